@@ -0,0 +1,79 @@
+"""
+基准测试用的本地 MCP 服务，不依赖网络。
+
+Stand-in MCP server for benchmarks. Tools:
+    echo(text)            返回原文
+    sleep(seconds)        等待后返回
+    large(n_bytes)        返回 n_bytes 字节的文本
+    tool_0000 ... tool_N  --tools N 生成的同构工具，用于测试大工具目录
+
+用法 (usage):
+    python bench/fake_mcp_server.py                        # stdio，供 mcp_conf.json 使用
+    python bench/fake_mcp_server.py --transport http --port 18500
+"""
+
+import argparse
+import asyncio
+
+from fastmcp import FastMCP
+
+
+def build_server(n_tools: int = 0, large_bytes: int = 1024 * 1024) -> FastMCP:
+    mcp = FastMCP('bench')
+
+    @mcp.tool
+    def echo(text: str) -> str:
+        """Return the text unchanged."""
+        return text
+
+    @mcp.tool
+    async def sleep(seconds: float) -> str:
+        """Wait for the given number of seconds, then return."""
+        await asyncio.sleep(seconds)
+        return f"slept {seconds}s"
+
+    @mcp.tool
+    def large(n_bytes: int = large_bytes) -> str:
+        """Return a text payload of n_bytes bytes."""
+        return 'x' * int(n_bytes)
+
+    def make_tool(i: int):
+        def tool(query: str, limit: int = 10) -> str:
+            return f"tool_{i:04d}: {query} ({limit})"
+        tool.__name__ = f"tool_{i:04d}"
+        tool.__doc__ = f"Synthetic tool number {i} for catalog benchmarks. Looks up '{i}' records matching a query."
+        return tool
+
+    for i in range(n_tools):
+        mcp.tool(make_tool(i))
+
+    @mcp.prompt
+    def greet(name: str) -> str:
+        """Say hello."""
+        return f"Hello {name}"
+
+    @mcp.resource('data://bench')
+    def data() -> str:
+        return 'bench data'
+
+    return mcp
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in MCP server for benchmarks")
+    parser.add_argument("--transport", default='stdio', choices=['stdio', 'http'])
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=18500)
+    parser.add_argument("--tools", type=int, default=0, help="number of extra synthetic tools")
+    parser.add_argument("--large-bytes", type=int, default=1024 * 1024, help="default payload size of the large tool")
+    args = parser.parse_args()
+
+    mcp = build_server(args.tools, args.large_bytes)
+    if args.transport == 'http':
+        mcp.run(transport='http', host=args.host, port=args.port, show_banner=False)
+    else:
+        mcp.run(show_banner=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+基准测试用的 OpenAI 兼容 chat.completions 接口，不调用任何真实模型。
+
+Stand-in OpenAI-compatible chat endpoint for benchmarks.
+
+行为 (behaviour):
+    最后一条消息来自用户且请求带有工具时，返回对 echo 工具（或第一个工具）的调用；
+    否则返回一段固定的回答。--latency 为每次请求的固定延迟（秒）。
+
+用法 (usage):
+    python bench/fake_openai_server.py --port 18600 --latency 0.05
+    settings.json: "openai_url": "http://127.0.0.1:18600/v1"
+"""
+
+import argparse
+import json
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+app = Flask(__name__)
+LATENCY = 0.0
+
+
+def count_tokens(obj) -> int:
+    return len(json.dumps(obj, ensure_ascii=False)) // 4 + 1
+
+
+@app.post('/v1/chat/completions')
+def chat_completions():
+    data = request.get_json()
+    if LATENCY:
+        time.sleep(LATENCY)
+    lst_messages = data.get('messages') or []
+    lst_tools = data.get('tools') or []
+    last = lst_messages[-1] if lst_messages else {}
+    if lst_tools and last.get('role') == 'user':
+        lst_names = [t['function']['name'] for t in lst_tools]
+        tool_name = next((n for n in lst_names if n.startswith('echo')), lst_names[0])
+        message = {
+            'role': 'assistant',
+            'content': None,
+            'tool_calls': [{
+                'id': 'call_' + uuid.uuid4().hex[:12],
+                'type': 'function',
+                'function': {'name': tool_name, 'arguments': json.dumps({'text': str(last.get('content'))})},
+            }],
+        }
+        finish_reason = 'tool_calls'
+    else:
+        message = {'role': 'assistant', 'content': 'This is a benchmark answer.'}
+        finish_reason = 'stop'
+    prompt_tokens = count_tokens(lst_messages) + count_tokens(lst_tools)
+    completion_tokens = count_tokens(message)
+    return jsonify({
+        'id': 'chatcmpl-' + uuid.uuid4().hex,
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': data.get('model', 'bench'),
+        'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    })
+
+
+@app.get('/v1/models')
+def models():
+    return jsonify({'object': 'list', 'data': [{'id': 'bench', 'object': 'model'}]})
+
+
+def main():
+    global LATENCY
+    parser = argparse.ArgumentParser(description="Stand-in OpenAI-compatible chat endpoint")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=18600)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    LATENCY = args.latency
+    app.run(host=args.host, port=args.port, debug=False, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
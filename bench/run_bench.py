@@ -0,0 +1,344 @@
+"""
+端到端基准测试：在临时目录中启动管理器、若干个本地 MCP 服务和假的 OpenAI 接口，全程离线。
+
+End-to-end benchmark. Starts the manager, N stand-in MCP services and a
+fake OpenAI endpoint in a temporary directory, all offline, and measures:
+
+    boot              启动到 API 可用、到全部服务可用的时间
+    catalog_fetch     get_tools_by_name(force_reload=True) 读取大工具目录的耗时
+    api_all_cold      第一次 /api/all 的耗时
+    api_services      /api/services 的延迟
+    direct_mcp_call   直接访问服务 out_port（mcp_stdio_to_http 代理）的 call_tool 延迟
+    call_tool         /api/services/<name>/call_tool 的吞吐与延迟（并发）
+    ai_chat_stream    首个事件时间与总耗时
+
+结果写入 --out 目录下的 JSON 文件，便于比较不同版本。
+
+用法 (usage):
+    python bench/run_bench.py --services 5 --tools 200 --calls 500 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from fastmcp import Client  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def summarize(lst_seconds: list, total_seconds: float = None) -> dict:
+    """
+    延迟统计（毫秒）：p50 / p90 / p99 / max / mean；给出 total_seconds 时附带吞吐（次/秒）。
+    """
+    if not lst_seconds:
+        return {'n': 0}
+    lst_ms = sorted(s * 1000 for s in lst_seconds)
+
+    def pct(p):
+        return round(lst_ms[min(len(lst_ms) - 1, int(round(p / 100 * (len(lst_ms) - 1))))], 3)
+
+    dict_res = {
+        'n': len(lst_ms),
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p99_ms': pct(99),
+        'max_ms': round(lst_ms[-1], 3),
+        'mean_ms': round(sum(lst_ms) / len(lst_ms), 3),
+    }
+    if total_seconds:
+        dict_res['throughput_per_s'] = round(len(lst_ms) / total_seconds, 2)
+    return dict_res
+
+
+def write_workdir(workdir: Path, args, mcp_ports: list, openai_port: int):
+    dict_servers = {}
+    for i, port in enumerate(mcp_ports):
+        lst_args = [str(BENCH_DIR / 'fake_mcp_server.py')]
+        if i == 0:  # 第一个服务带大工具目录
+            lst_args += ['--tools', str(args.tools)]
+        dict_servers[f'bench_{i}'] = {
+            'command': sys.executable,
+            'args': lst_args,
+            'out_port': port,
+        }
+    (workdir / 'mcp_conf.json').write_text(json.dumps({'mcpServers': dict_servers}, indent=2), encoding='utf8')
+    (workdir / 'settings.json').write_text(json.dumps({
+        'enabled_srv': list(dict_servers),
+        'openai_url': f'http://127.0.0.1:{openai_port}/v1',
+        'openai_key': 'bench',
+        'openai_model': 'bench',
+        'state_db': '',  # 每次都从零开始
+        'tool_timeout': 30,
+    }, indent=2), encoding='utf8')
+
+
+async def wait_mcp_ready(url: str, t_end: float):
+    while time.monotonic() < t_end:
+        try:
+            async with Client({'mcp': {'url': url}}):
+                return True
+        except Exception:
+            await asyncio.sleep(0.1)
+    return False
+
+
+async def bench_boot(api: str, mcp_ports: list, t_launch: float, timeout: float) -> dict:
+    t_end = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=5) as http:
+        while True:
+            try:
+                if (await http.get(f'{api}/api/services')).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > t_end:
+                raise RuntimeError('manager did not start')
+            await asyncio.sleep(0.05)
+    t_api = time.monotonic() - t_launch
+    lst_ready = await asyncio.gather(*[wait_mcp_ready(f'http://127.0.0.1:{p}/mcp', t_end) for p in mcp_ports])
+    if not all(lst_ready):
+        raise RuntimeError('some services did not start')
+    return {
+        'api_ready_s': round(t_api, 3),
+        'all_services_ready_s': round(time.monotonic() - t_launch, 3),
+        'n_services': len(mcp_ports),
+    }
+
+
+async def bench_catalog(workdir: Path, repeat: int) -> dict:
+    """
+    在本进程中用 ProcessManager 读取 bench_0 的工具目录。
+    """
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import local_mcp_manager_core as core
+        manager = core.ProcessManager(core.load_conf())
+        lst_seconds = []
+        n_tools = 0
+        for _ in range(repeat):
+            t0 = time.monotonic()
+            dict_res = await manager.get_tools_by_name('bench_0', force_reload=True)
+            lst_seconds.append(time.monotonic() - t0)
+            n_tools = len(dict_res.get('tools') or [])
+        return {**summarize(lst_seconds), 'n_tools': n_tools}
+    finally:
+        os.chdir(cwd)
+
+
+async def bench_api_all(api: str) -> dict:
+    async with httpx.AsyncClient(timeout=120) as http:
+        t0 = time.monotonic()
+        response = await http.get(f'{api}/api/all')
+        return {'seconds': round(time.monotonic() - t0, 3), 'bytes': len(response.content), 'status': response.status_code}
+
+
+async def bench_api_services(api: str, repeat: int) -> dict:
+    lst_seconds = []
+    async with httpx.AsyncClient(timeout=30) as http:
+        for _ in range(repeat):
+            t0 = time.monotonic()
+            response = await http.get(f'{api}/api/services')
+            response.raise_for_status()
+            lst_seconds.append(time.monotonic() - t0)
+    return summarize(lst_seconds)
+
+
+async def bench_direct_mcp(port: int, repeat: int) -> dict:
+    lst_seconds = []
+    async with Client({'mcp': {'url': f'http://127.0.0.1:{port}/mcp'}}) as client:
+        for i in range(repeat):
+            t0 = time.monotonic()
+            await client.call_tool('echo', {'text': f'hello {i}'})
+            lst_seconds.append(time.monotonic() - t0)
+    return summarize(lst_seconds)
+
+
+async def bench_call_tool(api: str, svc_name: str, tool_name: str, dict_params: dict, n_calls: int, concurrency: int) -> dict:
+    lst_seconds = []
+    n_errors = 0
+    queue = asyncio.Queue()
+    for i in range(n_calls):
+        queue.put_nowait(i)
+
+    async def worker(http):
+        nonlocal n_errors
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            t0 = time.monotonic()
+            try:
+                response = await http.post(
+                    f'{api}/api/services/{svc_name}/call_tool',
+                    json={'tool_name': tool_name, 'parameters': dict_params},
+                )
+                if response.status_code != 200 or not response.json().get('success'):
+                    n_errors += 1
+            except httpx.HTTPError:
+                n_errors += 1
+            lst_seconds.append(time.monotonic() - t0)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as http:
+        t0 = time.monotonic()
+        await asyncio.gather(*[worker(http) for _ in range(concurrency)])
+        total = time.monotonic() - t0
+    return {**summarize(lst_seconds, total), 'errors': n_errors, 'concurrency': concurrency, 'tool': tool_name}
+
+
+async def bench_chat(api: str, svc_name: str, repeat: int) -> dict:
+    lst_first = []
+    lst_total = []
+    async with httpx.AsyncClient(timeout=120) as http:
+        for i in range(repeat):
+            t0 = time.monotonic()
+            t_first = None
+            async with http.stream(
+                'POST', f'{api}/api/services/{svc_name}/ai_chat_stream',
+                json={'messages': [{'role': 'user', 'content': f'benchmark message {i}'}]},
+            ) as response:
+                async for line in response.aiter_lines():
+                    if line.startswith('data:') and t_first is None:
+                        t_first = time.monotonic() - t0
+            lst_first.append(t_first if t_first is not None else time.monotonic() - t0)
+            lst_total.append(time.monotonic() - t0)
+    return {'time_to_first_event': summarize(lst_first), 'total': summarize(lst_total)}
+
+
+def start_process(lst_cmd: list, cwd: Path, log_path: Path):
+    log = open(log_path, 'wb')
+    kwargs = {'start_new_session': True} if os.name == 'posix' else {}
+    return subprocess.Popen(lst_cmd, cwd=str(cwd), stdout=log, stderr=subprocess.STDOUT, **kwargs)
+
+
+def stop_process(proc):
+    if proc is None or proc.poll() is not None:
+        return
+    if os.name == 'posix':
+        import signal
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)  # 连同它启动的服务进程一起结束
+        except ProcessLookupError:
+            pass
+    else:
+        proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+async def run(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix='mcp-bench-'))
+    mcp_ports = [free_port() for _ in range(args.services)]
+    openai_port = free_port()
+    api_port = free_port()
+    api = f'http://127.0.0.1:{api_port}'
+    write_workdir(workdir, args, mcp_ports, openai_port)
+    print(f"[bench] workdir {workdir}")
+
+    proc_openai = proc_manager = None
+    dict_results = {}
+    try:
+        proc_openai = start_process(
+            [sys.executable, str(BENCH_DIR / 'fake_openai_server.py'), '--port', str(openai_port), '--latency', str(args.llm_latency)],
+            workdir, workdir / 'fake_openai.log',
+        )
+        t_launch = time.monotonic()
+        proc_manager = start_process(
+            [sys.executable, str(REPO_DIR / 'local_mcp_manager_flask.py'), '--port', str(api_port)],
+            workdir, workdir / 'manager.log',
+        )
+        print("[bench] boot")
+        dict_results['boot'] = await bench_boot(api, mcp_ports, t_launch, args.boot_timeout)
+        print("[bench] catalog_fetch")
+        dict_results['catalog_fetch'] = await bench_catalog(workdir, args.repeat)
+        print("[bench] api_all_cold")
+        dict_results['api_all_cold'] = await bench_api_all(api)
+        print("[bench] api_services")
+        dict_results['api_services'] = await bench_api_services(api, args.repeat * 5)
+        print("[bench] direct_mcp_call")
+        dict_results['direct_mcp_call'] = await bench_direct_mcp(mcp_ports[-1], args.calls)
+        print("[bench] call_tool")
+        svc_name = f'bench_{args.services - 1}'
+        dict_results['call_tool'] = {
+            'echo': await bench_call_tool(api, svc_name, 'echo', {'text': 'hello'}, args.calls, args.concurrency),
+            'sleep_100ms': await bench_call_tool(api, svc_name, 'sleep', {'seconds': 0.1}, args.calls // 5 or 1, args.concurrency),
+            'large': await bench_call_tool(api, svc_name, 'large', {'n_bytes': args.large_bytes}, args.calls // 10 or 1, args.concurrency),
+        }
+        print("[bench] ai_chat_stream")
+        dict_results['ai_chat_stream'] = await bench_chat(api, svc_name, args.repeat)
+    finally:
+        stop_process(proc_manager)
+        stop_process(proc_openai)
+        if args.keep_workdir:
+            print(f"[bench] logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return dict_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of Local MCP Manager")
+    parser.add_argument("--services", type=int, default=3, help="number of MCP services")
+    parser.add_argument("--tools", type=int, default=200, help="synthetic tools on the first service")
+    parser.add_argument("--calls", type=int, default=300, help="call_tool requests per run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=10, help="repetitions of the slower measurements")
+    parser.add_argument("--large-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds added by the fake OpenAI endpoint")
+    parser.add_argument("--boot-timeout", type=float, default=120)
+    parser.add_argument("--out", default=str(BENCH_DIR / 'results'), help="directory for the JSON result file")
+    parser.add_argument("--keep-workdir", action='store_true', help="keep the temporary directory with the logs")
+    args = parser.parse_args()
+    if args.services < 2:
+        parser.error('--services must be at least 2')
+
+    import local_mcp_manager_codec as codec
+    from local_mcp_manager_core import VERSION
+    dict_report = {
+        'version': VERSION,
+        'git_commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(REPO_DIR),
+                                     capture_output=True, text=True).stdout.strip() or None,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'json_backend': codec.BACKEND,
+        'params': vars(args),
+    }
+    dict_report['results'] = asyncio.run(run(args))
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_path = out_dir / f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    out_path.write_text(json.dumps(dict_report, indent=2, ensure_ascii=False), encoding='utf8')
+    print(json.dumps(dict_report['results'], indent=2))
+    print(f"[bench] results written to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+AI 对话的工具调用循环：轮次上限、时间与 token 预算、重复调用检测。
+
+Agent loop engine behind ai_chat_stream: round limit, wall-clock and token
+budgets, and early stop when the model repeats a tool call.
+"""
+
+import asyncio
+import time
+
+from fastmcp.exceptions import ToolError
+
+import local_mcp_manager_codec as codec
+from local_mcp_manager_cache import canonical_args
+from local_mcp_manager_chat import build_context, retrieval_query, summarize_extractive
+from local_mcp_manager_resilience import Deadline, DeadlineExceeded, ToolTimeoutError, ServiceUnavailable
+
+# 默认值。settings.json 的 "agent"、mcp_conf.json 中服务的 "agent"、请求中的 "agent" 依次覆盖
+AGENT_DEFAULTS = {
+    'max_rounds': 5,            # 调用模型的最大轮数，最后一轮不再提供工具
+    'max_seconds': None,        # 秒，整个循环的时间预算；None 表示只受 chat_timeout 限制
+    'max_tokens': None,         # 整个循环累计的 token 预算（以模型返回的 usage 计）；None 表示不限
+    'max_repeated_calls': 3,    # 同一工具、同样参数连续几次得到相同的结果后，下一轮让模型直接回答
+    'system_prompt': 'You can use tools to help user when necessary.',
+}
+
+
+def merge_agent_cfg(*lst_cfg) -> dict:
+    """
+    合并多层配置，后面的覆盖前面的；值为 None 的字段不覆盖。
+    """
+    dict_cfg = dict(AGENT_DEFAULTS)
+    for cfg in lst_cfg:
+        for k, v in (cfg or {}).items():
+            if k in AGENT_DEFAULTS and v is not None:
+                dict_cfg[k] = v
+    return dict_cfg
+
+
+def add_usage(dict_total: dict, usage) -> dict:
+    for k in ['prompt_tokens', 'completion_tokens', 'total_tokens']:
+        dict_total[k] = dict_total.get(k, 0) + int((usage or {}).get(k) or 0)
+    return dict_total
+
+
+class AgentLoop:
+    """
+    一次对话请求中的“模型 -> 工具 -> 模型”循环。
+
+    complete_fn(messages, tools, timeout): 异步函数，调用模型，返回 response 的 dict（含 choices / usage）。
+    tool_fn(tool_name, arguments, deadline): 异步函数，执行工具，返回结果 dict。
+    lst_tools: openai 格式的工具；tool_index / top_k 用于每轮只发送相关的工具（见 ToolIndex）。
+
+    run() 逐个产出 SSE 事件（JSON 字符串）。结束后 messages / summary 为更新后的历史，
+    stop_reason 为结束原因：answered / max_rounds / max_tokens / deadline / error。
+    """
+    def __init__(self, complete_fn, tool_fn, lst_tools: list, cfg: dict = None, deadline: Deadline = None,
+                 summarize_fn=None, context_max_tokens=8000, context_tool_max_chars=4000,
+                 tool_index=None, top_k: int = 0):
+        self.complete_fn = complete_fn
+        self.tool_fn = tool_fn
+        self.lst_tools = list(lst_tools)
+        self.tool_names = {t['function']['name'] for t in self.lst_tools}
+        self.cfg = merge_agent_cfg(cfg)
+        self.deadline = deadline or Deadline(None)
+        if self.cfg['max_seconds'] is not None:
+            remaining = self.deadline.remaining()
+            seconds = float(self.cfg['max_seconds'])
+            self.deadline = Deadline(seconds if remaining is None else min(seconds, remaining))
+        self.summarize_fn = summarize_fn or summarize_extractive
+        self.context_max_tokens = context_max_tokens
+        self.context_tool_max_chars = context_tool_max_chars
+        self.tool_index = tool_index
+        self.top_k = int(top_k or 0)
+
+        self.messages = []
+        self.summary = None
+        self.usage = {}
+        self.n_round = 0
+        self.stop_reason = None
+        self.seconds = None
+        self._sticky = set()  # 已经调用过的工具，之后每轮都发送
+        self._send_all_tools = False  # 模型要调用未知工具后，改为发送全部工具
+        self._call_counts = {}  # (工具名, 规范化参数) -> 连续得到相同结果的次数
+        self._last_results = {}  # (工具名, 规范化参数) -> 上一次的结果（JSON）
+        self._force_final = False  # 检测到重复调用后，下一轮不再提供工具
+
+    def _round_tools(self) -> list:
+        if self.tool_index is None or self._send_all_tools:
+            return self.lst_tools
+        set_selected = set(self.tool_index.search(retrieval_query(self.messages), self.top_k)) | self._sticky
+        return [t for t in self.lst_tools if t['function']['name'] in set_selected]
+
+    def _over_token_budget(self) -> bool:
+        max_tokens = self.cfg['max_tokens']
+        return max_tokens is not None and self.usage.get('total_tokens', 0) >= int(max_tokens)
+
+    async def run(self, lst_messages: list, summary: str = None):
+        self.messages = list(lst_messages)
+        self.summary = summary
+        t_start = time.monotonic()
+        max_rounds = int(self.cfg['max_rounds'])
+        while self.n_round < max_rounds:
+            if self._over_token_budget():
+                self.stop_reason = 'max_tokens'
+                break
+            self.n_round += 1
+            t_round = time.monotonic()
+            dict_round = {'type': 'round', 'round': self.n_round, 'tool_calls': 0, 'tool_seconds': 0.0}
+            try:
+                lst_context, lst_dropped, self.summary = await asyncio.to_thread(
+                    build_context, self.messages, self.summary,
+                    max_tokens=self.context_max_tokens,
+                    tool_max_chars=self.context_tool_max_chars,
+                    summarize_fn=self.summarize_fn,
+                )
+                self.messages = self.messages[len(lst_dropped):]  # 已并入摘要的消息不再保留
+                if self.cfg['system_prompt']:
+                    lst_context = [{'role': 'system', 'content': self.cfg['system_prompt']}] + lst_context
+
+                # 最后一轮、或检测到重复调用后，不再提供工具，让模型直接回答
+                is_final = self.n_round >= max_rounds or self._force_final
+                lst_round_tools = [] if is_final else self._round_tools()
+                dict_round['n_tools'] = len(lst_round_tools)
+
+                t_llm = time.monotonic()
+                dict_response = await self.complete_fn(lst_context, lst_round_tools, self.deadline.clamp())
+                dict_round['llm_seconds'] = round(time.monotonic() - t_llm, 3)
+                if dict_response.get('backend'):
+                    dict_round['backend'] = dict_response['backend']
+                dict_round['usage'] = add_usage({}, dict_response.get('usage'))
+                add_usage(self.usage, dict_response.get('usage'))
+
+                dict_choice = dict_response['choices'][0]
+                if dict_choice['finish_reason'] in ['tool_calls'] and dict_choice['message'].get('tool_calls'):
+                    self.messages.append(dict_choice['message'])
+                    for call in dict_choice['message']['tool_calls']:
+                        t_tool = time.monotonic()
+                        event = await self._run_tool_call(call)
+                        dict_round['tool_calls'] += 1
+                        dict_round['tool_seconds'] += time.monotonic() - t_tool
+                        yield event
+                    dict_round['tool_seconds'] = round(dict_round['tool_seconds'], 3)
+                else:  # 普通对话
+                    ai_response = dict_choice['message']['content']
+                    self.messages.append({'role': 'assistant', 'content': ai_response})
+                    yield codec.dumps({
+                        'type': 'response',
+                        'content': ai_response
+                    })
+                    self.stop_reason = 'answered'
+            except DeadlineExceeded as e:
+                self.stop_reason = 'deadline'
+                self._answer_pending_calls(f'Deadline exceeded: {e}')
+                yield codec.dumps({
+                    'type': 'error',
+                    'message': f'Deadline exceeded in round {self.n_round}: {str(e)}'
+                })
+            except Exception as e:
+                self.stop_reason = 'error'
+                self._answer_pending_calls(f'{type(e).__name__}: {e}')
+                yield codec.dumps({
+                    'type': 'error',
+                    'message': f'Error in round {self.n_round}: {str(e)}'
+                })
+            dict_round['seconds'] = round(time.monotonic() - t_round, 3)
+            yield codec.dumps(dict_round)
+            if self.stop_reason is not None:
+                break
+        if self.stop_reason is None:
+            self.stop_reason = 'max_rounds'
+        self.seconds = round(time.monotonic() - t_start, 3)
+
+    def _answer_pending_calls(self, error: str):
+        """
+        最后一条 assistant 消息中还没有结果的工具调用补上错误结果，历史中每个 tool_call_id 都有对应的 tool 消息。
+        """
+        for i in range(len(self.messages) - 1, -1, -1):
+            msg = self.messages[i]
+            if msg.get('role') == 'assistant':
+                break
+        else:
+            return
+        if not msg.get('tool_calls'):
+            return
+        set_answered = {m.get('tool_call_id') for m in self.messages[i + 1:] if m.get('role') == 'tool'}
+        for call in msg['tool_calls']:
+            if call.get('id') not in set_answered:
+                self.messages.append({
+                    'role': 'tool',
+                    'tool_call_id': call.get('id'),
+                    'content': codec.dumps({'error': error}),
+                })
+
+    async def _run_tool_call(self, call: dict) -> str:
+        """
+        执行一个工具调用，结果追加到历史，返回 tool_call 事件。
+        """
+        call_id = call.get('id')
+        tool_name = call['function']['name']
+        tool_params = call['function'].get("arguments", "{}")
+        key = None
+        try:
+            if tool_name not in self.tool_names:  # 不存在的工具：告诉模型，之后发送全部工具
+                self._send_all_tools = True
+                raise ToolError(f"Unknown tool '{tool_name}'")
+            self._sticky.add(tool_name)
+            try:
+                key = (tool_name, canonical_args(tool_params))
+            except Exception:  # 参数不是合法的 JSON，交给工具报错
+                key = (tool_name, tool_params)
+            tool_res = await self.tool_fn(tool_name, tool_params, self.deadline)
+        except DeadlineExceeded:
+            raise
+        except (ToolError, ToolTimeoutError, ServiceUnavailable) as e:  # 工具出错、超时或服务不可用，把错误交给模型处理
+            tool_res = {'error': str(e)}
+        except Exception as e:  # 其它异常（连接失败、参数无法解析等）同样作为该调用的结果，保证每个 tool_call_id 都有回复
+            tool_res = {'error': f'{type(e).__name__}: {e}'}
+        str_tool_res = codec.dumps(tool_res)  # 只编码一次，SSE 事件与历史消息共用
+
+        # 重复调用检测：轮询、失败后重试等结果会变化的调用不受限制，只有结果也相同时才计数
+        if key is not None:
+            if self._last_results.get(key) == str_tool_res:
+                self._call_counts[key] = self._call_counts.get(key, 0) + 1
+            else:
+                self._call_counts[key] = 1
+            self._last_results[key] = str_tool_res
+            if self._call_counts[key] >= int(self.cfg['max_repeated_calls']):
+                self._force_final = True
+
+        self.messages.append({
+            "role": 'tool',
+            'tool_call_id': call_id,
+            'content': str_tool_res,
+        })
+        # str_tool_res 已是 JSON，直接拼接，不再二次编码
+        return (
+            '{"type":"tool_call","tool_name":' + codec.dumps(tool_name)
+            + ',"parameters":' + codec.dumps(tool_params)
+            + ',"result":' + str_tool_res + '}'
+        )
+
+    def done_event(self) -> str:
+        return codec.dumps({
+            'type': 'done',
+            'rounds': self.n_round,
+            'stop_reason': self.stop_reason,
+            'usage': self.usage,
+            'seconds': self.seconds,
+        })
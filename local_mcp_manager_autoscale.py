@@ -0,0 +1,171 @@
+"""
+副本自动扩缩容：按每个服务的在途请求数、排队时间和延迟，在 min_replicas 与 max_replicas 之间调整副本数。
+
+Replica autoscaling. Every second the autoscaler samples, for each
+service with an "autoscale" block, the requests in flight on its
+replicas, the calls waiting in its admission queue, the average queue
+wait and the average latency. Over a sliding window it decides whether
+to add a replica or to drain one, with separate cooldowns for both
+directions.
+"""
+
+import threading
+import time
+from collections import deque
+
+from local_mcp_manager_gateway import ReplicaSet
+
+# mcp_conf.json 中服务的 "autoscale" 字段
+AUTOSCALE_DEFAULTS = {
+    'min_replicas': 1,
+    'max_replicas': 4,
+    'target_outstanding': 4,     # 每个副本的在途 + 排队请求数超过该值时扩容
+    'max_queue_wait': None,      # 秒，平均排队时间超过该值时扩容；None 表示不看
+    'max_latency': None,         # 秒，平均延迟超过该值时扩容；None 表示不看
+    'scale_down_ratio': 0.25,    # 每个副本的负载低于 target_outstanding 的这个比例时缩容
+    'window': 10,                # 秒，按这段时间内的平均值判断
+    'scale_up_cooldown': 15,     # 秒，两次扩容之间的最短间隔
+    'scale_down_cooldown': 120,  # 秒，任何一次扩缩容之后到下一次缩容的最短间隔
+    'drain_timeout': 30,         # 秒，缩容时等待在途请求完成的上限
+}
+
+
+def merge_autoscale_cfg(*lst_cfgs) -> dict:
+    """
+    依次覆盖默认值，None 的字段不覆盖。
+    """
+    cfg = dict(AUTOSCALE_DEFAULTS)
+    for c in lst_cfgs:
+        cfg.update({k: v for k, v in (c or {}).items() if v is not None})
+    cfg['min_replicas'] = max(1, int(cfg['min_replicas']))
+    cfg['max_replicas'] = max(cfg['min_replicas'], int(cfg['max_replicas']))
+    return cfg
+
+
+def decide(cfg: dict, n_replicas: int, lst_samples: list, now: float, last_up: float, last_change: float) -> int:
+    """
+    返回 +1（扩容）、-1（缩容）或 0。
+
+    lst_samples: [{'load', 'avg_wait', 'avg_latency'}]，load 为在途 + 排队请求数。
+    last_up: 上次扩容的时间；last_change: 上次扩容或缩容的时间（time.monotonic）。
+    """
+    if not lst_samples:
+        return 0
+    load = sum(s['load'] for s in lst_samples) / len(lst_samples)
+    per_replica = load / max(1, n_replicas)
+
+    lst_waits = [s['avg_wait'] for s in lst_samples if s.get('avg_wait') is not None]
+    lst_latencies = [s['avg_latency'] for s in lst_samples if s.get('avg_latency') is not None]
+    avg_wait = sum(lst_waits) / len(lst_waits) if lst_waits else None
+    avg_latency = sum(lst_latencies) / len(lst_latencies) if lst_latencies else None
+
+    # 平均排队时间和延迟只在有请求时更新，空闲时不参与判断
+    overloaded = per_replica > cfg['target_outstanding']
+    if load > 0 and cfg.get('max_queue_wait') is not None and avg_wait is not None and avg_wait > cfg['max_queue_wait']:
+        overloaded = True
+    if load > 0 and cfg.get('max_latency') is not None and avg_latency is not None and avg_latency > cfg['max_latency']:
+        overloaded = True
+
+    if n_replicas < cfg['min_replicas']:
+        return 1
+    if overloaded:
+        if n_replicas < cfg['max_replicas'] and now - last_up >= cfg['scale_up_cooldown']:
+            return 1
+        return 0
+    if n_replicas > cfg['max_replicas']:
+        return -1
+    if (n_replicas > cfg['min_replicas']
+            and per_replica < cfg['target_outstanding'] * cfg['scale_down_ratio']
+            and now - last_change >= cfg['scale_down_cooldown']):
+        return -1
+    return 0
+
+
+class Autoscaler:
+    """
+    后台线程，每秒采样一次所有开启了 autoscale 的副本服务。
+
+    manager: ProcessManager。缩容（等待在途请求完成）在单独的线程中进行，不阻塞采样。
+    """
+    TICK = 1.0
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.samples = {}  # svc_name -> deque of samples
+        self.last_up = {}  # svc_name -> time.monotonic()
+        self.last_change = {}
+        self.draining = {}  # svc_name -> 正在缩容的线程
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='autoscaler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get_cfg(self, svc) -> dict:
+        return merge_autoscale_cfg(self.manager.basic_config.cfg.get('autoscale'), svc.get('autoscale'))
+
+    def _run(self):
+        while not self._stop.wait(self.TICK):
+            for svc in list(self.manager.services):
+                if not svc.get('autoscale'):
+                    continue
+                try:
+                    self.tick(svc)
+                except Exception as e:
+                    print(f"[autoscaler] {svc['name']}: {e}")
+
+    def tick(self, svc):
+        proc = svc.get('process')
+        if not isinstance(proc, ReplicaSet) or not proc.is_alive():
+            self.samples.pop(svc['name'], None)
+            return
+        cfg = self.get_cfg(svc)
+        name = svc['name']
+        admission = self.manager.get_guard(svc).admission.status()
+        if name not in self.samples:  # 刚启动，缩容冷却从现在算起
+            self.samples[name] = deque()
+            self.last_change[name] = time.monotonic()
+        samples = self.samples[name]
+        samples.append({
+            'load': proc.outstanding() + admission['waiting'],
+            'avg_wait': admission['avg_wait'],
+            'avg_latency': proc.avg_latency,
+        })
+        while len(samples) > max(1, int(cfg['window'] / self.TICK)):
+            samples.popleft()
+        if len(samples) < 3 and proc.n_active() >= cfg['min_replicas']:
+            return  # 样本太少
+
+        thread = self.draining.get(name)
+        if thread is not None and thread.is_alive():
+            return  # 上一次缩容还没完成
+        if proc.restarting:
+            return  # 滚动重启中
+        now = time.monotonic()
+        n_replicas = proc.n_active()
+        action = decide(cfg, n_replicas, list(samples), now,
+                        self.last_up.get(name, float('-inf')), self.last_change.get(name, float('-inf')))
+        if action > 0:
+            proc.add_replica()
+            self.last_up[name] = self.last_change[name] = now
+            samples.clear()
+            proc.record_event(f"scaled up to {n_replicas + 1} replicas")
+        elif action < 0:
+            replica = proc.pick_for_removal()
+            if replica is None:
+                return
+            self.last_change[name] = now
+            samples.clear()
+            proc.record_event(f"scaling down to {n_replicas - 1} replicas, draining replica {replica.index}")
+            thread = threading.Thread(
+                target=proc.remove_replica, args=(replica, float(cfg['drain_timeout'])),
+                name=f'drain-{name}', daemon=True,
+            )
+            self.draining[name] = thread
+            thread.start()
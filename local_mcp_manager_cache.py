@@ -0,0 +1,220 @@
+"""
+工具调用结果缓存与大结果落盘。
+
+Result cache for idempotent MCP tools, and disk spool for large binary results.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import local_mcp_manager_codec as codec
+
+
+def canonical_args(arguments) -> str:
+    """
+    参数规范化：键排序、紧凑分隔符，保证相同参数得到相同的键。
+
+    Canonical JSON of the tool arguments.
+    """
+    if isinstance(arguments, str):
+        arguments = codec.loads(arguments or '{}')
+    return json.dumps(arguments or {}, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+class ToolResultCache:
+    """
+    按 (service, tool, 规范化参数) 缓存工具结果。
+    支持 TTL、条目数与字节数上限的 LRU 淘汰，以及按服务失效。
+
+    Cache of tool results keyed by (service, tool, canonical arguments), with
+    per-entry TTL and LRU eviction bounded by entry count and total bytes.
+    Values are the result dicts; their encoded size is what is accounted.
+    """
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self._data = OrderedDict()  # key -> (expires_at, value, n_bytes)
+        self._lock = threading.Lock()
+        self.n_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        self.svc_stats = {}  # svc_name -> {'hits': n, 'misses': n}
+
+    @staticmethod
+    def make_key(svc_name: str, tool_name: str, arguments) -> tuple:
+        return (svc_name, tool_name, canonical_args(arguments))
+
+    def _count(self, svc_name, field):
+        self.stats[field] += 1
+        dict_svc = self.svc_stats.setdefault(svc_name, {'hits': 0, 'misses': 0})
+        dict_svc[field] += 1
+
+    def get(self, key):
+        """
+        命中返回缓存值，否则返回 None。
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._count(key[0], 'misses')
+                return None
+            expires_at, value, n_bytes = item
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.stats['expirations'] += 1
+                self._count(key[0], 'misses')
+                return None
+            self._data.move_to_end(key)
+            self._count(key[0], 'hits')
+            return value
+
+    def put(self, key, value, ttl: float):
+        if isinstance(value, (bytes, str)):
+            n_bytes = len(value)
+        else:
+            n_bytes = len(codec.dumps_bytes(value))
+        if n_bytes > self.max_bytes:  # 单条超过总上限，不缓存
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + float(ttl), value, n_bytes)
+            self.n_bytes += n_bytes
+            while len(self._data) > self.max_entries or self.n_bytes > self.max_bytes:
+                old_key = next(iter(self._data))
+                self._remove(old_key)
+                self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, _, n_bytes = self._data.pop(key)
+        self.n_bytes -= n_bytes
+
+    def invalidate_service(self, svc_name: str) -> int:
+        """
+        删除某个服务的全部缓存（服务重启、工具目录变化时）。
+        """
+        with self._lock:
+            lst_keys = [k for k in self._data if k[0] == svc_name]
+            for k in lst_keys:
+                self._remove(k)
+            self.stats['invalidations'] += len(lst_keys)
+            return len(lst_keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.n_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            n_lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': round(self.stats['hits'] / n_lookups, 4) if n_lookups else None,
+                'entries': len(self._data),
+                'bytes': self.n_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'services': {k: dict(v) for k, v in self.svc_stats.items()},
+            }
+
+
+# ========== 大结果落盘 ==========
+
+class BlobSpool:
+    """
+    把工具结果中较大的二进制内容（image / audio 的 data、嵌入资源的 blob）写入磁盘，
+    结果里只保留引用，避免在内存中被反复复制和序列化。
+
+    Spool large binary contents of tool results to disk and replace them with
+    references served by /api/blobs/<blob_id>. Files are named by content hash,
+    so identical blobs are stored once; files older than `ttl` are removed.
+    """
+    def __init__(self, spool_dir='spool', threshold=1024 * 1024, ttl=3600):
+        self.spool_dir = Path(spool_dir)
+        self.threshold = int(threshold)
+        self.ttl = float(ttl)
+        self._last_cleanup = 0.0
+
+    def path_of(self, blob_id: str):
+        """
+        blob_id 对应的文件路径；非法 id 返回 None。
+        """
+        if not re.fullmatch(r'[0-9a-f]{64}', blob_id or ''):
+            return None
+        path = self.spool_dir / blob_id
+        return path if path.exists() else None
+
+    def _write(self, raw: bytes) -> str:
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        blob_id = hashlib.sha256(raw).hexdigest()
+        path = self.spool_dir / blob_id
+        if not path.exists():
+            fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir, suffix='.tmp')  # 每个写入者用自己的临时文件
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(raw)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
+        self._cleanup()
+        return blob_id
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for path in self.spool_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime > self.ttl:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def _spool_item(self, item: dict, key: str) -> dict:
+        """
+        item[key] 是 base64 字符串，超过阈值时替换为引用。
+        """
+        str_b64 = item.get(key)
+        if not isinstance(str_b64, str) or len(str_b64) * 3 // 4 < self.threshold:
+            return item
+        raw = base64.b64decode(str_b64)
+        blob_id = self._write(raw)
+        item = {k: v for k, v in item.items() if k != key}
+        item['blob_ref'] = {
+            'id': blob_id,
+            'url': f'/api/blobs/{blob_id}',
+            'size': len(raw),
+            'mimeType': item.get('mimeType'),
+        }
+        return item
+
+    def spool_result(self, dict_result: dict) -> dict:
+        """
+        处理 dump 后的工具结果，返回替换了大内容的新结果。
+        """
+        if not isinstance(dict_result, dict) or not dict_result.get('content'):
+            return dict_result
+        lst_content = []
+        for item in dict_result['content']:
+            if not isinstance(item, dict):
+                lst_content.append(item)
+            elif item.get('type') in ['image', 'audio']:
+                lst_content.append(self._spool_item(item, 'data'))
+            elif item.get('type') == 'resource' and isinstance(item.get('resource'), dict):
+                lst_content.append({**item, 'resource': self._spool_item(item['resource'], 'blob')})
+            else:
+                lst_content.append(item)
+        return {**dict_result, 'content': lst_content}
@@ -0,0 +1,258 @@
+"""
+AI 对话相关：服务端会话存储、上下文窗口管理与工具检索。
+
+Chat support: server-side conversation store, context window management
+and tool retrieval.
+"""
+
+import math
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    _encoding = None
+
+
+# ========== token 估算与截断 ==========
+
+def estimate_tokens(text) -> int:
+    """
+    估算文本的 token 数。装了 tiktoken 时精确计算，否则按 4 个字符一个 token 估算。
+    """
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def estimate_message_tokens(msg: dict) -> int:
+    """
+    单条消息的 token 数（内容 + 工具调用参数 + 固定开销）。
+    """
+    n = 4
+    n += estimate_tokens(msg.get('content'))
+    for call in msg.get('tool_calls') or []:
+        function = call.get('function') or {}
+        n += estimate_tokens(function.get('name')) + estimate_tokens(function.get('arguments'))
+    return n
+
+
+def elide_text(text: str, max_chars: int) -> str:
+    """
+    超长文本只保留头尾，中间替换为省略标记。
+    """
+    if not isinstance(text, str) or len(text) <= max_chars:
+        return text
+    n_head = max_chars * 2 // 3
+    n_tail = max_chars - n_head
+    n_elided = len(text) - n_head - n_tail
+    return f"{text[:n_head]}\n...[{n_elided} chars elided]...\n{text[-n_tail:]}"
+
+
+def split_turns(lst_messages: list) -> list:
+    """
+    按用户消息切分为轮次，保证 assistant 的 tool_calls 与对应的 tool 结果留在同一轮。
+    """
+    lst_turns = []
+    for msg in lst_messages:
+        if msg.get('role') == 'user' or not lst_turns:
+            lst_turns.append([msg])
+        else:
+            lst_turns[-1].append(msg)
+    return lst_turns
+
+
+def summarize_extractive(lst_messages: list, summary: str = None, max_chars: int = 200) -> str:
+    """
+    默认的摘要方式：不调用模型，每条消息保留开头一段。
+    """
+    lst_lines = [summary] if summary else []
+    for msg in lst_messages:
+        if msg.get('role') == 'tool':
+            continue  # 旧的工具结果不进入摘要
+        content = msg.get('content') or ''
+        if not content and msg.get('tool_calls'):
+            content = 'called ' + ', '.join((c.get('function') or {}).get('name', '') for c in msg['tool_calls'])
+        lst_lines.append(f"{msg.get('role')}: {elide_text(content, max_chars)}")
+    return '\n'.join(lst_lines)
+
+
+def build_context(lst_messages: list, summary: str = None, max_tokens: int = 8000,
+                  tool_max_chars: int = 4000, summarize_fn=None):
+    """
+    在 token 预算内构造发给模型的消息列表。
+
+    1. 过长的工具结果截断为头尾；
+    2. 超出预算时，从最早的轮次开始移出，移出的内容并入摘要，摘要作为一条 system 消息放在最前面。
+
+    Returns:
+        (lst_context, lst_dropped, summary): 发给模型的消息、被移出的消息、更新后的摘要
+    """
+    summarize_fn = summarize_fn or summarize_extractive
+    lst_messages = [
+        {**msg, 'content': elide_text(msg['content'], tool_max_chars)} if msg.get('role') == 'tool' else msg
+        for msg in lst_messages
+    ]
+    lst_turns = split_turns(lst_messages)
+    lst_dropped = []
+
+    def total_tokens():
+        n = estimate_tokens(summary) if summary else 0
+        return n + sum(estimate_message_tokens(msg) for turn in lst_turns for msg in turn)
+
+    while len(lst_turns) > 1 and total_tokens() > max_tokens:
+        lst_dropped += lst_turns.pop(0)
+    if lst_dropped:
+        summary = summarize_fn(lst_dropped, summary)
+        if estimate_tokens(summary) > max_tokens // 2:  # 摘要本身也不能无限增长
+            summary = elide_text(summary, max_tokens * 2)
+
+    lst_context = [msg for turn in lst_turns for msg in turn]
+    if summary:
+        lst_context = [{'role': 'system', 'content': f"Summary of the earlier conversation:\n{summary}"}] + lst_context
+    return lst_context, lst_dropped, summary
+
+
+# ========== 会话存储 ==========
+
+class ConversationStore:
+    """
+    服务端会话存储，按 session_id 保存完整历史，客户端每次只需发送新消息。
+    超过 ttl 未使用的会话、超过 max_sessions 的最旧会话会被清除。
+
+    Server-side conversation store keyed by session ID.
+    """
+    def __init__(self, max_sessions=256, ttl=3600):
+        self.max_sessions = int(max_sessions)
+        self.ttl = float(ttl)
+        self._sessions = {}  # session_id -> {'messages': [], 'summary': str, 'updated_at': float}
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        now = time.time()
+        for sid in [sid for sid, s in self._sessions.items() if now - s['updated_at'] > self.ttl]:
+            self._sessions.pop(sid)
+        while len(self._sessions) > self.max_sessions:
+            sid = min(self._sessions, key=lambda k: self._sessions[k]['updated_at'])
+            self._sessions.pop(sid)
+
+    def get(self, session_id: str = None):
+        """
+        读取会话，不存在时新建。返回 (session_id, messages 副本, summary)。
+        """
+        with self._lock:
+            self._expire()
+            if not session_id:
+                session_id = uuid.uuid4().hex
+            session = self._sessions.setdefault(
+                session_id, {'messages': [], 'summary': None, 'updated_at': time.time()}
+            )
+            return session_id, list(session['messages']), session['summary']
+
+    def save(self, session_id: str, lst_messages: list, summary: str = None):
+        """
+        保存会话的完整历史（已被摘要的消息不再保存）。
+        """
+        with self._lock:
+            self._sessions[session_id] = {
+                'messages': list(lst_messages),
+                'summary': summary,
+                'updated_at': time.time(),
+            }
+            self._expire()
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'sessions': len(self._sessions), 'max_sessions': self.max_sessions}
+
+
+# ========== 工具检索 ==========
+
+def tokenize(text: str) -> list:
+    """
+    检索用的分词：英文、数字按单词切分（下划线、驼峰也切开），中文按单字切分。
+    """
+    if not text:
+        return []
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', str(text)).lower()
+    return re.findall(r'[a-z0-9]+|[\u4e00-\u9fff]', text)
+
+
+def tool_document(dict_tool: dict) -> str:
+    """
+    openai 格式的工具 -> 检索文本：名称、描述、参数名与参数描述。
+    """
+    function = dict_tool.get('function') or {}
+    lst_parts = [function.get('name') or '', function.get('description') or '']
+    for name, prop in ((function.get('parameters') or {}).get('properties') or {}).items():
+        lst_parts.append(name)
+        if isinstance(prop, dict):
+            lst_parts.append(prop.get('description') or '')
+    return ' '.join(lst_parts)
+
+
+class ToolIndex:
+    """
+    工具的 BM25 检索索引，本地计算，不依赖模型。
+    工具很多时，每一轮只把与对话最相关的 top_k 个工具发给模型。
+
+    BM25 index over tool names, descriptions and parameter schemas.
+    """
+    def __init__(self, lst_tools: list, k1: float = 1.5, b: float = 0.75):
+        self.names = [t['function']['name'] for t in lst_tools]
+        self.k1 = k1
+        self.b = b
+        self._docs = [Counter(tokenize(tool_document(t))) for t in lst_tools]
+        self._doc_len = [sum(doc.values()) for doc in self._docs]
+        self._avg_len = (sum(self._doc_len) / len(self._docs)) if self._docs else 0.0
+        n_docs = len(self._docs)
+        df = Counter(term for doc in self._docs for term in doc)
+        self._idf = {term: math.log(1 + (n_docs - n + 0.5) / (n + 0.5)) for term, n in df.items()}
+
+    def scores(self, query: str) -> list:
+        lst_terms = [term for term in tokenize(query) if term in self._idf]
+        lst_scores = []
+        for doc, doc_len in zip(self._docs, self._doc_len):
+            score = 0.0
+            for term in lst_terms:
+                tf = doc.get(term)
+                if tf:
+                    norm = self.k1 * (1 - self.b + self.b * doc_len / (self._avg_len or 1))
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            lst_scores.append(score)
+        return lst_scores
+
+    def search(self, query: str, top_k: int) -> list:
+        """
+        返回得分最高的 top_k 个工具名，同分时保持原有顺序。
+        """
+        lst_scores = self.scores(query)
+        lst_order = sorted(range(len(self.names)), key=lambda i: -lst_scores[i])
+        return [self.names[i] for i in lst_order[:top_k]]
+
+
+def retrieval_query(lst_messages: list, n_messages: int = 4) -> str:
+    """
+    用最近几条用户 / 助手消息作为检索词，最新的用户消息权重最高（重复一次）。
+    """
+    lst_texts = [
+        msg.get('content') for msg in lst_messages[-n_messages:]
+        if msg.get('role') in ['user', 'assistant'] and isinstance(msg.get('content'), str)
+    ]
+    lst_user = [msg.get('content') for msg in lst_messages if msg.get('role') == 'user' and isinstance(msg.get('content'), str)]
+    if lst_user:
+        lst_texts.append(lst_user[-1])
+    return '\n'.join(lst_texts)
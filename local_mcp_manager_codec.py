@@ -0,0 +1,72 @@
+"""
+JSON 编解码。安装了 orjson 或 msgspec 时使用它们，否则使用标准库 json。
+
+JSON codec with an optional fast backend (orjson, then msgspec, then stdlib json).
+Internal APIs pass dicts around; a payload is encoded once, right before it
+leaves the process. loads raises json.JSONDecodeError on malformed input
+with every backend.
+"""
+
+import json
+
+try:
+    import orjson
+    BACKEND = 'orjson'
+except ImportError:
+    orjson = None
+    try:
+        import msgspec
+        BACKEND = 'msgspec'
+    except ImportError:
+        msgspec = None
+        BACKEND = 'json'
+
+
+def _default(obj):
+    """
+    无法直接序列化的对象（如 pydantic 的 AnyUrl）转为字符串。
+    """
+    return str(obj)
+
+
+if BACKEND == 'orjson':
+    def dumps_bytes(obj, indent: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, default=_default, option=option)
+
+    def loads(data):
+        return orjson.loads(data)
+
+elif BACKEND == 'msgspec':
+    _encoder = msgspec.json.Encoder(enc_hook=_default)
+    _decoder = msgspec.json.Decoder()
+
+    def dumps_bytes(obj, indent: bool = False) -> bytes:
+        data = _encoder.encode(obj)
+        return msgspec.json.format(data, indent=2) if indent else data
+
+    def loads(data):
+        # 与 json / orjson 一致，格式错误时抛出 json.JSONDecodeError（ValueError 的子类）
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            doc = data.decode('utf-8', 'replace') if isinstance(data, (bytes, bytearray, memoryview)) else str(data)
+            raise json.JSONDecodeError(str(e), doc, 0) from None
+
+else:
+    def dumps_bytes(obj, indent: bool = False) -> bytes:
+        return dumps(obj, indent).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+
+def dumps(obj, indent: bool = False) -> str:
+    """
+    编码为 str（非 ASCII 字符原样保留）。
+    """
+    if BACKEND == 'json':
+        if indent:
+            return json.dumps(obj, indent=2, ensure_ascii=False, default=_default)
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default)
+    return dumps_bytes(obj, indent).decode('utf-8')
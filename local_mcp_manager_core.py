@@ -1,70 +1,311 @@
 import multiprocessing as mp
 import asyncio
+import copy
 import os
 import json
 import time
 import signal
 import sys
 import shutil
+import hashlib
+import socket
+from contextlib import contextmanager
 from pathlib import Path
+import uvicorn
+try:
+    import psutil
+except ImportError:
+    psutil = None
 from fastmcp import FastMCP
 from fastmcp import Client
 from fastmcp.server.proxy import ProxyClient
-from openai import OpenAI
+from fastmcp.exceptions import ToolError
+import local_mcp_manager_codec as codec
+from local_mcp_manager_chat import ConversationStore, ToolIndex, summarize_extractive
+from local_mcp_manager_agent import AgentLoop, merge_agent_cfg
+from local_mcp_manager_llm import LLMPool
+from local_mcp_manager_state import StateStore
+from local_mcp_manager_gateway import ReplicaSet, free_port
+from local_mcp_manager_autoscale import Autoscaler
+from local_mcp_manager_node import NodeClient, NodeError, RemoteProcess, place
+from local_mcp_manager_hub import ClientHub, PassthroughProcess, remote_client_conf, stdio_client_conf
+from local_mcp_manager_uds import bind_unix_socket, socket_path, uds_supported, uds_transport
+from local_mcp_manager_cache import ToolResultCache, BlobSpool
+from local_mcp_manager_resilience import Deadline, ToolTimeoutError, call_tool_cancellable, is_backend_failure, ServiceGuard, ServiceUnavailable, SingleFlight
 
 #
 VERSION = 'v0.3.1'
 #
 # ========== Entry ==========
 
-def mcp_stdio_to_http(json_str, host:str, port:int, name:str='MCP', cwd:str=None):
+def serve_http(local_proxy, host:str, port, uds:str=None, stateless_http:bool=None, json_response:bool=None):
+    """
+    以 streamableHTTP 模式运行代理。
+
+    uds: 同时在该 Unix socket 上监听（管理器内部访问用）；port 为 None / "null" 时只监听 socket。
+    stateless_http: 无状态模式，每个请求独立处理，不返回 Mcp-Session-Id，服务端不保存会话。
+    json_response: 直接返回 JSON，而不是 SSE 流。None 表示使用 fastmcp 的默认值。
+    """
+    if not uds and stateless_http is None and json_response is None:
+        return local_proxy.run(transport='http', host=host, port=int(port))
+    lst_sockets = [bind_unix_socket(uds)] if uds else []
+    lst_addrs = [f"unix:{uds}"] if uds else []
+    if port not in [None, 'null', '']:
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+        sock.listen(2048)
+        lst_sockets.append(sock)
+        lst_addrs.append(f"http://{host}:{port}/mcp")
+    config = uvicorn.Config(
+        local_proxy.http_app(transport='http', stateless_http=stateless_http, json_response=json_response),
+        timeout_graceful_shutdown=0,
+        lifespan='on',
+    )
+    print(f"Starting MCP server {local_proxy.name!r} on {' and '.join(lst_addrs)}"
+          f" (stateless_http={stateless_http}, json_response={json_response})")
+    return uvicorn.Server(config).run(sockets=lst_sockets)
+
+def mcp_stdio_to_http(conf, host:str, port:int, name:str='MCP', cwd:str=None, detach:bool=False, uds:str=None,
+                      http_options:dict=None):
     """
     将 stdio 模式的MCP 代理为 httpstreamable 模式。
     Run MCP with npm / python, must work in stdio mode.
     
+    conf: {"mcpServers": {...}}，dict（也兼容 JSON 字符串）。
+    detach: 脱离管理器的进程组（POSIX），管理器退出或收到 Ctrl+C 时服务继续运行，
+        下次启动时由 adopt_running_services 接管。
+    uds: 同时监听的 Unix socket 路径，见 serve_http。
+    http_options: {"stateless_http": bool, "json_response": bool}，见 serve_http。
     输出： streamableHTTP 模式。
     Output: in streamableHTTP mode.
     """
+    if detach and os.name == "posix":
+        os.setsid()
     if cwd is not None:
         os.chdir(cwd)
     #
-    conf = json.loads(json_str)
+    if isinstance(conf, str):
+        conf = codec.loads(conf)
     try:
         client = ProxyClient(conf)
         local_proxy = FastMCP.as_proxy(
             client,
             name=name,
         )
-        tar = local_proxy.run(transport='http', host=host, port=int(port))
+        tar = serve_http(local_proxy, host, port, uds, **(http_options or {}))
     except:
         client = Client(conf)
         local_proxy = FastMCP.as_proxy(
             client,
             name=name,
         )
-        tar = local_proxy.run(transport='http', host=host, port=int(port))
+        tar = serve_http(local_proxy, host, port, uds, **(http_options or {}))
     finally:
         # 会停在 local_proxy.run 这一行，并不会向后执行
         print(f"tar = {tar}")
         return tar
 
-def mcp_to_openai(lst_mcp:list):
+# 精简模式下从参数 schema 中删除的字段，它们对模型选择和填写参数帮助不大
+SCHEMA_DROP_KEYS = {'title', '$schema', 'default', 'examples'}
+
+def minify_schema(schema):
+    """ 
+    精简 JSON schema，减少每次请求发送的 token。
+    删除 title / $schema / default / examples 与空的 description；properties 下的参数名保持不变。
+    """
+    if isinstance(schema, list):
+        return [minify_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    dict_res = {}
+    for k, v in schema.items():
+        if k in SCHEMA_DROP_KEYS or (k == 'description' and not v):
+            continue
+        if k in ['properties', '$defs', 'definitions'] and isinstance(v, dict):
+            dict_res[k] = {name: minify_schema(sub) for name, sub in v.items()}
+        else:
+            dict_res[k] = minify_schema(v)
+    return dict_res
+
+def mcp_to_openai(lst_mcp:list, minify:bool=False):
     """ 
     将 MCP 格式的工具文档转换为 openai 格式的。
+    不修改传入的工具文档；minify=True 时精简参数 schema，只保留描述的第一段。
     """
     lst_tools = []
     for mcp_tool in lst_mcp:
+        description = mcp_tool.get("description") or "null"
+        parameters = mcp_tool.get("inputSchema") or {"type": "object", "properties": {}}
+        if minify:
+            description = description.strip().split('\n\n')[0]
+            parameters = minify_schema(parameters)
         dict_tool = {
             "type":"function",
             "function": {
                 'name': mcp_tool.get('name'),
-                'description': mcp_tool.get("description","null"),
-                'parameters': mcp_tool.get("inputSchema")
+                'description': description,
+                'parameters': parameters
             }
         }
         lst_tools.append(dict_tool)
     return lst_tools
 
+def rename_openai_tool(dict_tool:dict, name:str) -> dict:
+    """ 
+    返回改了名字的副本（多个服务的工具重名时使用），缓存中的原对象不变。
+    """
+    return {**dict_tool, 'function': {**dict_tool['function'], 'name': name}}
+
+# 工具目录的各项：capability 名称、ClientSession 方法、结果字段
+CATALOG_SECTIONS = {
+    'tools': ('tools', 'list_tools', 'tools'),
+    'prompts': ('prompts', 'list_prompts', 'prompts'),
+    'resources': ('resources', 'list_resources', 'resources'),
+    'resource_templates': ('resources', 'list_resource_templates', 'resourceTemplates'),
+}
+
+async def list_all_pages(session, method:str, field:str) -> list:
+    """ 
+    调用 list_* 方法并跟随 nextCursor 读完所有分页。
+    """
+    lst_items = []
+    cursor = None
+    while True:
+        result = await getattr(session, method)(cursor)
+        lst_items += [t.model_dump(mode='json') for t in getattr(result, field)]
+        cursor = result.nextCursor
+        if not cursor:
+            return lst_items
+
+def dump_tool_result(tool_result) -> dict:
+    """ 
+    把 fastmcp 的 CallToolResult 转为可 JSON 序列化的 dict。
+    """
+    try:
+        return {
+            'content': [c.model_dump(mode='json') for c in tool_result.content],
+            'structured_content': tool_result.structured_content,
+            'is_error': tool_result.is_error,
+        }
+    except AttributeError:
+        return tool_result.model_dump(mode='json')
+
+def process_identity(pid:int):
+    """ 
+    进程的身份标识，与 pid 一起记录，用来确认 pid 没有被系统分配给别的进程。
+    Linux 读取 /proc/<pid>/stat 中的启动时间，其它系统使用 psutil 的 create_time；
+    都不可用或进程不存在时返回 None。
+    """
+    try:
+        with open(f'/proc/{int(pid)}/stat') as f:
+            return 'stat:' + f.read().rsplit(')', 1)[1].split()[19]  # 第 22 个字段 starttime
+    except (OSError, IndexError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            return f'ctime:{psutil.Process(int(pid)).create_time():.2f}'
+        except Exception:
+            pass
+    return None
+
+class AdoptedProcess:
+    """ 
+    管理器重启前启动、仍在运行的服务进程（不是当前进程的子进程）。
+    提供与 mp.Process 相同的 pid / is_alive / terminate / kill / join / exitcode，仅支持 POSIX。
+
+    identity: 记录的 process_identity。pid 上的进程身份不一致（原进程已退出、pid 被复用）时视为已退出，
+        terminate / kill 不发送信号。
+
+    A backend process started by a previous manager instance and adopted on boot.
+    """
+    def __init__(self, pid:int, identity:str=None):
+        self.pid = int(pid)
+        self.identity = identity
+
+    def is_same_process(self) -> bool:
+        return self.identity is not None and process_identity(self.pid) == self.identity
+
+    def is_alive(self) -> bool:
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:  # 进程存在，但属于其它用户
+            pass
+        return self.is_same_process()
+
+    @property
+    def exitcode(self):
+        return None if self.is_alive() else 0  # 不是子进程，拿不到真正的退出码
+
+    def start(self):
+        raise RuntimeError('An adopted process cannot be started again')
+
+    def _signal(self, sig):
+        if not self.is_same_process():
+            return
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+
+    def join(self, timeout=None):
+        t_end = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and (t_end is None or time.monotonic() < t_end):
+            time.sleep(0.05)
+
+    def __repr__(self):
+        return f"<AdoptedProcess pid={self.pid} alive={self.is_alive()}>"
+
+# svc['process'] 可以是其中之一；副本服务为 ReplicaSet，放在节点上的服务为 RemoteProcess，
+# 直连的远程服务为 PassthroughProcess
+PROCESS_TYPES = (mp.Process, AdoptedProcess, ReplicaSet, RemoteProcess, PassthroughProcess)
+
+async def probe_mcp(url, timeout:float=3.0) -> bool:
+    """ 
+    MCP 服务是否在 url 上正常响应（能完成 initialize 握手）。url 也可以是 transport（例如 Unix socket）。
+    """
+    try:
+        async def handshake():
+            async with Client({"mcp": {"url": url}} if isinstance(url, str) else url) as client:
+                return client.initialize_result is not None
+        return await asyncio.wait_for(handshake(), timeout)
+    except Exception:
+        return False
+
+async def probe_catalog(url:str, timeout:float=10.0) -> bool:
+    """
+    服务是否已经可以读取工具目录（滚动重启时判断新实例是否就绪）。
+    """
+    try:
+        async def list_tools():
+            async with Client({"mcp": {"url": url}}) as client:
+                await client.list_tools()
+                return True
+        return await asyncio.wait_for(list_tools(), timeout)
+    except Exception:
+        return False
+
+def port_unset(port) -> bool:
+    """ 
+    服务没有配置 out_port（"out_port": null 或没有写）。
+    """
+    return port in [None, 'null', '']
+
+def conf_hash(svc) -> str:
+    """ 
+    服务配置（mcpServers 中的一项）的哈希，用于判断保存的状态是否仍然适用。
+    """
+    str_conf = json.dumps(svc.get('conf'), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(str_conf.encode('utf-8')).hexdigest()
+
 class ProcessManager:
     """ 
     运行于后台的 MCP 服务管理。
@@ -77,6 +318,73 @@ class ProcessManager:
         self.services = services  
         self.name_index = {svc["name"]: i for i, svc in enumerate(self.services)}  
         self.basic_config = basic_config()
+        self.guards = {}  # svc_name -> ServiceGuard
+        self.openai_tools = {}  # svc_name -> (catalog_hash, minify, openai 格式的工具 tuple)
+        self.tool_indexes = {}  # 所选服务的 (名称, catalog_hash) 组合 -> ToolIndex
+        self.llm_pool = None  # LLM 后端池，配置变化时重建
+        self.nodes = {}  # 节点名 -> NodeClient，settings.json 的 nodes 变化时重建
+        self._nodes_key = None
+        self._llm_pool_key = None
+        self.autoscaler = Autoscaler(self)  # 有服务开启 autoscale 时启动
+        self.hub = ClientHub()  # 直连服务的常驻会话
+        self.single_flight = SingleFlight()  # 合并相同的并发目录读取与可缓存工具调用
+        self.conversations = ConversationStore(
+            max_sessions=self.basic_config.cfg.get('chat_sessions_max'),
+            ttl=self.basic_config.cfg.get('chat_session_ttl'),
+        )
+        self.blob_spool = BlobSpool(
+            spool_dir=self.basic_config.cfg.get('spool_dir'),
+            threshold=self.basic_config.cfg.get('spool_threshold'),
+            ttl=self.basic_config.cfg.get('spool_ttl'),
+        )
+        self.tool_cache = ToolResultCache(
+            max_entries=self.basic_config.cfg.get('tool_cache_max_entries'),
+            max_bytes=self.basic_config.cfg.get('tool_cache_max_bytes'),
+        )
+        # 运行状态持久化，重启后立即恢复工具目录
+        self.state = None
+        if self.basic_config.cfg.get('state_db'):
+            self.state = StateStore(
+                path=self.basic_config.cfg.get('state_db'),
+                history_max=self.basic_config.cfg.get('state_history_max'),
+            )
+            self._restore_state()
+
+    def _restore_state(self):
+        """
+        从状态库恢复工具目录。服务配置变化过、或超过 state_catalog_max_age 秒的目录不恢复。
+        """
+        try:
+            dict_catalogs = self.state.load_catalogs()
+        except Exception as e:
+            print(f"[ProcessManager] restore state failed: {e}")
+            return
+        max_age = self.basic_config.cfg.get('state_catalog_max_age')
+        for svc in self.services:
+            saved = dict_catalogs.get(svc['name'])
+            if saved is None or saved['conf_hash'] != conf_hash(svc):
+                continue
+            if max_age and time.time() - saved['fetched_at'] > max_age:
+                continue
+            svc.update({section: saved['catalog'].get(section) or [] for section in CATALOG_SECTIONS})
+            svc['catalog_errors'] = {}
+            svc['catalog_hash'] = saved['catalog_hash']
+            svc['catalog_fetched_at'] = saved['fetched_at']
+            svc['mcp_status'] = 'LOADING'  # 服务启动后由 check_mcp_status 置为 ON
+
+    def save_service_state(self, svc):
+        """
+        把服务状态写入状态库（异步）。
+        """
+        if self.state is None:
+            return
+        proc = svc.get('process')
+        pid = proc.pid if isinstance(proc, PROCESS_TYPES) else None
+        if isinstance(proc, AdoptedProcess):
+            identity = proc.identity
+        else:
+            identity = process_identity(pid) if pid else None
+        self.state.save_service(svc, pid=pid, conf_hash=conf_hash(svc), pid_identity=identity)
 
     async def create(self):
         """ 
@@ -92,6 +400,38 @@ class ProcessManager:
         self.stop_all_running_services()  # 必须先关停，再刷新
         self.services = services  
         self.name_index = {svc["name"]: i for i, svc in enumerate(self.services)}  
+        self.guards = {}
+        self.openai_tools = {}
+        self.tool_indexes = {}
+        self.tool_cache.clear()
+        if self.state is not None:
+            self._restore_state()
+
+    def get_guard(self, svc) -> ServiceGuard:
+        """
+        获取服务的熔断与准入控制器（按需创建）。
+        服务级配置覆盖 settings.json 中的默认值。
+        副本服务的 max_concurrency 按每个副本计，并发上限随活动副本数变化，扩容后新副本能分到请求。
+        """
+        guard = self.guards.get(svc['name'])
+        if guard is None:
+            cfg = self.basic_config.cfg
+            breaker_cfg = dict(cfg.get('breaker') or {})
+            breaker_cfg.update(svc.get('breaker') or {})
+
+            def n_replicas():
+                proc = svc.get('process')
+                return proc.n_active() if isinstance(proc, ReplicaSet) else 1
+
+            guard = ServiceGuard(
+                breaker_cfg=breaker_cfg,
+                max_concurrency=svc.get('max_concurrency') or cfg.get('max_concurrency'),
+                max_queue=svc.get('max_queue') if svc.get('max_queue') is not None else cfg.get('max_queue'),
+                queue_timeout=svc.get('queue_timeout') if svc.get('queue_timeout') is not None else cfg.get('queue_timeout'),
+                n_units_fn=n_replicas,
+            )
+            self.guards[svc['name']] = guard
+        return guard
 
     # ---------- process control ----------
 
@@ -131,7 +471,7 @@ class ProcessManager:
         proc = svc.get("process")
         is_alive = False
         try:
-            is_alive = proc.is_alive() if isinstance(proc, mp.Process) else False
+            is_alive = proc.is_alive() if isinstance(proc, PROCESS_TYPES) else False
             print(f"[{svc['name']}] {svc.get('process')}, is_alive = {is_alive}")
         except:
             is_alive = False
@@ -143,6 +483,9 @@ class ProcessManager:
         """
         print(f"starting {svc['name']}")
         svc['is_enabled'] = True
+        svc.pop('start_error', None)
+        self.get_guard(svc).breaker.reset()  # 重启后重新统计
+        self.tool_cache.invalidate_service(svc['name'])
 
         if update_cfg:
             if svc['name'] not in self.basic_config.cfg.get('enabled_srv',[]):
@@ -153,7 +496,7 @@ class ProcessManager:
             return
         #
         # if olds not alive, clean 
-        if isinstance(svc.get("process"), mp.Process):
+        if isinstance(svc.get("process"), PROCESS_TYPES):
             if self.check_svc_alive(svc):
                 return
             else:
@@ -167,27 +510,191 @@ class ProcessManager:
         try:
             svc["process"].start()
         except:
-            p = mp.Process(
-                target=mcp_stdio_to_http,
-                args=(
-                    svc["conf"], 
-                    svc['host'],
-                    svc["port"], 
-                    svc["name"],
-                    svc['cwd'],
-                ),
-                daemon=False,  # The typical service process does not recommend daemon, allowing for controlled exit.
+            n_replicas = self.get_replica_count(svc)
+            svc['uds_path'] = None
+            is_gateway = n_replicas > 1 or svc.get('autoscale') or svc.get('rolling_restart')
+            needs_tcp = svc.get('placement') is None and not (self.is_passthrough(svc) and not svc.get('expose')) and (
+                is_gateway or not self.uds_path(svc)
             )
+            if needs_tcp and port_unset(svc['port']):
+                # 没有 out_port，又不能只监听 Unix socket（未开启 uds、路径过长、副本）：由系统分配端口；
+                # 放在节点上的服务由节点分配
+                svc['port'] = free_port()
+                print(f"[{svc['name']}] no out_port configured, listening on free port {svc['port']}")
+            if self.is_passthrough(svc) and not svc.get('expose'):
+                # 管理器直接访问远程服务或 stdio 后端，不启动本地代理进程
+                with self.mcp_endpoint(svc) as dict_conf:
+                    p = PassthroughProcess(self.hub, svc['name'], client_conf=dict_conf)
+            elif svc.get('placement') is not None:
+                # 放到集群节点上运行，按标签和剩余容量选择节点
+                p = RemoteProcess(
+                    place(svc['placement'], self.get_nodes(), svc['name']),
+                    svc['name'], svc['conf'], None if port_unset(svc['port']) else svc['port'], svc['cwd'],
+                    slots=int(svc['placement'].get('slots', 1)),
+                    http_options=self.http_options(svc),
+                )
+            elif is_gateway:
+                # 多个副本在内部端口上运行，网关占用 out_port
+                p = ReplicaSet(
+                    svc['name'],
+                    spawn_fn=lambda port: self._new_proxy_process(svc, '127.0.0.1', port, detach=False),
+                    n_replicas=n_replicas,
+                    host=svc['host'],
+                    port=svc['port'],
+                    balance=svc.get('balance') or self.basic_config.cfg.get('replica_balance'),
+                    health_interval=self.basic_config.cfg.get('replica_health_interval'),
+                    session_ttl=self.basic_config.cfg.get('replica_session_ttl'),
+                    max_sessions=self.basic_config.cfg.get('replica_max_sessions'),
+                )
+            else:
+                svc['uds_path'] = self.uds_path(svc)
+                p = self._new_proxy_process(
+                    svc, svc['host'], svc['port'], detach=bool(self.basic_config.cfg.get('keep_services_on_exit')),
+                    uds=svc['uds_path'],
+                )
             svc["process"] = p
-            svc["process"].start()
+            try:
+                svc["process"].start()
+                if isinstance(p, RemoteProcess):
+                    svc['port'] = p.port
+            except NodeError as e:
+                print(f"[{svc['name']}] placement failed: {e}")
+                svc['start_error'] = str(e)
+                svc['mcp_status'] = 'ERROR'
             svc["is_alive"] = self.check_svc_alive(svc)
+            if svc.get('autoscale'):
+                self.autoscaler.start()
+        self.save_service_state(svc)
+
+    def http_options(self, svc) -> dict:
+        """
+        代理子进程的 streamableHTTP 选项，来自服务的 "stateless_http" / "json_response"，没有写的不传。
+        """
+        return {k: bool(svc[k]) for k in ['stateless_http', 'json_response'] if svc.get(k) is not None}
+
+    def _new_proxy_process(self, svc, host, port, detach=False, uds=None) -> mp.Process:
+        """
+        创建（不启动）把服务代理到 host:port 的子进程。uds: 同时监听的 Unix socket。
+        """
+        return mp.Process(
+            target=mcp_stdio_to_http,
+            args=(
+                svc["conf"], 
+                host,
+                port, 
+                svc["name"],
+                svc['cwd'],
+                detach,
+                uds,
+                self.http_options(svc),
+            ),
+            daemon=False,  # The typical service process does not recommend daemon, allowing for controlled exit.
+        )
+
+    def uds_path(self, svc):
+        """
+        本地代理子进程额外监听的 Unix socket 路径，管理器内部通过它访问；没有开启时为 None。
+        服务的 "uds" 优先，其次 settings.json 的 proxy_uds。只用于单个代理进程（不用于副本和节点）。
+        """
+        enabled = svc.get('uds')
+        if enabled is None:
+            enabled = self.basic_config.cfg.get('proxy_uds')
+        if not enabled or not uds_supported():
+            return None
+        return socket_path(self.basic_config.cfg.get('uds_dir') or 'run', svc['name'])
+
+    def is_passthrough(self, svc) -> bool:
+        """
+        服务是否由管理器直接访问（不经过本地代理进程）：远程 http/sse 服务直接访问其 url，
+        stdio 服务由管理器自己启动后端，通过管道通信。
+        服务的 "passthrough" 优先，其次 settings.json 的 remote_passthrough / stdio_passthrough。
+        放在集群节点上的服务不直连；写了 "expose" 的 stdio 服务也不直连：本地代理已经启动了一个后端，
+        管理器经由代理访问，不再启动第二个。
+        """
+        if svc.get('placement') is not None:
+            return False
+        if svc.get('in_type') == 'stdio' and svc.get('expose'):
+            return False
+        if svc.get('passthrough') is not None:
+            return bool(svc['passthrough'])
+        if svc.get('in_type') in ['http', 'sse']:
+            return bool(self.basic_config.cfg.get('remote_passthrough'))
+        if svc.get('in_type') == 'stdio':
+            return bool(self.basic_config.cfg.get('stdio_passthrough'))
+        return False
+
+    def get_nodes(self) -> dict:
+        """
+        集群节点，settings.json 中的 "nodes": [{"name", "url", "token"}]。配置不变时复用已有的客户端。
+        """
+        lst_nodes = self.basic_config.cfg.get('nodes') or []
+        key = json.dumps(lst_nodes, sort_keys=True, default=str)
+        if key != self._nodes_key:
+            for node in self.nodes.values():
+                node.close()
+            self.nodes = {
+                n['name']: NodeClient(n['name'], n['url'], token=n.get('token'), timeout=n.get('timeout', 10.0))
+                for n in lst_nodes
+            }
+            self._nodes_key = key
+        return self.nodes
+
+    def get_replica_count(self, svc) -> int:
+        """
+        服务启动时的副本数，mcp_conf.json 中的 "replicas"，默认 1；
+        开启 autoscale 时不少于 min_replicas。
+        """
+        try:
+            n_replicas = max(1, int(svc.get('replicas') or 1))
+        except (TypeError, ValueError):
+            n_replicas = 1
+        if svc.get('autoscale'):
+            cfg = self.autoscaler.get_cfg(svc)
+            n_replicas = min(max(n_replicas, cfg['min_replicas']), cfg['max_replicas'])
+        return n_replicas
+
+    @contextmanager
+    def mcp_endpoint(self, svc):
+        """
+        管理器内部访问服务时使用的客户端配置 {"mcp": {"url": ...}}，或可以直接传给 Client 的 transport。
+        放在节点上的服务直接访问节点地址；直连的远程服务访问其 url（带注入的请求头）；
+        直连的 stdio 服务返回启动后端的 stdio 配置（由 hub 的常驻会话使用）；
+        代理子进程监听 Unix socket 时通过 socket 访问。
+
+        副本服务直接选择一个副本（不经过网关），调用期间计入该副本的在途请求数；
+        没有健康副本时抛出 ServiceUnavailable。
+        """
+        if self.is_passthrough(svc):
+            if svc.get('in_type') == 'stdio':
+                yield stdio_client_conf(svc)
+            else:
+                yield remote_client_conf(svc, self.basic_config.cfg.get('remote_headers'))
+            return
+        proc = svc.get('process')
+        if isinstance(proc, ReplicaSet):
+            with proc.acquire() as replica:
+                yield {"mcp": {"url": replica.url}}
+            return
+        if isinstance(proc, RemoteProcess):
+            yield {"mcp": {"url": proc.url}}
+            return
+        if svc.get('uds_path'):
+            yield uds_transport(svc['uds_path'])
+            return
+        if svc['host'].startswith("http"):
+            host = svc['host']
+        elif svc['host'] in ['127.0.0.1', '0.0.0.0']:
+            host = 'http://127.0.0.1'
+        else:
+            host = f"http://{svc['host']}"
+        yield {"mcp": {"url": f"{host}:{svc['port']}/mcp"}}
 
     def _stop_service(self, svc, timeout=3.0, update_cfg=True):
         """ 
         关闭具体的服务
         """
         proc = svc.get("process")
-        if not isinstance(proc, mp.Process):
+        if not isinstance(proc, PROCESS_TYPES):
             svc["is_alive"] = False
             return
         if not proc.is_alive():
@@ -197,10 +704,12 @@ class ProcessManager:
             # stop
             proc.terminate()
             proc.join(timeout=timeout)
-            if proc.is_alive():
+            if isinstance(proc, ReplicaSet):
+                proc.kill()
+            elif proc.is_alive():
                 if os.name == "posix":
                     try:
-                        os.kill(proc.pid, signal.SIGKILL)
+                        proc.kill()  # AdoptedProcess 会先确认 pid 仍是原来的进程
                     except Exception:
                         pass
                 else:
@@ -216,11 +725,122 @@ class ProcessManager:
             svc["is_alive"] = False
             svc['is_enabled'] = False
             svc['mcp_status'] = 'STOPPED'
+            if svc.get('uds_path'):
+                try:
+                    os.unlink(svc['uds_path'])
+                except OSError:
+                    pass
+            if self.is_passthrough(svc):  # 远程服务 expose 时本地代理之外还有 hub 中的会话
+                self.hub.close(svc['name'])
+            self.tool_cache.invalidate_service(svc['name'])
+            self.save_service_state(svc)
             if update_cfg:
                 if svc['name'] in self.basic_config.cfg.get('enabled_srv',[]):
                     self.basic_config.cfg['enabled_srv'] = [s for s in self.basic_config.cfg['enabled_srv'] if s not in [svc['name']]]
                     self.basic_config.save_cfg()
 
+    def restart_service(self, svc, reload=True) -> str:
+        """
+        重启单个服务，返回使用的方式：'rolling' 或 'stop_start'。
+
+        reload: 先从 mcp_conf.json 读取该服务的最新配置。
+        运行在网关后面的服务（replicas / autoscale / rolling_restart）逐个替换副本：新副本能读取工具目录后
+        才切换路由，旧副本的在途请求完成后再关闭，重启期间调用不中断。
+        新副本没有就绪时放弃，旧副本继续运行，抛出 RuntimeError。
+        out_port 变化或服务不在网关后面时，先停止再启动。
+        """
+        new_svc = None
+        if reload:
+            new_svc = next((s for s in load_conf() if s['name'] == svc['name']), None)
+        proc = svc.get('process')
+        rolling = (
+            isinstance(proc, ReplicaSet) and proc.is_alive()
+            and (new_svc is None or port_unset(new_svc['port']) or str(new_svc['port']) == str(svc['port']))
+        )
+        if new_svc is not None and port_unset(new_svc['port']):
+            new_svc['port'] = svc['port']  # 保留系统分配的端口
+        if new_svc is not None:
+            svc.update({k: v for k, v in new_svc.items() if k not in ['process', 'is_enabled', 'is_alive']})
+            self.guards.pop(svc['name'], None)  # 按新配置重建
+        if not rolling:
+            self._stop_service(svc, update_cfg=False)
+            self._start_service(svc)
+            return 'stop_start'
+
+        cfg = self.basic_config.cfg
+        proc.replace_all(
+            ready_fn=lambda replica: asyncio.run(probe_catalog(replica.url)),
+            ready_timeout=float(cfg.get('rolling_ready_timeout')),
+            drain_timeout=float(cfg.get('rolling_drain_timeout')),
+        )
+        self.tool_cache.invalidate_service(svc['name'])
+        try:
+            asyncio.run(self.get_tools_by_name(svc['name'], force_reload=True))  # 新版本的工具目录
+        except Exception as e:
+            print(f"[{svc['name']}] catalog refresh after restart failed: {e}")
+        self.save_service_state(svc)
+        return 'rolling'
+
+    def adopt_running_services(self):
+        """
+        管理器启动时调用：接管上一次运行留下、仍在运行的服务进程，而不是重新启动。
+
+        条件：状态库中记录的 pid 仍在运行且仍是原来的进程（process_identity 一致）、配置哈希与当前配置一致、
+        out_port 上的 MCP 能正常握手。配置已经变化的旧进程会被关闭，之后按正常流程重新启动。
+        无法确认身份的 pid（没有记录身份，或本机读不到）既不接管也不发送信号。
+        需要开启 state_db；只支持 POSIX。在没有运行事件循环的线程中调用。
+        """
+        if self.state is None or os.name != "posix":
+            return []
+        self.state.flush()
+        dict_saved = self.state.load_services()
+        lst_candidates = []
+        for svc in self.services:
+            saved = dict_saved.get(svc['name'])
+            if not saved or not saved.get('pid') or self.check_svc_alive(svc):
+                continue
+            proc = AdoptedProcess(saved['pid'], saved.get('pid_identity'))
+            if proc.identity is None or process_identity(proc.pid) is None:
+                print(f"[adopt] {svc['name']}: cannot verify process {proc.pid}, skipped")
+                continue
+            if not proc.is_alive():  # 已退出，或 pid 已被别的进程使用
+                continue
+            if port_unset(svc['port']) and saved.get('port'):
+                svc['port'] = saved['port']  # 上次由系统分配的端口
+            if saved.get('conf_hash') != conf_hash(svc) or str(saved.get('port')) != str(svc['port']):
+                print(f"[adopt] {svc['name']}: config changed, stopping old process {proc.pid}")
+                proc.terminate()
+                proc.join(timeout=3.0)
+                continue
+            lst_candidates.append((svc, proc))
+
+        def probe_target(svc):
+            uds = self.uds_path(svc)
+            if uds and os.path.exists(uds):  # 上一次运行时代理也监听了 socket
+                return uds_transport(uds)
+            return f"http://127.0.0.1:{svc['port']}/mcp"
+
+        async def probe_all():
+            return await asyncio.gather(*[probe_mcp(probe_target(svc)) for svc, _ in lst_candidates])
+        lst_healthy = asyncio.run(probe_all()) if lst_candidates else []
+
+        lst_adopted = []
+        for (svc, proc), healthy in zip(lst_candidates, lst_healthy):
+            if not healthy:
+                print(f"[adopt] {svc['name']}: process {proc.pid} is not answering on port {svc['port']}, not adopted")
+                continue
+            svc['process'] = proc
+            uds = self.uds_path(svc)
+            svc['uds_path'] = uds if uds and os.path.exists(uds) else None
+            svc['is_alive'] = True
+            svc['is_enabled'] = True
+            if svc.get('mcp_status') != 'LOADING':  # 没有恢复出工具目录时，等待第一次读取
+                svc['mcp_status'] = None
+            self.save_service_state(svc)
+            lst_adopted.append(svc['name'])
+            print(f"[adopt] {svc['name']}: adopted running process {proc.pid} on port {svc['port']}")
+        return lst_adopted
+
     def start_all_enabled_services(self):
         """
         Start all 'is_enabled' processes
@@ -231,11 +851,15 @@ class ProcessManager:
             if svc.get("name") in self.basic_config.cfg.get('enabled_srv',[]):
                 self._start_service(svc, update_cfg=False)
 
-    def stop_all_running_services(self):
+    def stop_all_running_services(self, replicated_only=False):
         """
         stop all services
+
+        replicated_only: 只关闭副本服务（keep_services_on_exit 时使用，网关在管理器进程内，无法保留）
         """
         for svc in self.services:
+            if replicated_only and not isinstance(svc.get('process'), ReplicaSet):
+                continue
             if svc.get("is_alive", False):
                 self._stop_service(svc,update_cfg=False)
 
@@ -254,7 +878,7 @@ class ProcessManager:
         """
         获取MCP介绍信息(异步)
 
-        返回 json 格式的结果
+        返回 dict: tools / prompts / resources / resource_templates / catalog_errors
         """
         dict_res = {'tools':[]}
         lst_svc = [svc for svc in self.services if svc.get("name") == svc_name]
@@ -263,95 +887,261 @@ class ProcessManager:
             dict_res['tools'] = svc.get("tools", False)
             dict_res['prompts'] = svc.get("prompts", False)
             dict_res['resources'] = svc.get("resources", False)
+            dict_res['resource_templates'] = svc.get("resource_templates", False)
+            dict_res['catalog_errors'] = svc.get("catalog_errors", {})
             if dict_res['tools'] and not force_reload: # 如果已经有工具，且不强制刷新的话
                 pass  # 直接返回缓存结果
             else:  # 否则读取工具明细
                 dict_res['tools'] = [] # 正在加载的状态
+                old_status = svc.get('mcp_status')
                 svc['mcp_status'] = 'LOADING'
-                if svc['host'].startswith("http"):
-                    host = svc['host']
-                elif svc['host'] in ['127.0.0.1', '0.0.0.0']:
-                    host = 'http://127.0.0.1'
 
-                dict_conf = {"mcp":{
-                    "url": f"{host}:{svc['port']}/mcp"
-                }}
+                async def fetch():
+                    dict_fetched = {}
+                    async with self.get_guard(svc).call(is_failure=is_backend_failure):
+                        with self.mcp_endpoint(svc) as dict_conf:
+                            await self._fetch_catalog(svc, dict_conf, dict_fetched)
+                    return dict_fetched
+
+                try:
+                    dict_res.update(await self.single_flight.do(('catalog', svc_name), fetch))
+                except ServiceUnavailable:  # 熔断中或排队已满，不再访问后端，返回已有缓存
+                    svc['mcp_status'] = old_status
+                    dict_res['tools'] = svc.get("tools") or []
 
-                async with Client(dict_conf) as client:
-                    try:
-                        svc['tools'] = [t.model_dump() for t in await client.list_tools()]
-                        svc['prompts'] = [t.model_dump() for t in await client.list_prompts()]
-                        svc['resources'] = [t.model_dump() for t in await client.list_resources()]
-                        svc['mcp_status'] = 'ON'
-                        dict_res['tools'] = svc['tools']
-                        dict_res['prompts'] = svc['prompts']
-                        dict_res['resources'] = svc['resources']
-                    except:
-                        svc['tools'] = [str(t) for t in await client.list_tools()]
-                        svc['prompts'] = [str(t) for t in await client.list_prompts()]
-                        svc['resources'] = [str(t) for t in await client.list_resources()]
-                        svc['mcp_status'] = 'ERROR'
-                        dict_res['tools'] = svc['tools']
-                        dict_res['prompts'] = svc['prompts']
-                        dict_res['resources'] = svc['resources']
-                    # dict_res['resources'] = [t.modeawait client.list_resources()
-        
         # print(f"[get_tools_by_name] dict_res = {dict_res}")
-        try:
-            return json.dumps(dict_res, indent=2, ensure_ascii=False)
-        except:
-            return str(dict_res)
-    
+        return dict_res
+
+    async def _fetch_catalog(self, svc, dict_conf, dict_res):
+        """
+        从后端读取工具目录，写入 svc 与 dict_res。
+
+        tools / prompts / resources / resource_templates 在同一个会话上并发请求，
+        每一项都会跟随分页游标读完。某一项失败不影响其它项，该项保留上一次的内容，错误记录在 catalog_errors 中。
+        tools 读取失败时 mcp_status 为 ERROR。
+        """
+        async def read_catalog(client):
+            capabilities = client.initialize_result.capabilities
+            lst_sections = [
+                section for section, (capability, _, _) in CATALOG_SECTIONS.items()
+                if getattr(capabilities, capability, None) is not None
+            ]
+            results = await asyncio.gather(
+                *[list_all_pages(client.session, *CATALOG_SECTIONS[section][1:]) for section in lst_sections],
+                return_exceptions=True,
+            )
+            return lst_sections, results
+
+        if self.is_passthrough(svc):  # 在常驻会话上读取（stdio 服务不必再启动一个后端）
+            lst_sections, results = await self.hub.with_client(svc['name'], dict_conf, read_catalog)
+        else:
+            async with Client(dict_conf) as client:
+                lst_sections, results = await read_catalog(client)
+        dict_catalog = {section: [] for section in CATALOG_SECTIONS}  # 后端不支持的项为空列表
+        dict_errors = {}
+        for section, result in zip(lst_sections, results):
+            if isinstance(result, BaseException):
+                dict_errors[section] = f"{type(result).__name__}: {result}"
+                # 读取失败时保留上一次的内容，避免目录哈希变化（进而清空结果缓存和 openai 工具格式）
+                dict_catalog[section] = svc.get(section) or []
+            else:
+                dict_catalog[section] = result
+
+        svc.update(dict_catalog)
+        svc['catalog_errors'] = dict_errors
+        svc['mcp_status'] = 'ERROR' if 'tools' in dict_errors else 'ON'
+        svc['catalog_fetched_at'] = time.time()
+        catalog_hash = self._update_catalog_hash(svc)
+        if self.state is not None:
+            if not dict_errors:  # 只保存完整的目录
+                self.state.save_catalog(svc['name'], conf_hash(svc), catalog_hash, dict_catalog)
+            self.save_service_state(svc)
+        dict_res.update(dict_catalog)
+        dict_res['catalog_errors'] = dict_errors
+
+    def _update_catalog_hash(self, svc):
+        """
+        计算工具目录的哈希；目录变化时清空该服务的结果缓存。
+        """
+        str_catalog = json.dumps(
+            {section: svc.get(section) for section in CATALOG_SECTIONS},
+            sort_keys=True, ensure_ascii=False, default=str,
+        )  # 需要键排序，这里用标准库
+        catalog_hash = hashlib.sha256(str_catalog.encode('utf-8')).hexdigest()
+        if svc.get('catalog_hash') not in [None, catalog_hash]:
+            self.tool_cache.invalidate_service(svc['name'])
+        svc['catalog_hash'] = catalog_hash
+        return catalog_hash
+
+    def get_cache_ttl(self, svc, tool_name:str):
+        """
+        工具结果缓存的 TTL（秒），来自 mcp_conf.json 中服务的 "tool_cache": {tool_name: {"ttl": 秒}}。
+        未配置的工具不缓存，返回 None。
+        """
+        tool_cfg = (svc.get('tool_cache') or {}).get(tool_name)
+        if not tool_cfg:
+            return None
+        if isinstance(tool_cfg, dict):
+            return float(tool_cfg.get('ttl', self.basic_config.cfg.get('tool_cache_ttl')))
+        return float(tool_cfg)  # 也可以直接写秒数
+
+    def get_llm_pool(self) -> LLMPool:
+        """
+        LLM 后端池。重新读取 settings.json 中的模型配置，配置不变时复用已有的池（及其客户端和健康状态）。
+        """
+        self.basic_config.load_openai_cfg()
+        cfg = self.basic_config.cfg
+        key = json.dumps(
+            [cfg.get(k) for k in ['openai_url', 'openai_key', 'openai_model', 'llm_backends',
+                                  'llm_cooldown', 'llm_failure_threshold', 'llm_max_attempts', 'llm_queue_timeout',
+                                  'llm_cache', 'llm_cache_path', 'llm_cache_max_entries', 'llm_cache_max_bytes', 'llm_cache_ttl']],
+            sort_keys=True, default=str,
+        )
+        if self.llm_pool is None or key != self._llm_pool_key:
+            if self.llm_pool is not None and self.llm_pool.response_cache is not None:
+                self.llm_pool.response_cache.close()
+            self.llm_pool = LLMPool.from_cfg(cfg)
+            self._llm_pool_key = key
+        return self.llm_pool
+
+    def get_openai_tools(self, svc) -> tuple:
+        """
+        服务的工具列表（openai 格式），按 catalog_hash 缓存，目录变化时才重新转换。
+        返回的 tuple 与其中的 dict 是共享的，调用方不能修改，需要改名时用 rename_openai_tool。
+        """
+        minify = bool(self.basic_config.cfg.get('tool_schema_minify'))
+        cached = self.openai_tools.get(svc['name'])
+        if cached is not None and cached[:2] == (svc.get('catalog_hash'), minify):
+            return cached[2]
+        tup_tools = tuple(mcp_to_openai(svc.get('tools') or [], minify=minify))
+        self.openai_tools[svc['name']] = (svc.get('catalog_hash'), minify, tup_tools)
+        return tup_tools
+
+    def get_tool_index(self, lst_svc, lst_tools) -> ToolIndex:
+        """
+        所选服务全部工具的检索索引，按各服务的 catalog_hash 缓存。
+        """
+        key = (tuple((svc['name'], svc.get('catalog_hash')) for svc in lst_svc),
+               bool(self.basic_config.cfg.get('tool_schema_minify')))
+        index = self.tool_indexes.get(key)
+        if index is None:
+            if len(self.tool_indexes) >= 64:  # 只保留最近的组合
+                self.tool_indexes.pop(next(iter(self.tool_indexes)))
+            index = ToolIndex(lst_tools)
+            self.tool_indexes[key] = index
+        return index
+
     async def get_tools_all(self):
         """ 
         获取全部 MCP介绍信息
+
+        返回 dict: {服务名: get_tools_by_name 的结果}，出错的服务为 {'error': 错误信息}
         """
-        dict_tools = {}
         lst_tasks = [self.get_tools_by_name(s.get("name")) for s in self.services]
         results = await asyncio.gather(*lst_tasks, return_exceptions=True)
-        return str(results)
+        return {
+            s.get("name"): {'error': str(r)} if isinstance(r, BaseException) else r
+            for s, r in zip(self.services, results)
+        }
         
-    async def call_tool(self, svc_name:str, tool_name:str, tool_params:str):
+    def get_tool_timeout(self, svc, tool_name:str):
+        """
+        工具调用超时（秒）。优先级：tool_timeouts[tool] > 服务 timeout > settings.json 的 tool_timeout。
+
+        Timeout in seconds for one tool call.
+        """
+        timeout = (svc.get('tool_timeouts') or {}).get(tool_name)
+        if timeout is None:
+            timeout = svc.get('timeout')
+        if timeout is None:
+            timeout = self.basic_config.cfg.get('tool_timeout')
+        return None if timeout is None else float(timeout)
+
+    async def call_tool(self, svc_name:str, tool_name:str, tool_params, deadline:Deadline=None) -> dict:
         """
         调用工具
+
+        tool_params: dict，或 JSON 字符串（例如 LLM 给出的 arguments）。
+        超时见 get_tool_timeout；deadline 为整个请求的截止时间，两者取较小值。
+        返回 dict，由调用方在发送前序列化一次。
         """
+        if isinstance(tool_params, str):
+            tool_params = codec.loads(tool_params or '{}')
         dict_res = {}
+        cache_ttl = None
         lst_svc = [s for s in self.services if s.get("name")==svc_name]
         if len(lst_svc)>0:
             svc = lst_svc[0]
-            if svc['host'].startswith("http"):
-                host = svc['host']
-            elif svc['host'] in ['127.0.0.1', '0.0.0.0']:
-                host = 'http://127.0.0.1'
-
-            dict_conf = {"mcp":{
-                "url": f"{host}:{svc['port']}/mcp"
-            }}
-
-            async with Client(dict_conf) as client:
-                tool_result = await client.call_tool(tool_name, json.loads(tool_params))
-                try:
-                    dict_res['tool_result'] = tool_result.model_dump()
-                except:
-                    dict_res['tool_result'] = str(tool_result)
+            cache_ttl = self.get_cache_ttl(svc, tool_name)
+            if cache_ttl:
+                cache_key = self.tool_cache.make_key(svc_name, tool_name, tool_params)
+                cached = self.tool_cache.get(cache_key)
+                if cached is not None:
+                    if self.state is not None:
+                        self.state.record_call(svc_name, tool_name, True, 0.0, cached=True)
+                    return cached
+            timeout = self.get_tool_timeout(svc, tool_name)
+            if deadline is not None:
+                timeout = deadline.clamp(timeout)
+
+            async def call():
+                async with self.get_guard(svc).call(ok_exceptions=(ToolError,), is_failure=is_backend_failure):
+                    try:
+                        with self.mcp_endpoint(svc) as dict_conf:
+                            if self.is_passthrough(svc):  # 复用常驻会话
+                                return await self.hub.call_tool(svc['name'], dict_conf, tool_name, tool_params, timeout)
+                            async with Client(dict_conf) as client:
+                                return await call_tool_cancellable(client, tool_name, tool_params, timeout)
+                    except Exception as e:
+                        # 超时后关闭连接时，仍在读取的 SSE 流可能再抛出一个异常，把超时本身报告出去
+                        if isinstance(e.__context__, ToolTimeoutError):
+                            raise e.__context__ from None
+                        raise
+
+            t0 = time.monotonic()
+            try:
+                if cache_ttl:  # 可缓存的工具是幂等的，相同的并发调用可以合并
+                    tool_result = await self.single_flight.do(('call_tool',) + cache_key, call)
+                else:
+                    tool_result = await call()
+            except Exception as e:
+                if self.state is not None:
+                    self.state.record_call(svc_name, tool_name, False, time.monotonic() - t0, error=f"{type(e).__name__}: {e}")
+                raise
+            if self.state is not None:
+                self.state.record_call(svc_name, tool_name, True, time.monotonic() - t0)
+            try:
+                # 大的二进制内容落盘，只保留引用
+                dict_res['tool_result'] = self.blob_spool.spool_result(dump_tool_result(tool_result))
+            except Exception as e:
+                print(f"[call_tool] {svc_name}.{tool_name}: cannot convert result ({type(e).__name__}: {e}), returning it as text")
+                dict_res['tool_result'] = str(tool_result)
 
-        print(f"[call_tool] dict_res = {dict_res}")
-        return json.dumps(dict_res, ensure_ascii=False)
+        if dict_res and cache_ttl:
+            self.tool_cache.put(cache_key, dict_res, cache_ttl)
+        return dict_res
 
-    async def ai_chat_stream(self, svc_name: str, lst_messages: list):
+    async def ai_chat_stream(self, svc_name: str, lst_messages: list, deadline: Deadline = None, session_id: str = None,
+                             agent_cfg: dict = None):
         """
         AI聊天流式接口 - 使用OpenAI API调用MCP工具，增量返回结果
 
         Args:
             svc_name: 服务名称
             lst_messages: 用户消息列表, openai-api格式
+            deadline: 整个对话请求的截止时间，默认取 settings.json 的 chat_timeout
+            session_id: 服务端会话。None 表示不使用会话（lst_messages 是完整历史）；
+                其它值表示 lst_messages 只是新消息，历史从会话中读取，'' 表示新建会话。
+            agent_cfg: 本次请求的循环参数（max_rounds / max_seconds / max_tokens 等，见 AGENT_DEFAULTS），
+                覆盖 settings.json 与服务的 "agent" 配置
 
         Yields:
             JSON字符串，每次工具调用或AI响应后返回
         """
-        print(f"【core|ai_chat_stream】svc_name = {svc_name}, lst_messages = {lst_messages}")
-        
-        lst_tools = []
+        if deadline is None:
+            deadline = Deadline(self.basic_config.cfg.get('chat_timeout'))
+
+        lst_tools = []  # openai 格式
         dict_tools = {}
 
         # 获取服务的工具列表
@@ -366,108 +1156,106 @@ class ProcessManager:
             # return
         else:
             for svc in lst_svc:
-                tmp_lst_tools = svc.get('tools', [])
-                for tool in tmp_lst_tools:
-                    tool_name_real = tool['name']
+                for tool in self.get_openai_tools(svc):
+                    tool_name_real = tool['function']['name']
                     tool_name_uniq = tool_name_real
                     n = 0
                     while tool_name_uniq in dict_tools.keys():
                         n+=1
                         tool_name_uniq = tool_name_real + '_' + str(n)
-                    tool['name'] = tool_name_uniq
+                    if tool_name_uniq != tool_name_real:  # 重名时使用副本，不修改缓存
+                        tool = rename_openai_tool(tool, tool_name_uniq)
                     dict_tools[tool_name_uniq] = {"tool_name":tool_name_real,"svc_name":svc.get("name")}
-                lst_tools += tmp_lst_tools
+                    lst_tools.append(tool)
 
         # 消息列表
         lst_msg_selected = [
             msg for msg in lst_messages if msg['role'] in ['user', 'assistant', 'system'] and len(msg['content'])>0
         ]
+        summary = None
+        if session_id is not None:
+            session_id, lst_history, summary = self.conversations.get(session_id)
+            lst_msg_selected = lst_history + lst_msg_selected
+            yield codec.dumps({
+                'type': 'session',
+                'session_id': session_id
+            })
 
         try:
-            self.basic_config.load_openai_cfg()
-            openai_url = self.basic_config.cfg['openai_url']
-            openai_key = self.basic_config.cfg['openai_key']
-            openai_model = self.basic_config.cfg['openai_model']
-
+            llm_pool = self.get_llm_pool()
+            if not llm_pool.backends:
+                raise ValueError('no LLM backend configured')
         except Exception as e:
-            yield json.dumps({
+            yield codec.dumps({
                 'type': 'error',
                 'message': f'Error while read openai config {e}'
-            }, ensure_ascii=False)
+            })
             return
 
-        # 调用工具
-        client = OpenAI(
-            api_key=openai_key,
-            base_url=openai_url,
+        async def complete(messages, tools, timeout):
+            # 请求是同步的，放到线程里执行，避免阻塞事件循环，也让取消能及时生效
+            return await asyncio.to_thread(llm_pool.complete, messages, tools, timeout)
+
+        async def run_tool(tool_name, tool_params, deadline):
+            return await self.call_tool(
+                svc_name=dict_tools[tool_name].get("svc_name"),
+                tool_name=dict_tools[tool_name].get("tool_name"),
+                tool_params=tool_params,
+                deadline=deadline,
+            )
+
+        # 上下文窗口：每一轮都把发给模型的消息控制在 token 预算内
+        cfg = self.basic_config.cfg
+        if cfg.get('context_summarize') == 'llm':
+            summarize_fn = self._llm_summarizer(llm_pool)
+        else:
+            summarize_fn = summarize_extractive
+
+        # 工具检索：工具数超过 top_k 时，每轮只发送与对话最相关的 top_k 个
+        top_k = int(cfg.get('tool_retrieval_top_k') or 0)
+        tool_index = None
+        if top_k and len(lst_tools) > top_k:
+            tool_index = await asyncio.to_thread(self.get_tool_index, lst_svc, lst_tools)
+
+        agent = AgentLoop(
+            complete, run_tool, lst_tools,
+            cfg=merge_agent_cfg(cfg.get('agent'), *[svc.get('agent') for svc in lst_svc], agent_cfg),
+            deadline=deadline,
+            summarize_fn=summarize_fn,
+            context_max_tokens=cfg.get('context_max_tokens'),
+            context_tool_max_chars=cfg.get('context_tool_max_chars'),
+            tool_index=tool_index,
+            top_k=top_k,
         )
+        async for event in agent.run(lst_msg_selected, summary):
+            yield event
+
+        # 出错结束的一轮不保存：会话保持这一轮之前的历史，不留下不完整的消息
+        if session_id is not None and agent.stop_reason != 'error':
+            self.conversations.save(session_id, agent.messages, agent.summary)
 
-        n_round = 0
-        MAX_ROUND = 5
-        while n_round < MAX_ROUND:
-            n_round += 1
+        # 返回完成信号（含轮数、结束原因与累计 token）
+        yield agent.done_event()
+
+    def _llm_summarizer(self, llm_pool:LLMPool):
+        """ 
+        用模型对移出上下文的旧消息做摘要；调用失败时退回到 summarize_extractive。
+        """
+        def summarize(lst_messages, summary=None):
+            str_old = summarize_extractive(lst_messages, summary, max_chars=2000)
             try:
-                if n_round < MAX_ROUND and len(lst_tools)>0:
-                    response = client.chat.completions.create(
-                        model = openai_model,
-                        messages=[{"role":"system","content":"You can use tools to help user when necessary."}] + lst_msg_selected,
-                        tools=mcp_to_openai(lst_tools),
-                    )
-                else: # 最后一次 不再使用工具了，避免死循环
-                    response = client.chat.completions.create(
-                        model = openai_model,
-                        messages = lst_msg_selected,
-                    )
-                #
-                # 检查返回模式
-                if response.model_dump()['choices'][0]['finish_reason'] in ['tool_calls']: # 工具调用
-                    #
-                    lst_msg_selected.append(response.model_dump()['choices'][0]['message'])
-                    #
-                    for call in response.model_dump()['choices'][0]['message']['tool_calls']:
-                        call_id = call.get('id')
-                        tool_name = call['function']['name']
-                        tool_params = call['function'].get("arguments","{}")
-                        #
-                        tool_res = await self.call_tool(
-                            svc_name=dict_tools[tool_name].get("svc_name"),
-                            tool_name=dict_tools[tool_name].get("tool_name"),
-                            tool_params=tool_params
-                        )
-
-                        # 增量返回每个工具调用结果
-                        yield json.dumps({
-                            'type': 'tool_call',
-                            'tool_name': tool_name,
-                            'parameters': tool_params,
-                            'result': str(tool_res)
-                        }, ensure_ascii=False)
-
-                        lst_msg_selected.append({
-                            "role": 'tool',
-                            'tool_call_id': call_id,
-                            'content': tool_res,
-                        })
-
-                else:  # 普通对话
-                    ai_response = response.model_dump()['choices'][0]['message']['content']
-                    # 返回最终AI响应
-                    yield json.dumps({
-                        'type': 'response',
-                        'content': ai_response
-                    }, ensure_ascii=False)
-                    break
+                dict_response = llm_pool.complete(
+                    messages=[
+                        {'role': 'system', 'content': 'Summarize the conversation below in a few sentences. Keep facts, decisions and open questions.'},
+                        {'role': 'user', 'content': str_old},
+                    ],
+                    timeout=30,
+                )
+                return dict_response['choices'][0]['message']['content']
             except Exception as e:
-                yield json.dumps({
-                    'type': 'error',
-                    'message': f'Error in round {n_round}: {str(e)}'
-                }, ensure_ascii=False)
-                break
-
-        # 返回完成信号
-        yield json.dumps({
-            'type': 'done'
-        }, ensure_ascii=False)
+                print(f"[ai_chat_stream] summarize failed: {e}")
+                return summarize_extractive(lst_messages, summary)
+        return summarize
 
 #%%
 
@@ -525,10 +1313,28 @@ def load_conf(filepath = 'mcp_conf.json'):
             'process':None,
             'in_type':"stdio" if ms_value.get("command",False) else ms_value.get("type", "sse" if ms_value.get("url","").find("/sse")>0 else "http"),
             'out_type': 'http',
-            'conf': json.dumps({"mcpServers":{ms_key:ms_value}}, ensure_ascii=False),
+            'conf': {"mcpServers":{ms_key:ms_value}},
             'host': ms_value.get("host", '127.0.0.1'),
             'cwd': ms_value.get("cwd", None),
             'port': ms_value.get("out_port", "null"),
+            'timeout': ms_value.get("timeout", None),  # 秒，服务级工具调用超时
+            'tool_timeouts': ms_value.get("tool_timeouts", {}),  # {tool_name: 秒}
+            'max_concurrency': ms_value.get("max_concurrency", None),
+            'max_queue': ms_value.get("max_queue", None),
+            'queue_timeout': ms_value.get("queue_timeout", None),
+            'breaker': ms_value.get("breaker", {}),
+            'tool_cache': ms_value.get("tool_cache", {}),  # {tool_name: {"ttl": 秒}}
+            'replicas': ms_value.get("replicas", 1),  # 副本数，大于 1 时由网关在 out_port 上分发
+            'balance': ms_value.get("balance", None),  # least_outstanding / round_robin
+            'autoscale': ms_value.get("autoscale", None),  # 副本自动扩缩容，字段见 AUTOSCALE_DEFAULTS
+            'placement': ms_value.get("placement", None),  # 集群模式：{"node": 名称} 或 {"tags": [...], "slots": n}
+            'rolling_restart': ms_value.get("rolling_restart", False),  # 运行在网关后面，重启时不中断
+            'passthrough': ms_value.get("passthrough", None),  # 由管理器直接访问远程 http/sse 服务或 stdio 后端
+            'expose': ms_value.get("expose", False),  # 直连时仍在 out_port 上启动本地代理，供外部客户端使用（stdio 服务此时经由代理访问，不直连）
+            'uds': ms_value.get("uds", None),  # 代理子进程同时监听 Unix socket，管理器内部经 socket 访问
+            # 代理的 streamableHTTP 模式：无状态（请求可以发到任意副本）、JSON 响应（不用 SSE 流）
+            'stateless_http': ms_value.get("stateless_http", None),
+            'json_response': ms_value.get("json_response", None),
             # "is_enabled": ms_value.get("is_enabled", True),
             "is_enabled": False, 
             "is_alive": False,
@@ -785,6 +1591,76 @@ class mcp_config:
         pass
 
 
+# settings.json 中运行参数的默认值
+RUNTIME_DEFAULTS = {
+    'tool_timeout': 60,    # 秒，单次工具调用的默认超时
+    'chat_timeout': 300,   # 秒，ai_chat_stream 整个请求的截止时间
+    # 准入控制（每个服务），可在 mcp_conf.json 中按服务覆盖
+    'max_concurrency': 8,  # 同时进行的调用数上限（副本服务按每个副本计）
+    'max_queue': 32,       # 排队数上限，超过立即拒绝
+    'queue_timeout': 10,   # 秒，排队超时
+    # 熔断（每个服务），可在 mcp_conf.json 中用 "breaker" 按服务覆盖，字段见 CircuitBreaker
+    'breaker': {},
+    # 工具结果缓存（只缓存 mcp_conf.json 中 "tool_cache" 列出的工具）
+    'tool_cache_ttl': 300,                       # 秒，未写 ttl 时的默认值
+    'tool_cache_max_entries': 1024,
+    'tool_cache_max_bytes': 64 * 1024 * 1024,
+    # 工具结果中超过阈值的二进制内容写入 spool_dir，通过 /api/blobs/<id> 读取
+    'spool_dir': 'spool',
+    'spool_threshold': 1024 * 1024,  # 字节
+    'spool_ttl': 3600,               # 秒
+    # AI 对话的上下文窗口与服务端会话
+    'context_max_tokens': 8000,         # 每轮发给模型的历史消息 token 预算
+    'context_tool_max_chars': 4000,     # 单个工具结果在上下文中保留的最大字符数
+    'context_summarize': 'extractive',  # 超出预算的旧消息如何摘要：extractive / llm
+    'chat_sessions_max': 256,
+    'chat_session_ttl': 3600,           # 秒
+    # 发给模型的工具 schema 是否精简（删除 title / default 等，描述只保留第一段）
+    'tool_schema_minify': False,
+    # 所选服务的工具总数超过该值时，每轮只发送检索出的最相关的这么多个工具；0 表示总是全部发送
+    'tool_retrieval_top_k': 16,
+    # 工具调用循环（轮数、时间与 token 预算、重复调用），字段见 local_mcp_manager_agent.AGENT_DEFAULTS
+    'agent': {},
+    # LLM 后端池（llm_backends 为空时使用 openai_url / openai_key / openai_model），见 local_mcp_manager_llm
+    'llm_cooldown': 30,           # 秒，失败或 429 后后端暂停使用的时间
+    'llm_failure_threshold': 3,   # 连续失败几次后进入冷却
+    'llm_max_attempts': 3,        # 一次请求最多尝试几个后端
+    'llm_queue_timeout': 30,      # 秒，所有后端并发都满时的等待上限
+    # 模型响应缓存：off / on / record / replay，见 LLMResponseCache
+    'llm_cache': 'off',
+    'llm_cache_path': 'llm_cache.sqlite3',
+    'llm_cache_max_entries': 10000,
+    'llm_cache_max_bytes': 256 * 1024 * 1024,
+    'llm_cache_ttl': 0,           # 秒，0 表示不过期
+    # 运行状态持久化（服务状态、工具目录、调用记录）的 SQLite 文件，例如 "state.sqlite3"；None 表示不保存（默认）
+    'state_db': None,
+    'state_catalog_max_age': 7 * 24 * 3600,  # 秒，启动时不恢复更旧的工具目录
+    'state_history_max': 100000,             # 调用记录最多保留的条数
+    # 管理器退出时不关闭服务，下次启动时接管（需要 state_db，仅 POSIX；副本服务总是关闭）
+    'keep_services_on_exit': False,
+    # 副本服务（mcp_conf.json 中 "replicas" 大于 1）
+    'replica_balance': 'least_outstanding',  # 或 round_robin，可用服务的 "balance" 覆盖
+    'replica_health_interval': 5,            # 秒，健康检查间隔
+    'replica_session_ttl': 3600,             # 秒，网关会话表中多久没有请求的会话被删除
+    'replica_max_sessions': 10000,           # 网关会话表的条数上限，超出时删除最久未使用的
+    # 滚动重启（restart_service）
+    'rolling_ready_timeout': 60,  # 秒，新副本就绪的等待上限，超时则放弃，旧副本继续运行
+    'rolling_drain_timeout': 30,  # 秒，旧副本等待在途请求完成的上限
+    # 各服务 "autoscale" 的默认值，字段见 local_mcp_manager_autoscale.AUTOSCALE_DEFAULTS
+    'autoscale': {},
+    # 远程 http/sse 服务直接访问，不启动本地代理进程（可用服务的 "passthrough" 覆盖）
+    'remote_passthrough': False,
+    'remote_headers': {},  # 直连时附加到所有远程服务的请求头，支持 ${ENV}
+    # stdio 服务由管理器自己启动后端，内部调用走管道，不启动本地代理进程（可用服务的 "passthrough" 覆盖）
+    'stdio_passthrough': False,
+    # 代理子进程同时监听 <uds_dir>/<服务名>-<hash>.sock，管理器内部调用走 socket（仅 POSIX，可用服务的 "uds" 覆盖）；
+    # 开启后没有写 out_port 的服务不再占用 TCP 端口
+    'proxy_uds': False,
+    'uds_dir': 'run',
+    # 集群节点 [{"name", "url", "token"}]，见 local_mcp_manager_node；只有写了 "placement" 的服务放到节点上
+    'nodes': [],
+}
+
 class basic_config:
     """ 
     """
@@ -793,8 +1669,10 @@ class basic_config:
         加载配置数据
         """
         self.cfg = {}
+        self.user_keys = set()  # settings.json 中用户写了的运行参数，save_cfg 时保留
         self.load_enabled_srv()
         self.load_openai_cfg()
+        self.load_runtime_cfg()
     
     def save_cfg(self):
         """ 
@@ -802,7 +1680,7 @@ class basic_config:
         """
         try:
             with open('settings.json','w+') as f:
-                json.dump(self.cfg, f, indent=4, ensure_ascii=False)
+                json.dump(self.user_cfg(), f, indent=4, ensure_ascii=False)
             return {
                 'status': 'Succeed',
                 'info': 'saved'
@@ -813,18 +1691,58 @@ class basic_config:
                 'info': str(e)
             }
     
+    def user_cfg(self) -> dict:
+        """
+        要写入 settings.json 的内容：不写与默认值相同、用户也没有设置过的运行参数，
+        这样以后修改 RUNTIME_DEFAULTS 仍然对已有用户生效。
+        """
+        return {
+            k: v for k, v in self.cfg.items()
+            if k not in RUNTIME_DEFAULTS or k in self.user_keys or v != RUNTIME_DEFAULTS[k]
+        }
+
     def load_openai_cfg(self):
+        """ 
+        读取模型配置：单个端点 openai_url / openai_key / openai_model，或多个端点 llm_backends。
+        每次使用模型前调用，运行参数中的 llm_* 也一并重新读取，修改 settings.json 后不用重启。
+        """
         try:
             with open('settings.json','r+') as f:
                 dict_conf = json.load(f)
                 self.cfg.update({
-                    'openai_url': dict_conf['openai_url'],
-                    'openai_key': dict_conf['openai_key'],
-                    'openai_model': dict_conf['openai_model'],
+                    k: dict_conf[k] for k in ['openai_url', 'openai_key', 'openai_model', 'llm_backends'] if k in dict_conf
                 })
         except Exception as e:
-            pass
+            return
+        for k in RUNTIME_DEFAULTS:
+            if not k.startswith('llm_'):
+                continue
+            if k in dict_conf:
+                self.cfg[k] = dict_conf[k]
+                self.user_keys.add(k)
+            elif k in self.user_keys:  # 从 settings.json 中删除了，恢复默认值
+                self.cfg[k] = copy.deepcopy(RUNTIME_DEFAULTS[k])
+                self.user_keys.discard(k)
     
+    def load_runtime_cfg(self):
+        """ 
+        加载运行参数（超时等），缺省时使用 RUNTIME_DEFAULTS（不写入 settings.json，见 user_cfg）。
+        settings.json 中的其它字段也一并保留，避免 save_cfg 时丢失。
+        """
+        for k, v in RUNTIME_DEFAULTS.items():
+            self.cfg.setdefault(k, copy.deepcopy(v))  # 默认值中的 dict / list 不能被共享修改
+        try:
+            with open('settings.json','r+') as f:
+                dict_conf = json.load(f)
+            for k, v in dict_conf.items():
+                if k in RUNTIME_DEFAULTS:
+                    self.cfg[k] = v
+                    self.user_keys.add(k)
+                else:
+                    self.cfg.setdefault(k, v)
+        except Exception as e:
+            pass
+
     def load_enabled_srv(self):
         try:
             with open('settings.json','r+') as f:
@@ -8,8 +8,12 @@ import multiprocessing as mp
 import threading
 import os
 import json
-from flask import Flask, render_template, jsonify, request, g, Response, stream_with_context
+from flask import Flask, render_template, jsonify, request, g, Response, stream_with_context, send_file, abort
 from local_mcp_manager_core import ProcessManager, load_conf, VERSION, load_config_raw, save_config_raw, get_config_template, load_service_config, save_service_config, delete_service_config
+from local_mcp_manager_resilience import Deadline, ServiceUnavailable
+from local_mcp_manager_gateway import ReplicaSet
+from local_mcp_manager_node import NodeError, RemoteProcess
+import local_mcp_manager_codec as codec
 import webbrowser
 import sys
 import time
@@ -45,6 +49,19 @@ def get_manager():
         g.manager = ProcessManager(services=services)
     return g.manager
 
+def get_request_deadline(data=None, default=None):
+    """
+    从请求中读取截止时间（秒）：请求头 X-Request-Timeout 或 JSON 字段 timeout。
+
+    Build the end-to-end Deadline of the current request.
+    """
+    seconds = request.headers.get('X-Request-Timeout')
+    if seconds is None and isinstance(data, dict):
+        seconds = data.get('timeout')
+    if seconds is None:
+        seconds = default
+    return Deadline(None if seconds is None else float(seconds))
+
 @app.route('/')
 async def index():
     init_manager()
@@ -65,14 +82,12 @@ async def show_mcp_info(service_name):
     :param service_name: Description
     """
     init_manager()
-    service_info = await manager.get_tools_by_name(service_name)
-    dict_info = json.loads(service_info)
+    dict_info = await manager.get_tools_by_name(service_name)
     template_params = {
         'serviceName' : service_name,
-        'service_info' : service_info,
-        'serviceTools' : json.dumps(dict_info['tools']),
-        'servicePrompts' : json.dumps(dict_info['prompts']),
-        'serviceResources' : json.dumps(dict_info['resources']),
+        'serviceTools' : codec.dumps(dict_info['tools']),
+        'servicePrompts' : codec.dumps(dict_info['prompts']),
+        'serviceResources' : codec.dumps(dict_info['resources']),
         'n_tools': len(dict_info['tools']),
         'n_prompts': len(dict_info['prompts']),
         'n_resources': len(dict_info['resources']),
@@ -90,7 +105,7 @@ async def mcp_get_all():
     """
     init_manager()
     service_all = await manager.get_tools_all()
-    return service_all
+    return Response(codec.dumps_bytes(service_all), mimetype='application/json')
 
 @app.route('/api/services/<service_name>/delete', methods=['POST'])
 async def mcp_delete(service_name):
@@ -143,15 +158,12 @@ async def mcp_call_tool(service_name):
         init_manager()
 
         # 调用工具
-        tool_result_json = await manager.call_tool(service_name, tool_name, json.dumps(parameters))
+        deadline = get_request_deadline(data)
+        tool_result = await manager.call_tool(service_name, tool_name, parameters, deadline=deadline)
 
-        # 解析结果
-        tool_result = json.loads(tool_result_json)
-
-        return jsonify({
-            'success': True,
-            'result': tool_result
-        })
+        # 只序列化一次，直接拼接响应体；大的二进制内容已经落盘，结果中只有 blob_ref
+        body = b'{"success":true,"result":' + codec.dumps_bytes(tool_result) + b'}'
+        return Response(body, mimetype='application/json')
 
     except json.JSONDecodeError as e:
         return jsonify({
@@ -159,12 +171,42 @@ async def mcp_call_tool(service_name):
             'error': f'Invalid JSON in parameters: {str(e)}'
         }), 400
 
+    except TimeoutError as e:
+        return jsonify({
+            'success': False,
+            'error': f'Tool call timed out: {str(e)}'
+        }), 504
+
+    except ServiceUnavailable as e:
+        return jsonify({
+            'success': False,
+            'error': f'Service unavailable: {str(e)}'
+        }), 503
+
     except Exception as e:
         return jsonify({
             'success': False,
             'error': f'Tool call failed: {str(e)}'
         }), 500
 
+@app.route('/api/blobs/<blob_id>', methods=['GET'])
+def get_blob(blob_id):
+    """
+    读取落盘的工具结果内容（见 BlobSpool）。
+    内容来自后端工具，一律作为附件下载，不按其类型在管理器的页面中打开（mimeType 见结果中的 blob_ref）。
+
+    Serve a spooled blob of a tool result
+    """
+    init_manager()
+    path = manager.blob_spool.path_of(blob_id)
+    if path is None:
+        abort(404)
+    response = send_file(
+        os.path.abspath(path), mimetype='application/octet-stream', as_attachment=True, download_name=blob_id,
+    )
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
 @app.route('/api/services/<service_name>/ai_chat_stream', methods=['POST'])
 async def mcp_ai_chat_stream(service_name):
     """
@@ -179,7 +221,14 @@ async def mcp_ai_chat_stream(service_name):
                 'error': 'No JSON data provided'
             }), 400
 
+        # 会话模式：只发送新消息 message，历史保存在服务端（session_id 为空时新建会话）
+        # 兼容模式：发送完整历史 messages
+        session_id = None
         lst_msg = data.get('messages')
+        if data.get('message') or 'session_id' in data:
+            session_id = data.get('session_id') or ''
+            message = data.get('message')
+            lst_msg = [message if isinstance(message, dict) else {'role': 'user', 'content': message}] if message else lst_msg
 
         if not lst_msg:
             return jsonify({
@@ -189,6 +238,7 @@ async def mcp_ai_chat_stream(service_name):
 
         # 初始化管理器
         init_manager()
+        deadline = get_request_deadline(data, default=manager.basic_config.cfg.get('chat_timeout'))
 
         # 使用队列在线程间传递数据
         import queue
@@ -197,25 +247,29 @@ async def mcp_ai_chat_stream(service_name):
         # 在线程中运行异步生成器
         async def run_stream():
             try:
-                async for chunk in manager.ai_chat_stream(service_name, lst_msg):
+                async for chunk in manager.ai_chat_stream(service_name, lst_msg, deadline=deadline, session_id=session_id,
+                                                          agent_cfg=data.get('agent')):
                     result_queue.put(chunk)
-                # 发送完成信号
-                result_queue.put(None)
             except Exception as e:
-                error_msg = json.dumps({
+                error_msg = codec.dumps({
                     'type': 'error',
                     'message': f'Stream error: {str(e)}'
-                }, ensure_ascii=False)
+                })
                 result_queue.put(error_msg)
+            finally:
+                # 发送完成信号（被取消时也要发送）
                 result_queue.put(None)
 
-        # 在新线程中运行
-        import threading
+        # 在新线程中运行。loop 和 task 先建好，客户端断开时可以从这里取消
+        loop = asyncio.new_event_loop()
+        stream_task = loop.create_task(run_stream())
+
         def run_in_thread():
-            loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
             try:
-                loop.run_until_complete(run_stream())
+                loop.run_until_complete(stream_task)
+            except asyncio.CancelledError:
+                print(f"[ai_chat_stream] {service_name} cancelled.")
             finally:
                 loop.close()
 
@@ -232,12 +286,17 @@ async def mcp_ai_chat_stream(service_name):
                     # SSE 格式: data: <json>\n\n
                     yield f"data: {chunk}\n\n"
             except GeneratorExit:
-                pass
+                # SSE 客户端断开：取消后台任务，进行中的工具调用会向后端发送取消通知
+                if not stream_task.done():
+                    try:
+                        loop.call_soon_threadsafe(stream_task.cancel)
+                    except RuntimeError:  # loop 已经结束
+                        pass
             except Exception as e:
-                error_msg = json.dumps({
+                error_msg = codec.dumps({
                     'type': 'error',
                     'message': f'Generator error: {str(e)}'
-                }, ensure_ascii=False)
+                })
                 yield f"data: {error_msg}\n\n"
 
         # 返回 SSE 流
@@ -256,6 +315,20 @@ async def mcp_ai_chat_stream(service_name):
             'error': f'AI chat stream failed: {str(e)}'
         }), 500
 
+@app.route('/api/chat/sessions/<session_id>', methods=['DELETE'])
+def delete_chat_session(session_id):
+    """
+    删除服务端会话
+
+    Drop a server-side chat session
+    """
+    init_manager()
+    manager.conversations.drop(session_id)
+    return jsonify({
+        'success': True,
+        'message': f'Session {session_id} deleted.'
+    })
+
 @app.route('/api/config/edit')
 def edit_config():
     """
@@ -414,10 +487,10 @@ def add_service_to_config():
                 'error': f'Service ID "{service_name}" already exists. Please change the service name.'
             }), 400
 
-        # 检查端口冲突
+        # 检查端口冲突（"out_port": null 表示只监听 Unix socket，见 proxy_uds）
         new_port = new_service_config['out_port']
         for existing_service in config_data['mcpServers'].values():
-            if existing_service.get('out_port') == new_port:
+            if new_port is not None and existing_service.get('out_port') == new_port:
                 return jsonify({
                     'success': False,
                     'error': f'Port {new_port} is already in use by another service.'
@@ -536,6 +609,10 @@ async def get_services():
             'is_enabled': svc['is_enabled'],
             'is_alive': svc['is_alive'],
             'mcp_status': svc.get('mcp_status','UNKNOWN'),
+            'guard': manager.get_guard(svc).status(),
+            'replicas': svc['process'].status() if isinstance(svc.get('process'), ReplicaSet) else None,
+            'node': svc['process'].node.name if isinstance(svc.get('process'), RemoteProcess) and svc['process'].node else None,
+            'start_error': svc.get('start_error'),
         })
     
     return jsonify({
@@ -543,6 +620,112 @@ async def get_services():
         'services': services_data
     })
 
+@app.route('/api/services/<service_name>/history', methods=['GET'])
+def get_call_history(service_name):
+    """
+    工具调用记录（最新的在前）
+
+    Recent tool calls of a service
+    """
+    init_manager()
+    if manager.state is None:
+        return jsonify({
+            'success': False,
+            'error': 'State store is off (set state_db in settings.json)'
+        }), 400
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify({
+        'success': True,
+        'calls': manager.state.recent_calls(service_name, limit=limit),
+    })
+
+@app.route('/api/nodes', methods=['GET'])
+def get_nodes():
+    """
+    集群节点的状态：标签、容量、负载与其上运行的服务
+
+    Cluster nodes and the services placed on them
+    """
+    init_manager()
+    manager.basic_config.load_runtime_cfg()
+    lst_nodes = []
+    for name, node in manager.get_nodes().items():
+        try:
+            lst_nodes.append({'name': name, 'url': node.url, 'reachable': True, **node.info(max_age=0)})
+        except NodeError as e:
+            lst_nodes.append({'name': name, 'url': node.url, 'reachable': False, 'error': str(e)})
+    return jsonify({
+        'success': True,
+        'nodes': lst_nodes,
+    })
+
+@app.route('/api/llm/backends', methods=['GET'])
+def get_llm_backends():
+    """
+    LLM 后端池的状态（健康、延迟、并发）
+
+    LLM backend pool status
+    """
+    init_manager()
+    try:
+        return jsonify({
+            'success': True,
+            'pool': manager.get_llm_pool().status(),
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    工具结果缓存的命中统计
+
+    Tool result cache stats
+    """
+    init_manager()
+    return jsonify({
+        'success': True,
+        'stats': manager.tool_cache.get_stats(),
+        'single_flight': manager.single_flight.status(),
+    })
+
+@app.route('/api/cache/clear', methods=['POST'])
+def clear_cache():
+    """
+    清空工具结果缓存
+
+    Clear tool result cache
+    """
+    init_manager()
+    manager.tool_cache.clear()
+    return jsonify({
+        'success': True,
+        'message': 'Tool result cache cleared.'
+    })
+
+@app.route('/api/llm/cache/clear', methods=['POST'])
+def clear_llm_cache():
+    """
+    清空模型响应缓存
+
+    Clear LLM response cache
+    """
+    init_manager()
+    llm_pool = manager.get_llm_pool()
+    if llm_pool.response_cache is None:
+        return jsonify({
+            'success': False,
+            'error': 'LLM response cache is off (set llm_cache in settings.json)'
+        }), 400
+    llm_pool.response_cache.clear()
+    return jsonify({
+        'success': True,
+        'message': 'LLM response cache cleared.'
+    })
+
 @app.route('/api/services/start-all', methods=['POST'])
 async def start_all_services():
     """
@@ -618,12 +801,50 @@ def start_service(service_name):
     
     manager._start_service(service)
     manager.refresh_svc_status()
+    if service.get('start_error'):
+        return jsonify({
+            'success': False,
+            'message': f"Service {service_name} failed to start: {service['start_error']}"
+        }), 502
     
     return jsonify({
         'success': True,
         'message': f'Service {service_name} started.'
     })
 
+@app.route('/api/services/<service_name>/restart', methods=['POST'])
+def restart_service(service_name):
+    """
+    重启单个服务（读取最新配置）。运行在网关后面的服务滚动重启，不中断调用。
+
+    Restart one service, with zero downtime when it runs behind the gateway
+    """
+    init_manager()
+    service = next((svc for svc in manager.services if svc['name'] == service_name), None)
+    if not service:
+        return jsonify({
+            'success': False,
+            'message': f'Service {service_name} does not exist.'
+        }), 404
+    try:
+        mode = manager.restart_service(service)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': f'Restart of {service_name} failed: {e}'
+        }), 500
+    manager.refresh_svc_status()
+    if service.get('start_error'):
+        return jsonify({
+            'success': False,
+            'message': f"Service {service_name} failed to start: {service['start_error']}"
+        }), 502
+    return jsonify({
+        'success': True,
+        'mode': mode,
+        'message': f'Service {service_name} restarted ({mode}).'
+    })
+
 @app.route('/api/services/<service_name>/stop', methods=['POST'])
 def stop_service(service_name):
     """
@@ -779,16 +1000,23 @@ def cleanup():
     """
     global manager
     if manager:
-        print("正在停止所有服务...")
-        manager.stop_all_running_services()
-        
-        while True:
-            n_alive = manager.count_alive()
-            if n_alive > 0:
-                time.sleep(0.5)
-            else:
-                break
-        print("所有服务已停止")
+        if manager.basic_config.cfg.get('keep_services_on_exit'):
+            # 服务继续运行，下次启动时接管
+            print("保留运行中的服务 (keep_services_on_exit)")
+            manager.stop_all_running_services(replicated_only=True)
+        else:
+            print("正在停止所有服务...")
+            manager.stop_all_running_services()
+
+            while True:
+                n_alive = manager.count_alive()
+                if n_alive > 0:
+                    time.sleep(0.5)
+                else:
+                    break
+            print("所有服务已停止")
+        if manager.state is not None:
+            manager.state.close()  # 写完队列中的状态
 
 def delayed_startup():
     """
@@ -835,6 +1063,7 @@ if __name__ == "__main__":
     # startup_thread.start()
     #
     manager = init_manager()
+    manager.adopt_running_services()  # 接管上次运行留下的服务
     manager.start_all_enabled_services()
     #
     try:
@@ -843,4 +1072,7 @@ if __name__ == "__main__":
         cleanup()
     finally:
         cleanup()
+        if manager.basic_config.cfg.get('keep_services_on_exit'):
+            # 不等待子进程退出（multiprocessing 在退出时会 join 非 daemon 子进程）
+            os._exit(0)
         sys.exit(0)
@@ -0,0 +1,525 @@
+"""
+服务副本与网关：一个服务运行多个副本进程，网关在服务的 out_port 上提供唯一的入口，
+把请求分发到各副本（最少在途请求或轮询），同一个 MCP 会话始终发往同一个副本。
+
+Replicated services. A ReplicaSet runs N copies of a service's proxy
+process on internal ports and an HTTP gateway on the service's out_port.
+The gateway balances requests across healthy replicas, keeps each
+Mcp-Session-Id on the replica that created it, health-checks replicas
+and restarts the ones that died.
+"""
+
+import asyncio
+import itertools
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+
+from local_mcp_manager_resilience import ServiceUnavailable
+
+BALANCE_MODES = ['least_outstanding', 'round_robin']
+
+# 不转发的逐跳头
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade',
+               'proxy-authorization', 'proxy-authenticate', 'host', 'content-length'}
+
+
+def free_port(host: str = '127.0.0.1') -> int:
+    """
+    由系统分配一个空闲端口。
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+class Replica:
+    """
+    一个副本：代理进程 + 内部端口 + 在途请求数。
+    """
+    def __init__(self, index: int, port: int, process, host: str = '127.0.0.1'):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.process = process
+        self.outstanding = 0
+        self.healthy = False  # 端口可以连接后由健康检查置为 True
+        self.draining = False  # 不再接收新请求和新会话，在途请求完成后关闭
+        self.standby = False  # 滚动重启中的新副本，切换之前不接收请求
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_restarts = 0
+        self.started_at = time.monotonic()
+        self.checked_at = 0.0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/mcp"
+
+    def is_process_alive(self) -> bool:
+        try:
+            return self.process.is_alive()
+        except Exception:
+            return False
+
+    def status(self) -> dict:
+        return {
+            'index': self.index,
+            'port': self.port,
+            'pid': getattr(self.process, 'pid', None),
+            'alive': self.is_process_alive(),
+            'healthy': self.healthy,
+            'draining': self.draining,
+            'standby': self.standby,
+            'outstanding': self.outstanding,
+            'requests': self.n_requests,
+            'errors': self.n_errors,
+            'restarts': self.n_restarts,
+        }
+
+
+class ReplicaSet:
+    """
+    一个服务的全部副本与网关。对 ProcessManager 而言它就像一个进程：
+    有 start / is_alive / terminate / join / exitcode / pid，放在 svc['process'] 中。
+
+    spawn_fn(port) -> 未启动的进程对象（mp.Process），副本进程监听 127.0.0.1:port。
+    balance: least_outstanding（默认）或 round_robin。
+    health_interval: 秒，健康副本的检查间隔；不健康的副本每 0.5 秒检查一次。
+    session_ttl / max_sessions: 会话表中超过 session_ttl 秒没有请求的会话被删除，条数超过 max_sessions 时
+        删除最久未使用的（大多数客户端不会发送 DELETE）。
+    网关和健康检查运行在后台线程自己的事件循环中，副本表由锁保护，
+    管理器（Flask 各请求各自的事件循环）可以直接调用 acquire / add_replica / remove_replica。
+    """
+    def __init__(self, name: str, spawn_fn, n_replicas: int, host: str, port: int,
+                 balance: str = 'least_outstanding', health_interval: float = 5.0,
+                 session_ttl: float = 3600.0, max_sessions: int = 10000):
+        if balance not in BALANCE_MODES:
+            raise ValueError(f"balance must be one of {BALANCE_MODES}, got '{balance}'")
+        self.name = name
+        self.spawn_fn = spawn_fn
+        self.n_initial = max(1, int(n_replicas))
+        self.host = host
+        self.port = int(port)
+        self.balance = balance
+        self.health_interval = float(health_interval)
+        self.session_ttl = float(session_ttl)
+        self.max_sessions = int(max_sessions)
+        self.replicas = []
+        self.sessions = OrderedDict()  # Mcp-Session-Id -> Replica，按最近使用排序
+        self._session_seen = {}  # Mcp-Session-Id -> 最近一次请求的时间（time.monotonic）
+        self.avg_latency = None  # 秒，请求（不含 GET 事件流）耗时的指数移动平均
+        self.events = deque(maxlen=20)  # 最近的扩缩容与重启记录
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+        self._next_index = 0
+        self._started = False
+        self._stopping = False
+        self.restarting = False  # 滚动重启中，自动扩缩容暂停
+        self._server = None
+        self._thread = None
+
+    # ---------- 进程接口 ----------
+
+    pid = None  # 网关运行在管理器进程内，没有可接管的独立进程
+
+    def start(self):
+        if self._started:
+            raise RuntimeError('a ReplicaSet can only be started once')
+        self._started = True
+        for _ in range(self.n_initial):
+            self.add_replica()
+        self._start_gateway()
+
+    def is_alive(self) -> bool:
+        if self._stopping or self._thread is None or not self._thread.is_alive():
+            return False
+        with self._lock:
+            return any(r.is_process_alive() for r in self.replicas)
+
+    @property
+    def exitcode(self):
+        return None if self.is_alive() else 0
+
+    def terminate(self):
+        self._stopping = True
+        if self._server is not None:
+            self._server.should_exit = True
+        with self._lock:
+            lst_replicas = list(self.replicas)
+        for replica in lst_replicas:
+            try:
+                replica.process.terminate()
+            except Exception:
+                pass
+
+    def join(self, timeout=None):
+        t_end = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            lst_replicas = list(self.replicas)
+        for replica in lst_replicas:
+            try:
+                replica.process.join(timeout=None if t_end is None else max(0.0, t_end - time.monotonic()))
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=None if t_end is None else max(0.0, t_end - time.monotonic()))
+
+    def kill(self):
+        """
+        terminate 之后仍未退出的副本进程（POSIX 下发送 SIGKILL）。
+        """
+        with self._lock:
+            lst_replicas = list(self.replicas)
+        for replica in lst_replicas:
+            if replica.is_process_alive():
+                try:
+                    replica.process.kill()
+                except Exception:
+                    pass
+
+    def __repr__(self):
+        return f"<ReplicaSet {self.name} port={self.port} replicas={len(self.replicas)}>"
+
+    # ---------- 副本 ----------
+
+    def add_replica(self, standby: bool = False) -> Replica:
+        """
+        启动一个新副本。它在健康检查通过后才开始接收请求；standby 的副本要等 swap 之后。
+        """
+        port = free_port()
+        process = self.spawn_fn(port)
+        process.start()
+        with self._lock:
+            replica = Replica(self._next_index, port, process)
+            replica.standby = standby
+            self._next_index += 1
+            self.replicas.append(replica)
+        return replica
+
+    def swap(self, old: Replica, new: Replica):
+        """
+        原子地切换：新副本开始接收请求，旧副本同时进入下线状态（已有会话仍发往旧副本）。
+        """
+        with self._lock:
+            new.standby = False
+            old.draining = True
+
+    def replace_all(self, ready_fn, ready_timeout: float = 60.0, drain_timeout: float = 30.0):
+        """
+        滚动重启（蓝绿切换）：逐个用新副本替换旧副本。阻塞调用。
+
+        每一步：启动 standby 的新副本，等待端口可连接且 ready_fn(replica) 返回 True，
+        然后 swap，再等待旧副本的在途请求完成后关闭它。
+        新副本在 ready_timeout 秒内没有就绪时放弃，旧副本保持不变，抛出 RuntimeError。
+        """
+        self.restarting = True
+        try:
+            with self._lock:
+                lst_old = [r for r in self.replicas if not r.draining and not r.standby]
+            for old in lst_old:
+                new = self.add_replica(standby=True)
+                t_end = time.monotonic() + ready_timeout
+                while not (new.healthy and ready_fn(new)):
+                    if time.monotonic() > t_end or (not new.is_process_alive() and time.monotonic() - new.started_at > 1.0):
+                        self.remove_replica(new, drain_timeout=0)
+                        raise RuntimeError(f"new replica of '{self.name}' did not become ready within {ready_timeout}s")
+                    time.sleep(0.5)
+                self.swap(old, new)
+                self.record_event(f"replica {new.index} replaced replica {old.index}")
+                self.remove_replica(old, drain_timeout)
+        finally:
+            self.restarting = False
+
+    def remove_replica(self, replica: Replica, drain_timeout: float = 30.0):
+        """
+        优雅下线一个副本：不再分配新请求和新会话，等待在途请求完成（最多 drain_timeout 秒）后关闭进程。
+        阻塞调用。
+        """
+        with self._lock:
+            replica.draining = True
+        t_end = time.monotonic() + drain_timeout
+        while replica.outstanding > 0 and time.monotonic() < t_end:
+            time.sleep(0.1)
+        with self._lock:
+            if replica in self.replicas:
+                self.replicas.remove(replica)
+            self._drop_sessions(replica)
+        try:
+            replica.process.terminate()
+            replica.process.join(timeout=3.0)
+            if replica.is_process_alive():
+                replica.process.kill()
+        except Exception:
+            pass
+
+    def pick_for_removal(self) -> Replica:
+        """
+        缩容时下线哪个副本：优先不健康的，其次会话和在途请求最少的。
+        """
+        with self._lock:
+            lst_active = [r for r in self.replicas if not r.draining and not r.standby]
+            if len(lst_active) <= 1:
+                return None
+            dict_sessions = {}
+            for r in self.sessions.values():
+                dict_sessions[r.index] = dict_sessions.get(r.index, 0) + 1
+            return min(lst_active, key=lambda r: (r.healthy, dict_sessions.get(r.index, 0), r.outstanding, -r.index))
+
+    def pick(self, session_id: str = None, lst_exclude=()) -> Replica:
+        """
+        选择副本。带会话时返回会话所在的副本（不可用时返回 None）；
+        否则在健康、未下线的副本中按 balance 选择。没有可用副本时返回 None。
+        """
+        with self._lock:
+            if session_id:
+                replica = self.sessions.get(session_id)
+                if replica is not None:
+                    self._touch_session(session_id)
+                return replica if replica is not None and replica.healthy else None
+            lst_ready = [r for r in self.replicas if r.healthy and not r.draining and not r.standby and r not in lst_exclude]
+            if not lst_ready:
+                return None
+            if self.balance == 'round_robin':
+                return lst_ready[next(self._rr) % len(lst_ready)]
+            return min(lst_ready, key=lambda r: (r.outstanding, r.n_requests))
+
+    # ---------- 会话表（调用时已持有 self._lock） ----------
+
+    def _touch_session(self, session_id: str, replica: Replica = None):
+        """
+        记录会话的一次请求；给出 replica 时新建会话。顺便清理过期和超出上限的会话。
+        """
+        if replica is not None:
+            self.sessions[session_id] = replica
+        self.sessions.move_to_end(session_id)
+        now = time.monotonic()
+        self._session_seen[session_id] = now
+        while self.sessions:
+            oldest = next(iter(self.sessions))
+            if len(self.sessions) <= self.max_sessions and now - self._session_seen[oldest] <= self.session_ttl:
+                break
+            self._pop_session(oldest)
+
+    def _pop_session(self, session_id: str):
+        self.sessions.pop(session_id, None)
+        self._session_seen.pop(session_id, None)
+
+    def _drop_sessions(self, replica: Replica):
+        for session_id in [s for s, r in self.sessions.items() if r is replica]:
+            self._pop_session(session_id)
+
+    def _begin(self, replica: Replica) -> float:
+        with self._lock:
+            replica.outstanding += 1
+            replica.n_requests += 1
+        return time.monotonic()
+
+    def _end(self, replica: Replica, ok: bool = True, t0: float = None):
+        with self._lock:
+            replica.outstanding -= 1
+            if not ok:
+                replica.n_errors += 1
+            if t0 is not None:
+                latency = time.monotonic() - t0
+                self.avg_latency = latency if self.avg_latency is None else self.avg_latency + 0.2 * (latency - self.avg_latency)
+
+    def record_event(self, message: str):
+        self.events.append((round(time.time(), 3), message))
+        print(f"[gateway {self.name}] {message}")
+
+    @contextmanager
+    def acquire(self):
+        """
+        管理器内部调用使用：选择一个副本并计入在途请求数。
+
+        with replica_set.acquire() as replica:
+            ... replica.url ...
+        没有可用副本时抛出 ServiceUnavailable。
+        """
+        replica = self.pick()
+        if replica is None:
+            raise ServiceUnavailable(f"No healthy replica of '{self.name}'")
+        t0 = self._begin(replica)
+        ok = False
+        try:
+            yield replica
+            ok = True
+        finally:
+            self._end(replica, ok, t0)
+
+    def outstanding(self) -> int:
+        with self._lock:
+            return sum(r.outstanding for r in self.replicas)
+
+    def n_active(self) -> int:
+        """
+        未下线的副本数（包括仍在启动中的，不包括滚动重启中 standby 的）。
+        """
+        with self._lock:
+            return sum(1 for r in self.replicas if not r.draining and not r.standby)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'port': self.port,
+                'balance': self.balance,
+                'sessions': len(self.sessions),
+                'avg_latency': None if self.avg_latency is None else round(self.avg_latency, 4),
+                'replicas': [r.status() for r in self.replicas],
+                'events': list(self.events),
+            }
+
+    # ---------- 健康检查 ----------
+
+    async def _check(self, replica: Replica):
+        """
+        进程已退出的副本重新启动（同一端口），其会话作废；其余的检查端口能否连接。
+        standby 的副本退出后不在这里重启，由 replace_all 放弃并移除。
+        """
+        replica.checked_at = time.monotonic()
+        if not replica.is_process_alive():
+            with self._lock:
+                replica.healthy = False
+                self._drop_sessions(replica)
+            if self._stopping or replica.draining or replica.standby:
+                return
+            if time.monotonic() - replica.started_at < 5.0:  # 刚重启过，避免频繁重启
+                return
+            self.record_event(f"replica {replica.index} exited, restarting")
+            try:
+                replica.process = self.spawn_fn(replica.port)
+                replica.process.start()
+            except Exception as e:
+                print(f"[gateway {self.name}] restart of replica {replica.index} failed: {e}")
+            replica.started_at = time.monotonic()
+            replica.n_restarts += 1
+            return
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(replica.host, replica.port), 1.0)
+            writer.close()
+            healthy = True
+        except Exception:
+            healthy = False
+        with self._lock:
+            replica.healthy = healthy
+
+    async def _health_loop(self):
+        while not self._stopping:
+            with self._lock:
+                lst_replicas = list(self.replicas)
+            now = time.monotonic()
+            lst_due = [
+                r for r in lst_replicas
+                if not r.healthy or now - r.checked_at >= self.health_interval
+            ]
+            if lst_due:
+                await asyncio.gather(*[self._check(r) for r in lst_due], return_exceptions=True)
+            await asyncio.sleep(0.5)
+
+    # ---------- 网关 ----------
+
+    def _start_gateway(self):
+        import uvicorn
+        from starlette.applications import Starlette
+        from starlette.routing import Route
+
+        @asynccontextmanager
+        async def lifespan(app):
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(connect=5.0, read=None, write=60.0, pool=60.0),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=64),
+            )
+            health_task = asyncio.ensure_future(self._health_loop())
+            try:
+                yield
+            finally:
+                health_task.cancel()
+                await self._http.aclose()
+
+        methods = ['GET', 'POST', 'DELETE', 'PUT', 'PATCH', 'OPTIONS', 'HEAD']
+        app = Starlette(
+            routes=[Route('/{path:path}', self._forward, methods=methods)],
+            lifespan=lifespan,
+        )
+        config = uvicorn.Config(app, host=self.host, port=self.port, log_level='warning', lifespan='on')
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, name=f'gateway-{self.name}', daemon=True)
+        self._thread.start()
+
+    async def _forward(self, request):
+        from starlette.background import BackgroundTask
+        from starlette.responses import JSONResponse, StreamingResponse
+
+        session_id = request.headers.get('mcp-session-id')
+        body = await request.body()
+        lst_headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_HEADERS]
+        path = request.url.path + (f"?{request.url.query}" if request.url.query else '')
+
+        lst_tried = []
+        while True:
+            replica = self.pick(session_id, lst_tried)
+            if replica is None:
+                if session_id:
+                    # 会话所在的副本已不可用，按 MCP 规范返回 404，客户端会重新 initialize
+                    with self._lock:
+                        self._pop_session(session_id)
+                    return JSONResponse(
+                        {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32001, 'message': 'Session not found'}},
+                        status_code=404,
+                    )
+                return JSONResponse(
+                    {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32000, 'message': f"No healthy replica of '{self.name}'"}},
+                    status_code=503,
+                )
+            t0 = self._begin(replica)
+            upstream_request = self._http.build_request(
+                request.method, replica.base_url + path, headers=lst_headers, content=body,
+            )
+            try:
+                upstream = await self._http.send(upstream_request, stream=True)
+                break
+            except httpx.TransportError:
+                self._end(replica, ok=False)
+                with self._lock:
+                    replica.healthy = False  # 等健康检查恢复
+                if session_id:
+                    continue  # 下一轮返回 404
+                lst_tried.append(replica)  # 新请求换一个副本重试
+
+        new_session_id = upstream.headers.get('mcp-session-id')
+        with self._lock:
+            if new_session_id and not session_id:
+                self._touch_session(new_session_id, replica)
+            if request.method == 'DELETE' and session_id and upstream.status_code < 300:
+                self._pop_session(session_id)
+
+        released = []
+
+        async def release():
+            if not released:
+                released.append(True)
+                await upstream.aclose()
+                self._end(replica, ok=upstream.status_code < 500, t0=t0 if request.method == 'POST' else None)
+
+        async def body_iter():
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                await release()
+
+        lst_response_headers = [(k, v) for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS]
+        response = StreamingResponse(body_iter(), status_code=upstream.status_code, background=BackgroundTask(release))
+        response.raw_headers = [
+            (k.encode('latin-1'), v.encode('latin-1')) for k, v in lst_response_headers
+        ]
+        return response
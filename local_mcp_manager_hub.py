@@ -0,0 +1,259 @@
+"""
+常驻的 MCP 客户端：一个后台事件循环线程，每个服务保持一个已连接的会话，供所有请求共享。
+
+Persistent MCP client sessions. Flask runs every async view in its own
+short-lived event loop, so a client opened in one request cannot be
+reused by the next. ClientHub owns one background event loop; sessions
+live there and requests from any loop submit their calls to it.
+Concurrent calls share one session (MCP multiplexes requests by id).
+
+For remote http/sse services the session talks to the remote url. For
+stdio services the session owns the backend subprocess and talks to it
+over its pipes, without the local HTTP proxy in between.
+"""
+
+import asyncio
+import os
+import string
+import threading
+
+import anyio
+import httpx
+import mcp.client.stdio  # noqa: F401  fastmcp 在连接时才导入；提前在主线程导入，避免 hub 线程导入期间 fork 代理子进程而死锁
+from fastmcp import Client
+from fastmcp.exceptions import ToolError
+
+from local_mcp_manager_resilience import ToolTimeoutError, call_tool_cancellable
+
+
+def expand_env(value):
+    """
+    把字符串中的 ${VAR} / $VAR 替换为环境变量，未定义的保持原样。dict 递归处理。
+    """
+    if isinstance(value, dict):
+        return {k: expand_env(v) for k, v in value.items()}
+    if isinstance(value, str):
+        return string.Template(value).safe_substitute(os.environ)
+    return value
+
+
+# 这些错误说明请求没有发出（连接失败、会话在发送前已关闭），换新会话重试不会让工具执行两次
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, anyio.ClosedResourceError, anyio.BrokenResourceError)
+
+
+def request_not_sent(e: BaseException) -> bool:
+    if isinstance(e, NOT_SENT_ERRORS):
+        return True
+    # fastmcp 在会话已断开时抛出 RuntimeError('Client is not connected ...')
+    return isinstance(e, RuntimeError) and 'not connected' in str(e)
+
+
+def remote_client_conf(svc, extra_headers: dict = None) -> dict:
+    """
+    直接访问远程 http/sse 服务的客户端配置 {"mcp": {...}}。
+
+    请求头：settings.json 的 remote_headers（extra_headers）+ 服务自己的 headers，支持 ${ENV} 变量。
+    """
+    (ms_value,) = svc['conf']['mcpServers'].values()
+    headers = dict(extra_headers or {})
+    headers.update(ms_value.get('headers') or {})
+    dict_remote = {
+        'url': ms_value['url'],
+        'transport': 'sse' if svc.get('in_type') == 'sse' else 'http',
+        'headers': expand_env(headers),
+    }
+    if ms_value.get('auth'):
+        dict_remote['auth'] = expand_env(ms_value['auth'])
+    return {"mcp": dict_remote}
+
+
+def stdio_client_conf(svc) -> dict:
+    """
+    管理器自己启动 stdio 后端时的客户端配置 {"mcpServers": {...}}。
+    与代理子进程一样在服务的 cwd 中运行（配置中的 cwd 优先）。
+    """
+    dict_servers = {}
+    for name, ms_value in svc['conf']['mcpServers'].items():
+        ms_value = dict(ms_value)
+        if not ms_value.get('cwd') and svc.get('cwd'):
+            ms_value['cwd'] = svc['cwd']
+        dict_servers[name] = ms_value
+    return {"mcpServers": dict_servers}
+
+
+class PassthroughProcess:
+    """
+    直连模式的服务没有本地子进程。对 ProcessManager 而言它就像一个进程，放在 svc['process'] 中：
+    start 之后“运行中”，terminate 之后停止，并关闭 hub 中的会话。
+
+    client_conf: 给出时 start 在后台先建立会话（stdio 服务即启动后端），第一次调用不用等待连接。
+    """
+    pid = None
+
+    def __init__(self, hub, svc_name: str, client_conf: dict = None):
+        self.hub = hub
+        self.svc_name = svc_name
+        self.client_conf = client_conf
+        self._started = False
+        self._stopped = False
+
+    def start(self):
+        if self._started:
+            raise RuntimeError('a PassthroughProcess can only be started once')
+        self._started = True
+        if self.client_conf is not None:
+            self.hub.warm(self.svc_name, self.client_conf)
+
+    def is_alive(self) -> bool:
+        return self._started and not self._stopped
+
+    @property
+    def exitcode(self):
+        return None if self.is_alive() else 0
+
+    def terminate(self):
+        self._stopped = True
+        self.hub.close(self.svc_name)
+
+    def join(self, timeout=None):
+        pass
+
+    def kill(self):
+        pass
+
+    def __repr__(self):
+        return f"<PassthroughProcess {self.svc_name}>"
+
+
+class ClientHub:
+    """
+    key（一般是服务名）-> 已连接的 fastmcp Client。
+
+    client_conf 变化时（例如配置修改）重新连接；调用因连接问题失败时丢弃会话，下次重新连接。
+    复用的旧会话失败、且能确定请求没有发出时（见 request_not_sent），用新会话重试一次；
+    其它错误下请求可能已经送达，不重试，直接抛出。
+    """
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._clients = {}  # key -> (client_conf, Client)
+        self._connecting = {}  # key -> asyncio.Lock（hub 循环内）
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name='client-hub', daemon=True)
+                self._thread.start()
+                self._loop = loop
+        return self._loop
+
+    async def run(self, coro):
+        """
+        在 hub 的循环中运行 coro，在调用方的循环中等待结果。调用方被取消时 hub 中的任务也被取消。
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    # ---------- 以下在 hub 循环中运行 ----------
+
+    async def _get_client(self, key, client_conf):
+        """
+        返回 (client, reused)。
+        """
+        lock = self._connecting.setdefault(key, asyncio.Lock())
+        async with lock:
+            cached = self._clients.get(key)
+            if cached is not None and cached[0] == client_conf and cached[1].is_connected():
+                return cached[1], True
+            if cached is not None:
+                await self._close_client(key)
+            client = Client(client_conf)
+            await client.__aenter__()
+            self._clients[key] = (client_conf, client)
+            return client, False
+
+    async def _close_client(self, key, client=None):
+        cached = self._clients.get(key)
+        if cached is None or (client is not None and cached[1] is not client):
+            return  # 已经被其它调用换成了新会话
+        del self._clients[key]
+        client = cached[1]
+        try:
+            await client.close()
+            # {"mcpServers": ...} 配置的 transport 不会关闭内部的 stdio transport，stdio 后端要单独结束
+            inner = getattr(client.transport, 'transport', None)
+            if inner is not None:
+                await inner.close()
+        except Exception:
+            pass
+
+    async def _call(self, key, client_conf, fn):
+        client, reused = await self._get_client(key, client_conf)
+        try:
+            return await fn(client)
+        except (ToolError, asyncio.CancelledError):
+            raise
+        except ToolTimeoutError:
+            # 工具可能已经执行，不重试；但会话可能已失效（远程重启后请求得不到响应），下次重新连接
+            if reused:
+                await self._close_client(key, client)
+            raise
+        except Exception as e:
+            await self._close_client(key, client)
+            if not reused or not request_not_sent(e):
+                raise
+        # 旧会话失效、请求没有发出：新会话重试一次
+        client, _ = await self._get_client(key, client_conf)
+        try:
+            return await fn(client)
+        except (ToolError, ToolTimeoutError, asyncio.CancelledError):
+            raise
+        except Exception:
+            await self._close_client(key, client)
+            raise
+
+    # ---------- 对外接口（任意事件循环） ----------
+
+    async def call_tool(self, key, client_conf, tool_name: str, arguments: dict, timeout=None):
+        return await self.run(self._call(
+            key, client_conf, lambda client: call_tool_cancellable(client, tool_name, arguments, timeout),
+        ))
+
+    async def with_client(self, key, client_conf, fn):
+        """
+        在 hub 中用会话执行 fn(client)（协程函数），例如读取工具目录。
+        """
+        return await self.run(self._call(key, client_conf, fn))
+
+    def warm(self, key, client_conf):
+        """
+        在后台建立会话，不等待结果（同步，可在任意线程调用）。连接失败时第一次调用会重新连接并报告错误。
+        """
+        async def connect():
+            try:
+                await self._get_client(key, client_conf)
+            except Exception as e:
+                print(f"[client-hub] {key}: connect failed: {type(e).__name__}: {e}")
+
+        asyncio.run_coroutine_threadsafe(connect(), self._ensure_loop())
+
+    def close(self, key):
+        """
+        关闭一个会话（同步，可在任意线程调用）。
+        """
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close_client(key), self._loop)
+        try:
+            future.result(timeout=5)
+        except Exception:
+            pass
+
+    def close_all(self):
+        for key in list(self._clients):
+            self.close(key)
+
+    def status(self) -> dict:
+        return {key: {'connected': client.is_connected()} for key, (_, client) in list(self._clients.items())}
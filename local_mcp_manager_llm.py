@@ -0,0 +1,407 @@
+"""
+LLM 后端池：多个 OpenAI 兼容端点之间的负载均衡与故障切换。
+
+Pool of OpenAI-compatible LLM backends with weights, per-backend
+concurrency limits, passive health tracking, latency-aware routing and
+failover on errors and 429s. Clients are created once per backend and
+reused across requests.
+"""
+
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+import openai
+from openai import OpenAI
+
+import local_mcp_manager_codec as codec
+
+
+class NoBackendAvailable(Exception):
+    """
+    没有可用的后端（未配置、全部冷却中或并发已满且等待超时）。
+
+    No LLM backend could take the request.
+    """
+
+
+def is_failover_error(e: Exception) -> bool:
+    """
+    连接失败、超时、429 和 5xx 换一个后端重试；其它错误（如 400）是请求本身的问题，直接抛出。
+    """
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError)):  # APITimeoutError 是 APIConnectionError 的子类
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code >= 500
+    return False
+
+
+class LLMCacheMiss(Exception):
+    """
+    replay 模式下缓存中没有这个请求（与 NoBackendAvailable 无关，后端可能都可用）。
+
+    The request is not in the response cache and the cache is in replay mode.
+    """
+
+
+class LLMResponseCache:
+    """
+    模型响应的本地缓存（SQLite，响应 JSON 经 zlib 压缩），键为 模型 + 消息 + 工具 + 其它参数 的哈希。
+
+    mode:
+        on      先查缓存，未命中时请求模型并写入缓存
+        record  总是请求模型，并写入（覆盖）缓存
+        replay  只读缓存，未命中时报错，不访问模型（离线运行、测试）
+    超过 max_entries 条或 max_bytes 字节时，删除最久未使用的条目；ttl 秒后过期（0 表示不过期）。
+    """
+    MODES = ['on', 'record', 'replay']
+
+    def __init__(self, path='llm_cache.sqlite3', mode='on', max_entries=10000, max_bytes=256 * 1024 * 1024, ttl=0):
+        if mode not in self.MODES:
+            raise ValueError(f"llm_cache must be one of off / {' / '.join(self.MODES)}, got {mode!r}")
+        self.path = str(path)
+        self.mode = mode
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl or 0)
+        self.n_hits = 0
+        self.n_misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' key TEXT PRIMARY KEY, model TEXT, created_at REAL, last_used REAL,'
+            ' hits INTEGER DEFAULT 0, size INTEGER, body BLOB)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)')
+
+    @staticmethod
+    def make_key(model: str, messages: list, tools: list = None, **kwargs) -> str:
+        str_req = json.dumps(
+            {'model': model, 'messages': messages, 'tools': tools or [], 'kwargs': kwargs},
+            sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str,
+        )  # 需要键排序，这里用标准库
+        return hashlib.sha256(str_req.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """
+        命中返回响应 dict，否则返回 None。record 模式不读缓存。
+        """
+        return self.get_any([key])
+
+    def get_any(self, lst_keys: list):
+        """
+        依次查找多个键，返回第一个命中的响应 dict；命中或未命中都只计一次。
+        """
+        if self.mode == 'record':
+            return None
+        now = time.time()
+        with self._lock:
+            for key in lst_keys:
+                row = self._conn.execute('SELECT created_at, body FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None and self.ttl and now - row[0] > self.ttl:
+                    self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    row = None
+                if row is not None:
+                    self.n_hits += 1
+                    self._conn.execute('UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?', (now, key))
+                    return codec.loads(zlib.decompress(row[1]))
+            self.n_misses += 1
+        return None
+
+    def put(self, key: str, model: str, dict_response: dict):
+        if self.mode == 'replay':
+            return
+        body = zlib.compress(codec.dumps_bytes(dict_response))
+        if len(body) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, created_at, last_used, hits, size, body)'
+                ' VALUES (?, ?, ?, ?, 0, ?, ?)',
+                (key, model, now, now, len(body), body),
+            )
+            self._evict()
+
+    def _evict(self):
+        n_entries, n_bytes = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        while n_entries > self.max_entries or n_bytes > self.max_bytes:
+            # 每次删掉最久未使用的 10%
+            n_delete = max(1, n_entries // 10, n_entries - self.max_entries)
+            self._conn.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)', (n_delete,)
+            )
+            n_entries, n_bytes = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM responses')
+            self._conn.execute('VACUUM')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def status(self) -> dict:
+        with self._lock:
+            n_entries, n_bytes = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        n_lookups = self.n_hits + self.n_misses
+        return {
+            'mode': self.mode,
+            'path': self.path,
+            'entries': n_entries,
+            'bytes': n_bytes,
+            'hits': self.n_hits,
+            'misses': self.n_misses,
+            'hit_rate': round(self.n_hits / n_lookups, 4) if n_lookups else None,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class LLMBackend:
+    """
+    一个 OpenAI 兼容端点。
+
+    name / url / key / model: 端点信息；weight: 权重；max_concurrency: 同时进行的请求数上限。
+    """
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, url: str, key: str, model: str, name: str = None, weight: float = 1.0,
+                 max_concurrency: int = 8):
+        self.name = name or url
+        self.url = url
+        self.model = model
+        self.weight = max(float(weight), 0.001)
+        self.max_concurrency = int(max_concurrency)
+        # 故障切换由 LLMPool 负责，客户端自身不重试
+        self.client = OpenAI(api_key=key, base_url=url, max_retries=0)
+        self.in_flight = 0
+        self.latency = None  # 成功请求耗时的指数移动平均（秒）
+        self.n_ok = 0
+        self.n_failed = 0
+        self.n_rate_limited = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.last_error = None
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until and self.in_flight < self.max_concurrency
+
+    def cost(self) -> float:
+        """
+        路由代价：预计耗时 × (排队数 + 1) / 权重，越小越好。
+        """
+        latency = self.latency if self.latency is not None else 1.0
+        return latency * (self.in_flight + 1) / self.weight
+
+    def status(self) -> dict:
+        return {
+            'name': self.name,
+            'url': self.url,
+            'model': self.model,
+            'weight': self.weight,
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'latency': None if self.latency is None else round(self.latency, 4),
+            'ok': self.n_ok,
+            'failed': self.n_failed,
+            'rate_limited': self.n_rate_limited,
+            'healthy': time.monotonic() >= self.cooldown_until,
+            'cooldown_remaining': round(max(0.0, self.cooldown_until - time.monotonic()), 1),
+            'last_error': self.last_error,
+        }
+
+
+class LLMPool:
+    """
+    后端选择：在可用的后端中按权重随机取两个，选路由代价较小的一个（power of two choices）。
+    请求失败（连接错误、超时、429、5xx）时换一个没试过的后端，直到成功、
+    试满 max_attempts 次或超时。连续失败 failure_threshold 次、或收到 429 的后端冷却 cooldown 秒。
+
+    请求是同步的（OpenAI 客户端），在异步代码中用 asyncio.to_thread 调用 complete。
+    """
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, lst_backends: list, cooldown=30.0, failure_threshold=3, max_attempts=3, queue_timeout=30.0,
+                 response_cache: LLMResponseCache = None):
+        self.backends = lst_backends
+        self.response_cache = response_cache
+        self.cooldown = float(cooldown)
+        self.failure_threshold = int(failure_threshold)
+        self.max_attempts = int(max_attempts)
+        self.queue_timeout = float(queue_timeout)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_cfg(cls, cfg: dict):
+        """
+        由 settings.json 构造。配置了 llm_backends 时使用它；
+        否则使用 openai_url / openai_key / openai_model 这一个端点。
+        """
+        lst_cfg = cfg.get('llm_backends') or []
+        if not lst_cfg and cfg.get('openai_url') and cfg.get('openai_model'):
+            lst_cfg = [{'name': 'default', 'url': cfg['openai_url'], 'key': cfg.get('openai_key'), 'model': cfg['openai_model']}]
+        lst_backends = [
+            LLMBackend(
+                url=b['url'],
+                key=b.get('key') or 'none',
+                model=b['model'],
+                name=b.get('name'),
+                weight=b.get('weight', 1.0),
+                max_concurrency=b.get('max_concurrency', 8),
+            )
+            for b in lst_cfg if b.get('enabled', True)
+        ]
+        response_cache = None
+        if cfg.get('llm_cache', 'off') not in [None, False, 'off']:
+            response_cache = LLMResponseCache(
+                path=cfg.get('llm_cache_path', 'llm_cache.sqlite3'),
+                mode=cfg['llm_cache'],
+                max_entries=cfg.get('llm_cache_max_entries', 10000),
+                max_bytes=cfg.get('llm_cache_max_bytes', 256 * 1024 * 1024),
+                ttl=cfg.get('llm_cache_ttl', 0),
+            )
+        return cls(
+            lst_backends,
+            cooldown=cfg.get('llm_cooldown', 30),
+            failure_threshold=cfg.get('llm_failure_threshold', 3),
+            max_attempts=cfg.get('llm_max_attempts', 3),
+            queue_timeout=cfg.get('llm_queue_timeout', 30),
+            response_cache=response_cache,
+        )
+
+    @property
+    def model(self):
+        """
+        第一个后端的模型名，仅用于显示。
+        """
+        return self.backends[0].model if self.backends else None
+
+    def _pick(self, set_tried: set):
+        """
+        选一个后端并占用一个并发名额；没有可用的返回 None。
+        """
+        with self._lock:
+            now = time.monotonic()
+            lst_candidates = [b for b in self.backends if b not in set_tried and b.available(now)]
+            if not lst_candidates:
+                return None
+            if len(lst_candidates) == 1:
+                backend = lst_candidates[0]
+            else:
+                a, b = random.choices(lst_candidates, weights=[c.weight for c in lst_candidates], k=2)
+                backend = a if a.cost() <= b.cost() else b
+            backend.in_flight += 1
+            return backend
+
+    def _record(self, backend: LLMBackend, latency: float, error: Exception = None):
+        with self._lock:
+            backend.in_flight -= 1
+            if error is None:
+                backend.n_ok += 1
+                backend.consecutive_failures = 0
+                if backend.latency is None:
+                    backend.latency = latency
+                else:
+                    backend.latency += backend.EWMA_ALPHA * (latency - backend.latency)
+                return
+            backend.n_failed += 1
+            backend.consecutive_failures += 1
+            backend.last_error = f"{type(error).__name__}: {error}"[:500]
+            if isinstance(error, openai.RateLimitError):
+                backend.n_rate_limited += 1
+                retry_after = None
+                try:
+                    retry_after = float(error.response.headers.get('retry-after'))
+                except (TypeError, ValueError, AttributeError):
+                    pass
+                backend.cooldown_until = time.monotonic() + (retry_after or self.cooldown)
+            elif backend.consecutive_failures >= self.failure_threshold:
+                backend.cooldown_until = time.monotonic() + self.cooldown
+
+    def complete(self, messages: list, tools: list = None, timeout: float = None, **kwargs) -> dict:
+        """
+        发送一次 chat.completions 请求，返回 response 的 dict，并附上 'backend' 字段（实际使用的后端名，
+        来自缓存时为 'cache'）。
+
+        缓存键中的模型是实际应答的后端的模型；查找时依次尝试池中各后端的模型，
+        增减后端不影响其它模型的缓存，不同模型的响应也不会互相替代。
+        """
+        cache = self.response_cache
+        if cache is None:
+            return self._complete_backends(messages, tools, timeout, **kwargs)
+        lst_models = list(dict.fromkeys(b.model for b in self.backends))
+        dict_response = cache.get_any([cache.make_key(model, messages, tools, **kwargs) for model in lst_models])
+        if dict_response is not None:
+            dict_response['backend'] = 'cache'
+            return dict_response
+        if cache.mode == 'replay':
+            raise LLMCacheMiss('LLM response not in cache (llm_cache is "replay")')
+        dict_response, model = self._complete_backends(messages, tools, timeout, with_model=True, **kwargs)
+        cache.put(cache.make_key(model, messages, tools, **kwargs), model, dict_response)
+        return dict_response
+
+    def _complete_backends(self, messages: list, tools: list = None, timeout: float = None, with_model: bool = False,
+                           **kwargs):
+        """
+        依次尝试后端，返回 response 的 dict；with_model=True 时返回 (dict, 应答后端的模型名)。
+        """
+        if not self.backends:
+            raise NoBackendAvailable('No LLM backend configured (set openai_url / llm_backends in settings.json)')
+        t_end = None if timeout is None else time.monotonic() + float(timeout)
+        t_queue_end = time.monotonic() + (self.queue_timeout if timeout is None else min(self.queue_timeout, float(timeout)))
+        set_tried = set()
+        last_error = None
+        while len(set_tried) < min(self.max_attempts, len(self.backends)):
+            backend = self._pick(set_tried)
+            if backend is None:
+                if time.monotonic() >= t_queue_end or all(
+                    b in set_tried or b.cooldown_until > time.monotonic() for b in self.backends
+                ):
+                    break  # 剩下的后端都在冷却中，或等待并发名额超时
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            set_tried.add(backend)
+            if tools:
+                kwargs['tools'] = tools
+            t0 = time.monotonic()
+            try:
+                response = backend.client.chat.completions.create(
+                    model=backend.model,
+                    messages=messages,
+                    timeout=None if t_end is None else max(0.1, t_end - t0),
+                    **kwargs,
+                )
+            except Exception as e:
+                self._record(backend, time.monotonic() - t0, e)
+                if not is_failover_error(e):
+                    raise
+                print(f"[LLMPool] backend {backend.name} failed, trying another: {e}")
+                last_error = e
+                if t_end is not None and time.monotonic() >= t_end:
+                    break
+                continue
+            self._record(backend, time.monotonic() - t0)
+            dict_response = response.model_dump()
+            dict_response['backend'] = backend.name
+            return (dict_response, backend.model) if with_model else dict_response
+        if last_error is not None:
+            raise last_error
+        raise NoBackendAvailable('All LLM backends are cooling down or busy')
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'backends': [b.status() for b in self.backends],
+                'cooldown': self.cooldown,
+                'failure_threshold': self.failure_threshold,
+                'max_attempts': self.max_attempts,
+                'cache': None if self.response_cache is None else self.response_cache.status(),
+            }
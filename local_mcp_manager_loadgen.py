@@ -0,0 +1,416 @@
+"""
+压测工具：按给定的请求组合，以固定速率或固定并发访问管理器的 HTTP API 与各服务的 MCP 端口，
+报告延迟分位数、错误率，以及管理器进程的 CPU / 内存随时间的变化。
+
+Load generator for the manager HTTP API and the proxied MCP endpoints.
+
+用法 (usage):
+    python local_mcp_manager_loadgen.py --url http://127.0.0.1:17000 \\
+        --mix "call_tool:time:get_current_time=70,services=20,all=5,mcp:18101:echo=5" \\
+        --params '{"get_current_time": {"timezone": "UTC"}, "echo": {"text": "hi"}}' \\
+        --rate 50 --duration 60 --pid 12345 --out load.json
+
+请求组合 (--mix) 中的每一项为 "操作=权重"，操作可以是：
+    call_tool:<服务名>:<工具名>   POST /api/services/<服务名>/call_tool
+    services                      GET /api/services
+    all                           GET /api/all
+    mcp:<端口>:<工具名>           直接调用 http://<mcp-host>:<端口>/mcp 上的工具（每个并发保持一个会话）
+--rate 为每秒发出的请求数（开环）；不给 --rate 时按 --concurrency 个并发循环发送（闭环）。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# ========== 统计 ==========
+
+def percentiles(lst_seconds: list) -> dict:
+    if not lst_seconds:
+        return {'n': 0}
+    lst_ms = sorted(s * 1000 for s in lst_seconds)
+
+    def pct(p):
+        return round(lst_ms[min(len(lst_ms) - 1, int(round(p / 100 * (len(lst_ms) - 1))))], 2)
+
+    return {
+        'n': len(lst_ms),
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p99_ms': pct(99),
+        'max_ms': round(lst_ms[-1], 2),
+    }
+
+
+class OpStats:
+    def __init__(self):
+        self.lst_latency = []
+        self.n_errors = 0
+        self.dict_errors = {}  # 错误信息 -> 次数（只保留前 20 种）
+
+    def add(self, latency: float, error: str = None):
+        self.lst_latency.append(latency)
+        if error is not None:
+            self.n_errors += 1
+            if error in self.dict_errors or len(self.dict_errors) < 20:
+                self.dict_errors[error] = self.dict_errors.get(error, 0) + 1
+
+    def report(self) -> dict:
+        n = len(self.lst_latency)
+        return {
+            **percentiles(self.lst_latency),
+            'errors': self.n_errors,
+            'error_rate': round(self.n_errors / n, 4) if n else None,
+            'top_errors': dict(sorted(self.dict_errors.items(), key=lambda kv: -kv[1])[:5]),
+        }
+
+
+# ========== 进程资源采样 ==========
+
+class ProcessSampler:
+    """
+    采样进程（及其子进程）的 CPU 使用率与 RSS。优先使用 psutil，否则读取 Linux 的 /proc。
+    """
+    def __init__(self, pid: int, include_children: bool = False):
+        self.pid = int(pid)
+        self.include_children = include_children
+        self._last = None  # (时间, CPU 秒)
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self._clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def _pids(self) -> list:
+        if not self.include_children:
+            return [self.pid]
+        if psutil is not None:
+            proc = psutil.Process(self.pid)
+            return [self.pid] + [c.pid for c in proc.children(recursive=True)]
+        lst_pids, lst_todo = [], [self.pid]
+        while lst_todo:
+            pid = lst_todo.pop()
+            lst_pids.append(pid)
+            try:
+                for tid in os.listdir(f'/proc/{pid}/task'):
+                    with open(f'/proc/{pid}/task/{tid}/children') as f:
+                        lst_todo += [int(c) for c in f.read().split()]
+            except OSError:
+                pass
+        return lst_pids
+
+    def _read(self, pid: int):
+        """
+        返回 (CPU 秒, RSS 字节)。
+        """
+        if psutil is not None:
+            proc = psutil.Process(pid)
+            cpu = proc.cpu_times()
+            return cpu.user + cpu.system, proc.memory_info().rss
+        with open(f'/proc/{pid}/stat') as f:
+            lst_fields = f.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(lst_fields[11]) + int(lst_fields[12])) / self._clock_ticks  # utime + stime
+        with open(f'/proc/{pid}/statm') as f:
+            rss = int(f.read().split()[1]) * self._page_size
+        return cpu_seconds, rss
+
+    def sample(self):
+        """
+        返回 {'cpu_percent', 'rss_mb', 'n_processes'}；进程不存在时返回 None。
+        """
+        cpu_total, rss_total, n = 0.0, 0, 0
+        try:
+            lst_pids = self._pids()
+        except Exception:
+            return None
+        for pid in lst_pids:
+            try:
+                cpu, rss = self._read(pid)
+            except Exception:
+                continue
+            cpu_total += cpu
+            rss_total += rss
+            n += 1
+        if n == 0:
+            return None
+        now = time.monotonic()
+        cpu_percent = None
+        if self._last is not None and now > self._last[0]:
+            cpu_percent = round(100 * (cpu_total - self._last[1]) / (now - self._last[0]), 1)
+        self._last = (now, cpu_total)
+        return {'cpu_percent': cpu_percent, 'rss_mb': round(rss_total / 1024 / 1024, 1), 'n_processes': n}
+
+
+# ========== 操作 ==========
+
+def parse_mix(str_mix: str) -> list:
+    """
+    "call_tool:svc:tool=70,services=20" -> [(op, weight), ...]
+    """
+    lst_ops = []
+    for item in str_mix.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        op, _, weight = item.rpartition('=') if '=' in item else (item, '', '1')
+        kind = op.split(':')[0]
+        if kind not in ['call_tool', 'services', 'all', 'mcp']:
+            raise ValueError(f"Unknown operation '{op}'")
+        if kind in ['call_tool', 'mcp'] and len(op.split(':')) != 3:
+            raise ValueError(f"'{op}' must look like {kind}:<{'service' if kind == 'call_tool' else 'port'}>:<tool>")
+        lst_ops.append((op, float(weight)))
+    if not lst_ops:
+        raise ValueError('Empty --mix')
+    return lst_ops
+
+
+class Worker:
+    """
+    每个并发一个：一个 HTTP 连接池共享，MCP 会话按端口各保持一个。
+    """
+    def __init__(self, gen):
+        self.gen = gen
+        self.mcp_clients = {}  # port -> fastmcp Client（已连接）
+
+    async def mcp_client(self, port: str):
+        client = self.mcp_clients.get(port)
+        if client is None:
+            from fastmcp import Client
+            client = Client({'mcp': {'url': f'http://{self.gen.mcp_host}:{port}/mcp'}})
+            await client.__aenter__()
+            self.mcp_clients[port] = client
+        return client
+
+    async def close(self):
+        for client in self.mcp_clients.values():
+            try:
+                await client.__aexit__(None, None, None)
+            except Exception:
+                pass
+
+    async def run_op(self, op: str):
+        gen = self.gen
+        lst_parts = op.split(':')
+        kind = lst_parts[0]
+        error = None
+        t0 = time.monotonic()
+        try:
+            if kind == 'call_tool':
+                svc_name, tool_name = lst_parts[1], lst_parts[2]
+                response = await gen.http.post(
+                    f'{gen.url}/api/services/{svc_name}/call_tool',
+                    json={'tool_name': tool_name, 'parameters': gen.params.get(tool_name, {})},
+                )
+                if response.status_code != 200:
+                    error = f'HTTP {response.status_code}'
+                elif not response.json().get('success'):
+                    error = str(response.json().get('error'))[:200]
+            elif kind in ['services', 'all']:
+                response = await gen.http.get(f'{gen.url}/api/{kind}')
+                if response.status_code != 200:
+                    error = f'HTTP {response.status_code}'
+            elif kind == 'mcp':
+                port, tool_name = lst_parts[1], lst_parts[2]
+                client = await self.mcp_client(port)
+                await client.call_tool(tool_name, gen.params.get(tool_name, {}))
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'[:200]
+            if kind == 'mcp':  # 会话可能已经坏了，下次重新连接
+                client = self.mcp_clients.pop(lst_parts[1], None)
+                if client is not None:
+                    try:
+                        await client.__aexit__(None, None, None)
+                    except Exception:
+                        pass
+        gen.record(op, time.monotonic() - t0, error)
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.url = args.url.rstrip('/')
+        self.mcp_host = args.mcp_host
+        self.lst_ops = parse_mix(args.mix)
+        self.params = json.loads(args.params) if args.params else {}
+        self.rate = args.rate
+        self.concurrency = args.concurrency
+        self.duration = args.duration
+        self.interval = args.interval
+        self.max_in_flight = args.max_in_flight
+        self.sampler = ProcessSampler(args.pid, args.include_children) if args.pid else None
+        self.stats = {op: OpStats() for op, _ in self.lst_ops}
+        self.lst_timeline = []
+        self._window = {'n': 0, 'errors': 0, 'latency': []}
+        self.n_in_flight = 0
+        self.n_dropped = 0  # 开环模式下因在途请求过多而未发出的请求
+        self.http = None
+
+    def pick_op(self) -> str:
+        return random.choices([op for op, _ in self.lst_ops], weights=[w for _, w in self.lst_ops])[0]
+
+    def record(self, op: str, latency: float, error: str = None):
+        self.stats[op].add(latency, error)
+        self._window['n'] += 1
+        self._window['latency'].append(latency)
+        if error is not None:
+            self._window['errors'] += 1
+
+    async def _monitor(self, t_start: float):
+        """
+        每 interval 秒记录一次吞吐、错误、延迟与管理器资源占用，并打印一行。
+        """
+        if self.sampler is not None:
+            self.sampler.sample()  # CPU 使用率需要两次采样
+        while True:
+            await asyncio.sleep(self.interval)
+            window, self._window = self._window, {'n': 0, 'errors': 0, 'latency': []}
+            dict_point = {
+                't': round(time.monotonic() - t_start, 1),
+                'rps': round(window['n'] / self.interval, 1),
+                'errors': window['errors'],
+                'in_flight': self.n_in_flight,
+                **{k: v for k, v in percentiles(window['latency']).items() if k in ['p50_ms', 'p99_ms']},
+            }
+            if self.sampler is not None:
+                dict_point['manager'] = self.sampler.sample()
+            self.lst_timeline.append(dict_point)
+            print(json.dumps(dict_point, ensure_ascii=False), flush=True)
+
+    async def _closed_loop(self, t_end: float):
+        async def loop():
+            worker = Worker(self)
+            try:
+                while time.monotonic() < t_end:
+                    self.n_in_flight += 1
+                    try:
+                        await worker.run_op(self.pick_op())
+                    finally:
+                        self.n_in_flight -= 1
+            finally:
+                await worker.close()
+        await asyncio.gather(*[loop() for _ in range(self.concurrency)])
+
+    async def _open_loop(self, t_end: float):
+        # 空闲的 Worker 复用，保持 MCP 会话
+        lst_idle = []
+        lst_workers = []
+        set_tasks = set()
+
+        async def fire(op):
+            worker = lst_idle.pop() if lst_idle else Worker(self)
+            if worker not in lst_workers:
+                lst_workers.append(worker)
+            self.n_in_flight += 1
+            try:
+                await worker.run_op(op)
+            finally:
+                self.n_in_flight -= 1
+                lst_idle.append(worker)
+
+        t_next = time.monotonic()
+        while t_next < t_end:
+            delay = t_next - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.n_in_flight >= self.max_in_flight:
+                self.n_dropped += 1
+            else:
+                task = asyncio.ensure_future(fire(self.pick_op()))
+                set_tasks.add(task)
+                task.add_done_callback(set_tasks.discard)
+            t_next += 1.0 / self.rate
+        if set_tasks:
+            await asyncio.gather(*set_tasks, return_exceptions=True)
+        for worker in lst_workers:
+            await worker.close()
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(max_connections=max(self.concurrency, 100), max_keepalive_connections=max(self.concurrency, 100))
+        async with httpx.AsyncClient(timeout=120, limits=limits) as http:
+            self.http = http
+            t_start = time.monotonic()
+            t_end = t_start + self.duration
+            monitor = asyncio.ensure_future(self._monitor(t_start))
+            try:
+                if self.rate:
+                    await self._open_loop(t_end)
+                else:
+                    await self._closed_loop(t_end)
+            finally:
+                monitor.cancel()
+            elapsed = time.monotonic() - t_start
+
+        n_total = sum(len(s.lst_latency) for s in self.stats.values())
+        n_errors = sum(s.n_errors for s in self.stats.values())
+        lst_manager = [p['manager'] for p in self.lst_timeline if p.get('manager')]
+        return {
+            'url': self.url,
+            'mode': 'rate' if self.rate else 'concurrency',
+            'target_rate': self.rate,
+            'concurrency': None if self.rate else self.concurrency,
+            'duration_s': round(elapsed, 2),
+            'requests': n_total,
+            'throughput_rps': round(n_total / elapsed, 2) if elapsed else None,
+            'errors': n_errors,
+            'error_rate': round(n_errors / n_total, 4) if n_total else None,
+            'dropped': self.n_dropped,
+            'operations': {op: s.report() for op, s in self.stats.items()},
+            'manager_peak': {
+                'cpu_percent': max((m['cpu_percent'] or 0 for m in lst_manager), default=None),
+                'rss_mb': max((m['rss_mb'] for m in lst_manager), default=None),
+            } if lst_manager else None,
+            'timeline': self.lst_timeline,
+        }
+
+
+def print_report(dict_report: dict):
+    print()
+    print(f"requests={dict_report['requests']}  throughput={dict_report['throughput_rps']}/s  "
+          f"errors={dict_report['errors']} ({dict_report['error_rate']})  dropped={dict_report['dropped']}")
+    print(f"{'operation':<40} {'n':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'err %':>7}")
+    for op, r in dict_report['operations'].items():
+        if not r['n']:
+            continue
+        print(f"{op:<40} {r['n']:>7} {r['p50_ms']:>9} {r['p90_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9} "
+              f"{100 * (r['error_rate'] or 0):>7.2f}")
+    if dict_report['manager_peak']:
+        print(f"manager peak: cpu {dict_report['manager_peak']['cpu_percent']}%  rss {dict_report['manager_peak']['rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for Local MCP Manager")
+    parser.add_argument("--url", default='http://127.0.0.1:17000', help="manager base URL")
+    parser.add_argument("--mix", required=True, help='e.g. "call_tool:svc:tool=70,services=20,all=5,mcp:18101:echo=5"')
+    parser.add_argument("--params", default=None, help='JSON: {tool_name: arguments}')
+    parser.add_argument("--rate", type=float, default=None, help="requests per second (open loop)")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent workers when --rate is not given")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between timeline samples")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="open loop: skip sends above this many in flight")
+    parser.add_argument("--mcp-host", default='127.0.0.1', help="host of the MCP out_ports")
+    parser.add_argument("--pid", type=int, default=None, help="manager pid, to sample its CPU and RSS")
+    parser.add_argument("--include-children", action='store_true', help="add the service processes to the CPU/RSS samples")
+    parser.add_argument("--out", default=None, help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    try:
+        gen = LoadGenerator(args)
+    except ValueError as e:
+        parser.error(str(e))
+    dict_report = asyncio.run(gen.run())
+    print_report(dict_report)
+    if args.out:
+        with open(args.out, 'w', encoding='utf8') as f:
+            json.dump(dict_report, f, indent=2, ensure_ascii=False)
+        print(f"report written to {args.out}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
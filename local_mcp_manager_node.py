@@ -0,0 +1,418 @@
+"""
+集群模式：节点代理（node agent）与管理器一侧的节点客户端。
+
+Cluster mode. A node agent runs on every host and supervises MCP proxy
+processes there, exactly as the manager does for local services. The
+manager places services on nodes by tags and free capacity, starts and
+stops them through the agent's HTTP API, and calls them directly on
+the node's advertised host and the service's out_port.
+
+节点代理用法 (node agent usage):
+    python local_mcp_manager_node.py --name gpu-1 --host 0.0.0.0 --port 17100 \\
+        --advertise-host 10.0.0.5 --tags gpu,large --capacity 8 --token secret
+
+管理器 settings.json:
+    "nodes": [{"name": "gpu-1", "url": "http://10.0.0.5:17100", "token": "secret"}]
+mcp_conf.json 中需要放到节点上的服务:
+    "placement": {"tags": ["gpu"]}            按标签选择剩余容量最多的节点
+    "placement": {"node": "gpu-1"}            指定节点
+    "placement": {"tags": [...], "slots": 2}  占用的容量，默认 1
+没有 out_port 的服务由节点代理在节点上分配端口。
+"""
+
+import hashlib
+import hmac
+import ipaddress
+import json
+import multiprocessing as mp
+import os
+import signal
+import sys
+import threading
+import time
+
+import httpx
+
+from local_mcp_manager_gateway import free_port
+
+
+class NodeError(Exception):
+    """
+    节点不可达，或节点代理返回了错误。
+
+    A node agent could not be reached or rejected the request.
+    """
+
+
+def payload_hash(conf) -> str:
+    str_conf = json.dumps(conf, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(str_conf.encode('utf-8')).hexdigest()
+
+
+# ========== 管理器一侧 ==========
+
+class NodeClient:
+    """
+    访问一个节点代理的 HTTP API（同步）。
+    """
+    def __init__(self, name: str, url: str, token: str = None, timeout: float = 10.0):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.token = token
+        self._http = httpx.Client(timeout=timeout, headers={'X-Node-Token': token} if token else None)
+        self._info = None
+        self._info_at = 0.0
+
+    def _request(self, method: str, path: str, **kw) -> dict:
+        try:
+            response = self._http.request(method, self.url + path, **kw)
+        except httpx.HTTPError as e:
+            raise NodeError(f"node '{self.name}' unreachable: {type(e).__name__}: {e}") from e
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code != 200 or not data.get('success'):
+            raise NodeError(f"node '{self.name}': {data.get('error') or f'HTTP {response.status_code}'}")
+        return data
+
+    def info(self, max_age: float = 2.0) -> dict:
+        """
+        节点信息（名称、标签、容量、已用容量、负载、服务列表），缓存 max_age 秒。
+        """
+        if self._info is None or time.monotonic() - self._info_at > max_age:
+            self._info = self._request('GET', '/node/info')['node']
+            self._info_at = time.monotonic()
+        return self._info
+
+    def start(self, svc_name: str, conf: dict, port: int = None, cwd: str = None, slots: int = 1,
+              http_options: dict = None) -> dict:
+        self._info = None
+        return self._request('POST', f'/node/services/{svc_name}/start', json={
+            'conf': conf, 'port': port, 'cwd': cwd, 'slots': slots, 'http_options': http_options or {},
+        })['service']
+
+    def stop(self, svc_name: str, timeout: float = 3.0) -> dict:
+        self._info = None
+        return self._request('POST', f'/node/services/{svc_name}/stop', json={'timeout': timeout})
+
+    def service(self, svc_name: str) -> dict:
+        return self._request('GET', f'/node/services/{svc_name}')['service']
+
+    def close(self):
+        self._http.close()
+
+
+def place(placement: dict, dict_nodes: dict, svc_name: str = None) -> list:
+    """
+    按放置要求给候选节点排序，返回 [NodeClient, ...]（最合适的在前）。
+
+    placement: {"node": 名称} 或 {"tags": [...], "slots": n}。
+    条件：包含全部 tags、剩余容量不少于 slots；按剩余容量从多到少、负载从低到高排序。
+    已经在运行 svc_name 的节点排在最前（管理器重启后重新接上，不占新的容量）。
+    不可达的节点跳过。
+    """
+    placement = placement or {}
+    slots = int(placement.get('slots', 1))
+    lst_tags = set(placement.get('tags') or [])
+    lst_candidates = []
+    for name, node in dict_nodes.items():
+        if placement.get('node') and placement['node'] != name:
+            continue
+        try:
+            info = node.info()
+        except NodeError as e:
+            print(f"[placement] {e}")
+            continue
+        if not lst_tags.issubset(set(info.get('tags') or [])):
+            continue
+        running = bool(((info.get('services') or {}).get(svc_name) or {}).get('is_alive'))
+        free = info['capacity'] - info['used']
+        if free < slots and not running:
+            continue
+        lst_candidates.append((not running, -free, info.get('load') or 0.0, name, node))
+    return [node for *_, node in sorted(lst_candidates, key=lambda c: c[:4])]
+
+
+class RemoteProcess:
+    """
+    运行在节点上的服务。对 ProcessManager 而言它就像一个进程，放在 svc['process'] 中。
+
+    lst_nodes: place() 给出的候选节点，start 时依次尝试，直到某个节点启动成功。
+    节点的 advertise_host 与 port 组成管理器访问该服务的地址；port 为 None 时由节点分配，start 之后可读。
+    运行状态由后台线程每 status_interval 秒向节点查询一次，is_alive() 只读缓存的结果。
+    """
+    pid = None  # 不在本机，不参与 adopt_running_services
+
+    def __init__(self, lst_nodes: list, svc_name: str, conf: dict, port: int = None, cwd: str = None,
+                 slots: int = 1, http_options: dict = None, status_interval: float = 1.0):
+        self.lst_nodes = list(lst_nodes)
+        self.node = None
+        self.svc_name = svc_name
+        self.conf = conf
+        self.port = None if port is None else int(port)
+        self.cwd = cwd
+        self.slots = slots
+        self.http_options = http_options or {}
+        self.status_interval = float(status_interval)
+        self.host = None
+        self._started = False
+        self._stopped = threading.Event()
+        self._alive = False
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/mcp"
+
+    def start(self):
+        if self._started:
+            raise RuntimeError('a RemoteProcess can only be started once')
+        self._started = True
+        if not self.lst_nodes:
+            raise NodeError(f"no node matches the placement of '{self.svc_name}'")
+        lst_errors = []
+        for node in self.lst_nodes:
+            try:
+                dict_service = node.start(self.svc_name, self.conf, self.port, self.cwd, self.slots, self.http_options)
+                break
+            except NodeError as e:
+                lst_errors.append(str(e))
+        else:
+            raise NodeError('; '.join(lst_errors))
+        self.node = node
+        self.host = dict_service['host']
+        self.port = int(dict_service['port'])
+        self.remote_pid = dict_service.get('pid')
+        self._alive = True
+        threading.Thread(target=self._watch, name=f'node-status-{self.svc_name}', daemon=True).start()
+
+    def _watch(self):
+        """
+        后台线程：定期向节点查询服务是否在运行。节点不可达时视为未运行。
+        """
+        while not self._stopped.wait(self.status_interval):
+            try:
+                self._alive = bool(self.node.service(self.svc_name).get('is_alive'))
+            except NodeError:
+                self._alive = False
+
+    def is_alive(self) -> bool:
+        """
+        最近一次查询的结果，不访问网络。
+        """
+        if self.node is None or self._stopped.is_set():
+            return False
+        return self._alive
+
+    @property
+    def exitcode(self):
+        return None if self.is_alive() else 0
+
+    def terminate(self):
+        self._stopped.set()
+        if self.node is None:
+            return
+        try:
+            self.node.stop(self.svc_name)
+        except NodeError as e:
+            print(f"[{self.svc_name}] stop on node failed: {e}")
+
+    def join(self, timeout=None):
+        pass  # stop 请求返回时节点上的进程已经退出
+
+    def kill(self):
+        pass
+
+    def __repr__(self):
+        return f"<RemoteProcess {self.svc_name} on {getattr(self.node, 'name', None)} {self.host}:{self.port}>"
+
+
+# ========== 节点代理 ==========
+
+class NodeAgent:
+    """
+    节点上的进程监管：按管理器的请求启动、停止 MCP 代理进程。
+    """
+    def __init__(self, name: str, advertise_host: str, bind_host: str = '0.0.0.0', tags=(), capacity: int = 8):
+        self.name = name
+        self.advertise_host = advertise_host
+        self.bind_host = bind_host
+        self.tags = list(tags)
+        self.capacity = int(capacity)
+        self.services = {}  # svc_name -> {'process', 'port', 'conf_hash', 'slots', 'started_at'}
+        self._lock = threading.Lock()
+
+    def _service_status(self, svc_name: str, item: dict) -> dict:
+        proc = item['process']
+        return {
+            'name': svc_name,
+            'host': self.advertise_host,
+            'port': item['port'],
+            'pid': proc.pid,
+            'is_alive': proc.is_alive(),
+            'exitcode': proc.exitcode,
+            'conf_hash': item['conf_hash'],
+            'slots': item['slots'],
+            'started_at': item['started_at'],
+        }
+
+    def info(self) -> dict:
+        with self._lock:
+            dict_services = {name: self._service_status(name, item) for name, item in self.services.items()}
+        return {
+            'name': self.name,
+            'host': self.advertise_host,
+            'tags': self.tags,
+            'capacity': self.capacity,
+            'used': sum(s['slots'] for s in dict_services.values() if s['is_alive']),
+            'load': os.getloadavg()[0] if hasattr(os, 'getloadavg') else None,
+            'cpu_count': os.cpu_count(),
+            'services': dict_services,
+        }
+
+    def start(self, svc_name: str, conf: dict, port: int = None, cwd: str = None, slots: int = 1,
+              http_options: dict = None) -> dict:
+        """
+        启动服务。同名服务已经以相同配置运行时直接返回（管理器重启后重新下发也不会重复启动）。
+        port 为 None 时在本节点上分配空闲端口，实际端口在返回值的 'port' 中。
+
+        http_options: 代理的 stateless_http / json_response，见 local_mcp_manager_core.serve_http。
+        """
+        from local_mcp_manager_core import mcp_stdio_to_http
+
+        conf_hash = payload_hash([conf, port, cwd] + ([http_options] if http_options else []))
+        with self._lock:
+            item = self.services.get(svc_name)
+            if item is not None and item['process'].is_alive():
+                if item['conf_hash'] == conf_hash:
+                    return self._service_status(svc_name, item)
+                raise ValueError(f"'{svc_name}' is already running here with another configuration")
+            used = sum(i['slots'] for n, i in self.services.items() if n != svc_name and i['process'].is_alive())
+            if used + int(slots) > self.capacity:
+                raise ValueError(f"node '{self.name}' is full ({used}/{self.capacity} slots used)")
+            if port is None:
+                port = free_port(self.bind_host)
+            proc = mp.Process(
+                target=mcp_stdio_to_http,
+                args=(conf, self.bind_host, port, svc_name, cwd, False, None, http_options),
+                daemon=False,
+            )
+            proc.start()
+            item = {'process': proc, 'port': int(port), 'conf_hash': conf_hash, 'slots': int(slots), 'started_at': time.time()}
+            self.services[svc_name] = item
+            return self._service_status(svc_name, item)
+
+    def stop(self, svc_name: str, timeout: float = 3.0):
+        with self._lock:
+            item = self.services.pop(svc_name, None)
+        if item is None:
+            return
+        proc = item['process']
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(timeout=timeout)
+            if proc.is_alive():
+                if os.name == "posix":
+                    os.kill(proc.pid, signal.SIGKILL)
+                proc.join(timeout=1.0)
+
+    def stop_all(self):
+        for svc_name in list(self.services):
+            self.stop(svc_name)
+
+
+def is_loopback(host: str) -> bool:
+    """
+    host 是否只能从本机访问（127.0.0.0/8、::1、localhost）。
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def create_app(agent: NodeAgent, token: str = None):
+    from flask import Flask, jsonify, request
+
+    app = Flask('local_mcp_manager_node')
+
+    @app.before_request
+    def check_token():
+        if token and not hmac.compare_digest(
+            request.headers.get('X-Node-Token', '').encode('utf-8'), token.encode('utf-8'),
+        ):
+            return jsonify({'success': False, 'error': 'Invalid node token'}), 401
+
+    @app.route('/node/info', methods=['GET'])
+    def node_info():
+        return jsonify({'success': True, 'node': agent.info()})
+
+    @app.route('/node/services/<service_name>', methods=['GET'])
+    def node_service(service_name):
+        with agent._lock:
+            item = agent.services.get(service_name)
+            dict_service = None if item is None else agent._service_status(service_name, item)
+        if dict_service is None:
+            return jsonify({'success': True, 'service': {'name': service_name, 'is_alive': False}})
+        return jsonify({'success': True, 'service': dict_service})
+
+    @app.route('/node/services/<service_name>/start', methods=['POST'])
+    def node_start(service_name):
+        data = request.get_json() or {}
+        try:
+            dict_service = agent.start(service_name, data['conf'], data.get('port'), data.get('cwd'),
+                                       data.get('slots', 1), data.get('http_options'))
+        except (KeyError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        return jsonify({'success': True, 'service': dict_service})
+
+    @app.route('/node/services/<service_name>/stop', methods=['POST'])
+    def node_stop(service_name):
+        data = request.get_json(silent=True) or {}
+        agent.stop(service_name, timeout=float(data.get('timeout', 3.0)))
+        return jsonify({'success': True})
+
+    return app
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Local MCP Manager node agent")
+    parser.add_argument("--name", default=None, help="node name (default: hostname)")
+    parser.add_argument("--host", default='127.0.0.1', help="address the agent and the services listen on")
+    parser.add_argument("--port", type=int, default=17100, help="agent port")
+    parser.add_argument("--advertise-host", default=None, help="address the manager uses to reach services (default: --host)")
+    parser.add_argument("--tags", default='', help="comma separated tags, e.g. gpu,large")
+    parser.add_argument("--capacity", type=int, default=8, help="number of service slots")
+    parser.add_argument("--token", default=os.environ.get('MCP_NODE_TOKEN'), help="shared secret (or MCP_NODE_TOKEN)")
+    args = parser.parse_args()
+    # 节点可以在本机启动任意命令，监听非本机地址时必须设置 token
+    if not args.token and not is_loopback(args.host):
+        parser.error(f"--token (or MCP_NODE_TOKEN) is required when --host {args.host!r} is not a loopback address")
+
+    mp.freeze_support()
+    if os.name == "nt":
+        mp.set_start_method("spawn", force=True)
+
+    import socket
+    advertise_host = args.advertise_host or ('127.0.0.1' if args.host in ['0.0.0.0', ''] else args.host)
+    agent = NodeAgent(
+        name=args.name or socket.gethostname(),
+        advertise_host=advertise_host,
+        bind_host=args.host,
+        tags=[t.strip() for t in args.tags.split(',') if t.strip()],
+        capacity=args.capacity,
+    )
+    app = create_app(agent, token=args.token)
+    try:
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+    finally:
+        print("stopping services...")
+        agent.stop_all()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+超时、截止时间、取消、熔断、准入控制与请求合并。
+
+Timeouts, deadlines, cancellation, circuit breaking, admission control
+and request coalescing for calls to MCP backends.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import anyio
+import httpx
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    整个请求的截止时间已到。
+
+    The end-to-end deadline of a request has passed.
+    """
+
+
+class ToolTimeoutError(TimeoutError):
+    """
+    单次工具调用超时。
+
+    A single tool call did not finish within its timeout.
+    """
+
+
+class Deadline:
+    """
+    端到端截止时间，从 HTTP 请求一直传递到 LLM 轮次和工具调用。
+
+    End-to-end deadline, carried from the HTTP request through LLM rounds and tool calls.
+    seconds = None 表示不限时 (no limit).
+    """
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires_at = None if seconds is None else time.monotonic() + float(seconds)
+
+    def remaining(self):
+        """
+        剩余秒数；不限时返回 None。
+        """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def clamp(self, timeout=None):
+        """
+        取 timeout 与剩余时间中较小的一个。已过期则抛出 DeadlineExceeded。
+
+        Return the smaller of `timeout` and the remaining time.
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline of {self.seconds}s exceeded")
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(float(timeout), remaining)
+
+
+async def call_tool_cancellable(client, tool_name: str, arguments: dict, timeout=None):
+    """
+    在 timeout 内调用工具。超时或被取消时，向后端发送 notifications/cancelled，
+    让后端停止已经没人等待的工作。
+
+    Call a tool within `timeout`. On timeout or cancellation, send an MCP
+    cancellation notification so the backend stops working on the abandoned call.
+    """
+    dict_request = {}
+
+    async def call():
+        # 同一个会话可能被并发使用：在发送之前的同一步中读取 id，中间没有切换，不会拿到别的调用的 id
+        dict_request['id'] = client.session._request_id
+        return await client.call_tool(tool_name, arguments)
+
+    try:
+        return await asyncio.wait_for(call(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        is_timeout = isinstance(e, asyncio.TimeoutError)
+        if 'id' not in dict_request:  # 请求还没有发出
+            if is_timeout:
+                raise ToolTimeoutError(f"Tool '{tool_name}' timed out after {timeout}s") from e
+            raise
+        try:
+            await asyncio.wait_for(
+                client.cancel(dict_request['id'], 'timeout' if is_timeout else 'cancelled by client'),
+                timeout=2.0,
+            )
+        except Exception as e_cancel:
+            print(f"[call_tool_cancellable] cancel notification failed: {e_cancel}")
+        if is_timeout:
+            raise ToolTimeoutError(f"Tool '{tool_name}' timed out after {timeout}s") from e
+        raise
+
+
+# ========== 熔断与准入控制 ==========
+
+class ServiceUnavailable(Exception):
+    """
+    服务暂时不可用（熔断打开或排队已满），请求被快速拒绝。
+
+    The service is temporarily unavailable and the request was rejected fast.
+    """
+
+
+class CircuitOpenError(ServiceUnavailable):
+    pass
+
+
+class AdmissionRejected(ServiceUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    基于失败率和慢调用率的熔断器，带半开探测。
+
+    Circuit breaker driven by failure rate and slow-call rate over the last `window` calls.
+    CLOSED -> OPEN when either rate reaches its threshold (after `min_calls` calls);
+    OPEN -> HALF_OPEN after `open_seconds`, letting `half_open_probes` calls through;
+    HALF_OPEN -> CLOSED on a successful probe, back to OPEN on a failed one.
+    """
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
+
+    def __init__(self, window=20, min_calls=5, failure_rate=0.5,
+                 slow_call_seconds=10.0, slow_call_rate=0.8,
+                 open_seconds=30.0, half_open_probes=1):
+        self.window = int(window)
+        self.min_calls = int(min_calls)
+        self.failure_rate = float(failure_rate)
+        self.slow_call_seconds = float(slow_call_seconds)
+        self.slow_call_rate = float(slow_call_rate)
+        self.open_seconds = float(open_seconds)
+        self.half_open_probes = int(half_open_probes)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._calls = deque(maxlen=self.window)  # (ok, latency)
+            self._opened_at = 0.0
+            self._probes = 0
+
+    def allow(self) -> bool:
+        """
+        是否放行一次调用。半开状态下最多放行 half_open_probes 个探测。
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes = 0
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, ok: bool, latency: float):
+        """
+        记录一次调用的结果与耗时（秒）。
+        """
+        with self._lock:
+            is_slow = latency >= self.slow_call_seconds
+            if self.state == self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if ok and not is_slow:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                else:
+                    self._trip()
+                return
+            self._calls.append((ok, latency))
+            n = len(self._calls)
+            if self.state == self.CLOSED and n >= self.min_calls:
+                n_failed = sum(1 for c_ok, _ in self._calls if not c_ok)
+                n_slow = sum(1 for _, c_lat in self._calls if c_lat >= self.slow_call_seconds)
+                if n_failed / n >= self.failure_rate or n_slow / n >= self.slow_call_rate:
+                    self._trip()
+
+    def release_probe(self):
+        """
+        放行后没有真正发出调用（例如被准入控制拒绝）时归还探测名额。
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probes = 0
+
+    def status(self) -> dict:
+        with self._lock:
+            n = len(self._calls)
+            return {
+                'state': self.state,
+                'calls': n,
+                'failures': sum(1 for c_ok, _ in self._calls if not c_ok),
+                'avg_latency': round(sum(c_lat for _, c_lat in self._calls) / n, 4) if n else None,
+            }
+
+
+class AdmissionController:
+    """
+    并发上限 + 有界等待队列。队列满时立即拒绝，等待超过 queue_timeout 也拒绝。
+
+    Concurrency limit plus a bounded wait queue. Works across event loops
+    (every Flask async view runs in its own loop), so it uses a thread lock
+    and polls instead of asyncio primitives.
+    """
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, max_concurrency=8, max_queue=32, queue_timeout=10.0, n_units_fn=None):
+        """
+        n_units_fn: 返回当前处理单元数（例如活动副本数）的函数；给出时并发上限为 max_concurrency × 单元数。
+        """
+        self.max_concurrency = int(max_concurrency)
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        self.n_units_fn = n_units_fn
+        self.in_flight = 0
+        self.waiting = 0
+        self.n_rejected = 0
+        self.avg_wait = 0.0  # 秒，排队时间的指数移动平均（不排队的调用计为 0）
+        self._lock = threading.Lock()
+
+    def limit(self) -> int:
+        """
+        当前的并发上限。
+        """
+        if self.n_units_fn is None:
+            return self.max_concurrency
+        try:
+            n_units = int(self.n_units_fn())
+        except Exception:
+            n_units = 1
+        return self.max_concurrency * max(1, n_units)
+
+    def _try_acquire(self, t0: float = None) -> bool:
+        limit = self.limit()
+        with self._lock:
+            if self.in_flight < limit:
+                self.in_flight += 1
+                wait = 0.0 if t0 is None else time.monotonic() - t0
+                self.avg_wait += 0.2 * (wait - self.avg_wait)
+                return True
+            return False
+
+    async def acquire(self):
+        if self._try_acquire():
+            return
+        t0 = time.monotonic()
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.n_rejected += 1
+                raise AdmissionRejected(f"Queue full ({self.max_queue} waiting)")
+            self.waiting += 1
+        try:
+            t_end = time.monotonic() + self.queue_timeout
+            while True:
+                await asyncio.sleep(self.POLL_INTERVAL)
+                if self._try_acquire(t0):
+                    return
+                if time.monotonic() >= t_end:
+                    with self._lock:
+                        self.n_rejected += 1
+                    raise AdmissionRejected(f"Waited more than {self.queue_timeout}s in queue")
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+    def status(self) -> dict:
+        limit = self.limit()
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'rejected': self.n_rejected,
+                'avg_wait': round(self.avg_wait, 4),
+                'max_concurrency': limit,
+                'max_queue': self.max_queue,
+            }
+
+
+def is_backend_failure(e: BaseException) -> bool:
+    """
+    异常是否说明后端本身出了问题（计入熔断统计）：超时、连接或传输错误、会话断开。
+    协议层的错误响应（McpError，例如参数不合法）说明后端仍在正常应答，不算故障。
+    """
+    if isinstance(e, McpError):
+        return e.error.code == CONNECTION_CLOSED
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError, OSError, httpx.TransportError,
+                      anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)):
+        return True
+    # fastmcp 把连接失败、会话意外关闭报告为 RuntimeError
+    return isinstance(e, RuntimeError)
+
+
+class ServiceGuard:
+    """
+    每个后端服务一个：准入控制 + 熔断。
+
+    One per backend service, in front of every call to it.
+
+    用法 (usage):
+        async with guard.call(ok_exceptions=(ToolError,), is_failure=is_backend_failure):
+            ...
+    ok_exceptions 中的异常（例如工具自身返回的错误）不算后端故障；
+    is_failure 给出时，其它异常中只有 is_failure(e) 为 True 的才算故障。
+    """
+    def __init__(self, breaker_cfg: dict = None, max_concurrency=8, max_queue=32, queue_timeout=10.0,
+                 n_units_fn=None):
+        self.breaker = CircuitBreaker(**(breaker_cfg or {}))
+        self.admission = AdmissionController(max_concurrency, max_queue, queue_timeout, n_units_fn)
+
+    @asynccontextmanager
+    async def call(self, ok_exceptions: tuple = (), is_failure=None):
+        # 先看熔断：熔断中的调用立即失败，不进入排队，也不占用队列
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit open, retry after {self.breaker.open_seconds}s")
+        try:
+            await self.admission.acquire()
+        except BaseException:  # 排队被拒绝或被取消，归还半开状态下的探测名额
+            self.breaker.release_probe()
+            raise
+        try:
+            t0 = time.monotonic()
+            try:
+                yield
+            except ok_exceptions:
+                self.breaker.record(True, time.monotonic() - t0)
+                raise
+            except Exception as e:
+                self.breaker.record(is_failure is not None and not is_failure(e), time.monotonic() - t0)
+                raise
+            except BaseException:  # 被取消，不计入统计
+                self.breaker.release_probe()
+                raise
+            else:
+                self.breaker.record(True, time.monotonic() - t0)
+        finally:
+            self.admission.release()
+
+    def status(self) -> dict:
+        return {
+            'breaker': self.breaker.status(),
+            'admission': self.admission.status(),
+        }
+
+
+# ========== 请求合并 ==========
+
+class SingleFlight:
+    """
+    合并相同的并发请求：同一个 key 同时只发出一次上游调用，其余调用者共享结果。
+
+    Coalesce identical in-flight calls: the first caller of a key runs it,
+    concurrent callers of the same key wait for and share its result.
+    Callers may live in different event loops, so the shared result is a
+    concurrent.futures.Future.
+    """
+    def __init__(self):
+        self._calls = {}  # key -> concurrent.futures.Future
+        self._lock = threading.Lock()
+        self.n_calls = 0
+        self.n_shared = 0
+
+    async def do(self, key, fn):
+        """
+        fn: 无参数的协程函数，真正发出上游调用。
+        """
+        with self._lock:
+            fut = self._calls.get(key)
+            is_leader = fut is None
+            if is_leader:
+                fut = concurrent.futures.Future()
+                self._calls[key] = fut
+                self.n_calls += 1
+            else:
+                self.n_shared += 1
+        if not is_leader:
+            # shield: 某个等待者被取消时，不影响共享的调用
+            return await asyncio.shield(asyncio.wrap_future(fut))
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            fut.set_exception(RuntimeError('Coalesced call was cancelled'))
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls),
+                'calls': self.n_calls,
+                'shared': self.n_shared,
+            }
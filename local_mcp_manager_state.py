@@ -0,0 +1,185 @@
+"""
+运行状态持久化（SQLite）：服务状态、工具目录、工具调用记录。
+
+Persistent state store. Service status, tool catalogs and call history are
+written to SQLite by a background thread, off the request path, and read
+back at boot so the UI has complete data right after a restart.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+
+import local_mcp_manager_codec as codec
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS services ('
+    ' name TEXT PRIMARY KEY, is_enabled INTEGER, is_alive INTEGER, mcp_status TEXT,'
+    ' pid INTEGER, port INTEGER, conf_hash TEXT, updated_at REAL, pid_identity TEXT)',
+    'CREATE TABLE IF NOT EXISTS catalogs ('
+    ' service TEXT PRIMARY KEY, conf_hash TEXT, catalog_hash TEXT, fetched_at REAL, body BLOB)',
+    'CREATE TABLE IF NOT EXISTS call_history ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL, service TEXT, tool TEXT,'
+    ' ok INTEGER, latency REAL, cached INTEGER, error TEXT)',
+    'CREATE INDEX IF NOT EXISTS idx_call_history_service_ts ON call_history (service, ts)',
+    'CREATE INDEX IF NOT EXISTS idx_call_history_ts ON call_history (ts)',
+]
+
+
+class StateStore:
+    """
+    写操作放入队列，由后台线程批量写入（每批一个事务）；读操作直接查询。
+
+    Writes are queued and applied in batches by a background thread;
+    reads query the database directly.
+    history_max: call_history 最多保留的行数，超出后删除最旧的。
+    """
+    BATCH_SIZE = 256
+
+    def __init__(self, path='state.sqlite3', history_max=100000):
+        self.path = str(path)
+        self.history_max = int(history_max)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()  # 读与写共用一个连接
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for sql in SCHEMA:
+            self._conn.execute(sql)
+        # 旧版本创建的库没有 pid_identity 列
+        set_cols = {row[1] for row in self._conn.execute('PRAGMA table_info(services)')}
+        if 'pid_identity' not in set_cols:
+            self._conn.execute('ALTER TABLE services ADD COLUMN pid_identity TEXT')
+        self._n_inserted = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, name='state-store-writer', daemon=True)
+        self._thread.start()
+
+    # ---------- 写（异步） ----------
+
+    def save_service(self, svc: dict, pid: int = None, conf_hash: str = None, pid_identity: str = None):
+        self._queue.put((
+            'INSERT OR REPLACE INTO services'
+            ' (name, is_enabled, is_alive, mcp_status, pid, port, conf_hash, updated_at, pid_identity)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (svc['name'], int(bool(svc.get('is_enabled'))), int(bool(svc.get('is_alive'))), svc.get('mcp_status'),
+             pid, _int_or_none(svc.get('port')), conf_hash, time.time(), pid_identity),
+        ))
+
+    def save_catalog(self, svc_name: str, conf_hash: str, catalog_hash: str, dict_catalog: dict):
+        self._queue.put((
+            'INSERT OR REPLACE INTO catalogs (service, conf_hash, catalog_hash, fetched_at, body) VALUES (?, ?, ?, ?, ?)',
+            (svc_name, conf_hash, catalog_hash, time.time(), codec.dumps_bytes(dict_catalog)),
+        ))
+
+    def record_call(self, svc_name: str, tool_name: str, ok: bool, latency: float, cached: bool = False, error: str = None):
+        self._queue.put((
+            'INSERT INTO call_history (ts, service, tool, ok, latency, cached, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (time.time(), svc_name, tool_name, int(ok), latency, int(cached), None if error is None else str(error)[:1000]),
+        ))
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            lst_items = [item]
+            while item is not None and len(lst_items) < self.BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                lst_items.append(item)
+            lst_writes = [i for i in lst_items if i is not None]
+            try:
+                if lst_writes:
+                    with self._lock:
+                        self._conn.execute('BEGIN')
+                        for sql, params in lst_writes:
+                            self._conn.execute(sql, params)
+                        self._prune_history(lst_writes)
+                        self._conn.execute('COMMIT')
+            except Exception as e:
+                print(f"[StateStore] write failed: {e}")
+                try:
+                    with self._lock:
+                        self._conn.execute('ROLLBACK')
+                except Exception:
+                    pass
+            finally:
+                for _ in lst_items:
+                    self._queue.task_done()
+            if None in lst_items:  # close() 的结束信号
+                return
+
+    def _prune_history(self, lst_writes):
+        self._n_inserted += sum(1 for sql, _ in lst_writes if sql.startswith('INSERT INTO call_history'))
+        if self._n_inserted < 1000:  # 每写入约 1000 条检查一次
+            return
+        self._n_inserted = 0
+        self._conn.execute(
+            'DELETE FROM call_history WHERE id <= (SELECT MAX(id) FROM call_history) - ?', (self.history_max,)
+        )
+
+    def flush(self):
+        """
+        等待队列中的写操作完成。
+        """
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        with self._lock:
+            self._conn.close()
+
+    # ---------- 读 ----------
+
+    def load_services(self) -> dict:
+        """
+        返回 {服务名: {is_enabled, is_alive, mcp_status, pid, port, conf_hash, updated_at, pid_identity}}。
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT name, is_enabled, is_alive, mcp_status, pid, port, conf_hash, updated_at, pid_identity'
+                ' FROM services'
+            )
+            lst_cols = [c[0] for c in cursor.description]
+            return {row[0]: dict(zip(lst_cols, row)) for row in cursor.fetchall()}
+
+    def load_catalogs(self) -> dict:
+        """
+        返回 {服务名: {conf_hash, catalog_hash, fetched_at, catalog}}。
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT service, conf_hash, catalog_hash, fetched_at, body FROM catalogs').fetchall()
+        return {
+            service: {'conf_hash': conf_hash, 'catalog_hash': catalog_hash, 'fetched_at': fetched_at,
+                      'catalog': codec.loads(body)}
+            for service, conf_hash, catalog_hash, fetched_at, body in rows
+        }
+
+    def recent_calls(self, svc_name: str = None, limit: int = 100) -> list:
+        sql = 'SELECT ts, service, tool, ok, latency, cached, error FROM call_history'
+        params = []
+        if svc_name:
+            sql += ' WHERE service = ?'
+            params.append(svc_name)
+        sql += ' ORDER BY ts DESC LIMIT ?'
+        params.append(int(limit))
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            lst_cols = [c[0] for c in cursor.description]
+            return [dict(zip(lst_cols, row)) for row in cursor.fetchall()]
+
+    def status(self) -> dict:
+        return {'path': self.path, 'pending_writes': self._queue.qsize()}
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,80 @@
+"""
+管理器与本地代理子进程之间的 Unix domain socket 通道。
+
+Unix domain sockets between the manager and its proxy children. A child
+proxy listens on <uds_dir>/<service>-<hash>.sock (and on its TCP out_port when
+one is configured, for external clients). The manager's own calls go
+over the socket: no TCP handshake, no loopback port to allocate, and no
+"address already in use" for services that only the manager talks to.
+POSIX only.
+"""
+
+import hashlib
+import os
+import re
+import socket
+
+import httpx
+from fastmcp.client.transports import StreamableHttpTransport
+
+# sockaddr_un.sun_path 的长度上限（Linux 108，macOS 104，留出余量）
+MAX_SOCKET_PATH = 100
+
+# 通过 socket 访问时 URL 中的主机名不起作用，只用于 Host 请求头
+UDS_URL = 'http://localhost/mcp'
+
+
+def uds_supported() -> bool:
+    return os.name == 'posix' and hasattr(socket, 'AF_UNIX')
+
+
+def socket_path(uds_dir: str, svc_name: str):
+    """
+    服务的 socket 路径 <uds_dir>/<服务名>-<hash>.sock（绝对路径）。路径过长时返回 None（改用 TCP）。
+    服务名中的特殊字符替换为 _，hash 取原服务名的前 8 位 sha1，"a b" 与 "a_b" 不会用同一个 socket。
+    """
+    digest = hashlib.sha1(svc_name.encode('utf-8')).hexdigest()[:8]
+    file_name = re.sub(r'[^A-Za-z0-9_.-]', '_', svc_name) + '-' + digest + '.sock'
+    path = os.path.abspath(os.path.join(uds_dir, file_name))
+    if len(path.encode('utf-8')) > MAX_SOCKET_PATH:
+        print(f"[uds] {svc_name}: socket path too long ({path}), using TCP")
+        return None
+    return path
+
+
+def bind_unix_socket(path: str) -> socket.socket:
+    """
+    在 path 上监听。目录只允许当前用户访问；上次运行留下的 socket 文件先删除。
+    """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o600)
+    sock.listen(2048)
+    return sock
+
+
+def uds_client_factory(path: str):
+    """
+    mcp 的 httpx_client_factory：与 mcp 默认的客户端相同，只是连接走 Unix socket。
+    """
+    def factory(headers=None, timeout=None, auth=None) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=path),
+            headers=headers,
+            timeout=timeout or httpx.Timeout(30.0),
+            auth=auth,
+            follow_redirects=True,
+        )
+    return factory
+
+
+def uds_transport(path: str) -> StreamableHttpTransport:
+    """
+    通过 socket 访问代理子进程的 transport，可直接传给 fastmcp.Client。
+    """
+    return StreamableHttpTransport(UDS_URL, httpx_client_factory=uds_client_factory(path))
@@ -0,0 +1,66 @@
+"""
+扩缩容决策 decide() 的单元测试。
+"""
+
+from local_mcp_manager_autoscale import decide, merge_autoscale_cfg
+
+CFG = merge_autoscale_cfg({
+    'min_replicas': 1,
+    'max_replicas': 3,
+    'target_outstanding': 4,
+    'scale_down_ratio': 0.25,
+    'scale_up_cooldown': 10,
+    'scale_down_cooldown': 60,
+})
+NOW = 1000.0
+LONG_AGO = 0.0
+
+
+def samples(load, avg_wait=None, avg_latency=None, n=5):
+    return [{'load': load, 'avg_wait': avg_wait, 'avg_latency': avg_latency}] * n
+
+
+def test_no_samples_means_no_change():
+    assert decide(CFG, 1, [], NOW, LONG_AGO, LONG_AGO) == 0
+
+
+def test_scale_up_when_load_per_replica_exceeds_target():
+    assert decide(CFG, 1, samples(5), NOW, LONG_AGO, LONG_AGO) == 1
+    assert decide(CFG, 2, samples(9), NOW, LONG_AGO, LONG_AGO) == 1
+    assert decide(CFG, 2, samples(8), NOW, LONG_AGO, LONG_AGO) == 0
+
+
+def test_scale_up_respects_cooldown_and_max_replicas():
+    assert decide(CFG, 1, samples(10), NOW, NOW - 5, NOW - 5) == 0
+    assert decide(CFG, 3, samples(100), NOW, LONG_AGO, LONG_AGO) == 0
+
+
+def test_scale_up_on_queue_wait_or_latency():
+    cfg = merge_autoscale_cfg(CFG, {'max_queue_wait': 0.5, 'max_latency': 2.0})
+    assert decide(cfg, 1, samples(1, avg_wait=1.0), NOW, LONG_AGO, LONG_AGO) == 1
+    assert decide(cfg, 1, samples(1, avg_latency=3.0), NOW, LONG_AGO, LONG_AGO) == 1
+    # 空闲时旧的平均值不触发扩容
+    assert decide(cfg, 1, samples(0, avg_wait=1.0, avg_latency=3.0), NOW, LONG_AGO, LONG_AGO) == 0
+
+
+def test_scale_down_when_idle_after_cooldown():
+    assert decide(CFG, 2, samples(0), NOW, LONG_AGO, LONG_AGO) == -1
+    assert decide(CFG, 2, samples(0), NOW, LONG_AGO, NOW - 30) == 0
+    assert decide(CFG, 1, samples(0), NOW, LONG_AGO, LONG_AGO) == 0
+
+
+def test_no_scale_down_between_thresholds():
+    # 每个副本的负载 1.5：低于 target_outstanding，但不低于 4 * 0.25
+    assert decide(CFG, 2, samples(3), NOW, LONG_AGO, LONG_AGO) == 0
+
+
+def test_bounds_are_restored():
+    assert decide(CFG, 0, samples(0), NOW, NOW, NOW) == 1
+    assert decide(CFG, 4, samples(0), NOW, NOW, NOW) == -1
+
+
+def test_merge_autoscale_cfg_ignores_none_and_clamps():
+    cfg = merge_autoscale_cfg({'min_replicas': 3, 'max_replicas': 2, 'window': None})
+    assert cfg['min_replicas'] == 3
+    assert cfg['max_replicas'] == 3
+    assert cfg['window'] == 10
@@ -0,0 +1,98 @@
+"""
+工具结果缓存的单元测试：键的规范化、TTL 与 LRU 淘汰。
+"""
+
+import time
+
+from local_mcp_manager_cache import ToolResultCache, canonical_args
+
+
+def test_canonical_args_ignores_key_order_and_whitespace():
+    assert canonical_args({'b': 1, 'a': [1, 2]}) == canonical_args('{ "a": [1, 2],  "b": 1 }')
+    assert canonical_args({'b': 1, 'a': 2}) == '{"a":2,"b":1}'
+
+
+def test_canonical_args_empty_forms_are_equal():
+    assert canonical_args(None) == canonical_args({}) == canonical_args('') == '{}'
+
+
+def test_canonical_args_keeps_non_ascii():
+    assert canonical_args({'q': '天气'}) == '{"q":"天气"}'
+
+
+def test_make_key_distinguishes_service_tool_and_arguments():
+    key = ToolResultCache.make_key('svc', 'tool', {'x': 1})
+    assert key == ToolResultCache.make_key('svc', 'tool', '{"x": 1}')
+    assert key != ToolResultCache.make_key('svc', 'tool', {'x': 2})
+    assert key != ToolResultCache.make_key('svc', 'other', {'x': 1})
+    assert key != ToolResultCache.make_key('other', 'tool', {'x': 1})
+
+
+def test_get_and_put():
+    cache = ToolResultCache()
+    key = cache.make_key('svc', 'tool', {})
+    assert cache.get(key) is None
+    cache.put(key, {'content': 'x'}, ttl=60)
+    assert cache.get(key) == {'content': 'x'}
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+
+def test_entry_expires_after_ttl():
+    cache = ToolResultCache()
+    key = cache.make_key('svc', 'tool', {})
+    cache.put(key, {'content': 'x'}, ttl=0.01)
+    time.sleep(0.02)
+    assert cache.get(key) is None
+    assert cache.get_stats()['expirations'] == 1
+    assert cache.n_bytes == 0
+
+
+def test_lru_eviction_by_entries_keeps_recently_used():
+    cache = ToolResultCache(max_entries=2)
+    k1, k2, k3 = [cache.make_key('svc', 'tool', {'i': i}) for i in range(3)]
+    cache.put(k1, {'i': 1}, ttl=60)
+    cache.put(k2, {'i': 2}, ttl=60)
+    assert cache.get(k1) == {'i': 1}  # k1 变为最近使用
+    cache.put(k3, {'i': 3}, ttl=60)
+    assert cache.get(k2) is None
+    assert cache.get(k1) == {'i': 1}
+    assert cache.get(k3) == {'i': 3}
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_lru_eviction_by_bytes():
+    cache = ToolResultCache(max_entries=100, max_bytes=100)
+    k1, k2 = cache.make_key('svc', 'a', {}), cache.make_key('svc', 'b', {})
+    cache.put(k1, 'x' * 60, ttl=60)
+    cache.put(k2, 'y' * 60, ttl=60)
+    assert cache.get(k1) is None
+    assert cache.get(k2) == 'y' * 60
+    assert cache.n_bytes == 60
+
+
+def test_oversized_value_is_not_cached():
+    cache = ToolResultCache(max_bytes=10)
+    key = cache.make_key('svc', 'tool', {})
+    cache.put(key, 'x' * 11, ttl=60)
+    assert cache.get(key) is None
+    assert cache.n_bytes == 0
+
+
+def test_put_same_key_replaces_and_accounts_bytes():
+    cache = ToolResultCache()
+    key = cache.make_key('svc', 'tool', {})
+    cache.put(key, 'x' * 10, ttl=60)
+    cache.put(key, 'y' * 4, ttl=60)
+    assert cache.get(key) == 'y' * 4
+    assert cache.n_bytes == 4
+
+
+def test_invalidate_service():
+    cache = ToolResultCache()
+    cache.put(cache.make_key('a', 'tool', {}), 1, ttl=60)
+    cache.put(cache.make_key('a', 'other', {}), 2, ttl=60)
+    cache.put(cache.make_key('b', 'tool', {}), 3, ttl=60)
+    assert cache.invalidate_service('a') == 2
+    assert cache.get(cache.make_key('b', 'tool', {})) == 3
+    assert cache.get_stats()['entries'] == 1
@@ -0,0 +1,88 @@
+"""
+上下文窗口管理 build_context() 的单元测试。
+"""
+
+from local_mcp_manager_chat import build_context, elide_text, estimate_message_tokens, split_turns
+
+
+def turn(i, n_chars=400):
+    return [
+        {'role': 'user', 'content': f'question {i} ' + 'q' * n_chars},
+        {'role': 'assistant', 'content': None, 'tool_calls': [
+            {'id': f'call_{i}', 'type': 'function', 'function': {'name': 'lookup', 'arguments': '{}'}},
+        ]},
+        {'role': 'tool', 'tool_call_id': f'call_{i}', 'content': 'r' * n_chars},
+        {'role': 'assistant', 'content': f'answer {i}'},
+    ]
+
+
+def tokens(lst_messages):
+    return sum(estimate_message_tokens(m) for m in lst_messages)
+
+
+def test_elide_text_keeps_head_and_tail():
+    text = 'a' * 50 + 'b' * 50
+    elided = elide_text(text, 30)
+    assert elided.startswith('a' * 20)
+    assert elided.endswith('b' * 10)
+    assert '[70 chars elided]' in elided
+    assert elide_text('short', 30) == 'short'
+
+
+def test_split_turns_keeps_tool_results_with_their_call():
+    lst_messages = turn(0) + turn(1)
+    lst_turns = split_turns(lst_messages)
+    assert [len(t) for t in lst_turns] == [4, 4]
+    assert lst_turns[1][2]['tool_call_id'] == 'call_1'
+
+
+def test_context_within_budget_is_unchanged():
+    lst_messages = turn(0) + turn(1)
+    lst_context, lst_dropped, summary = build_context(lst_messages, max_tokens=100000)
+    assert lst_context == lst_messages
+    assert lst_dropped == []
+    assert summary is None
+
+
+def test_long_tool_results_are_elided():
+    lst_messages = turn(0, n_chars=5000)
+    lst_context, _, _ = build_context(lst_messages, max_tokens=100000, tool_max_chars=100)
+    assert 'chars elided' in lst_context[2]['content']
+    assert lst_context[0] == lst_messages[0]  # 用户消息不截断
+    assert len(lst_messages[2]['content']) == 5000  # 不修改传入的消息
+
+
+def test_oldest_turns_are_dropped_whole_and_summarized():
+    lst_messages = turn(0) + turn(1) + turn(2)
+    max_tokens = tokens(turn(2)) + 100
+    lst_context, lst_dropped, summary = build_context(lst_messages, max_tokens=max_tokens)
+    assert lst_dropped == turn(0) + turn(1)
+    assert lst_context[0]['role'] == 'system'
+    assert lst_context[1:] == turn(2)
+    assert 'question 0' in summary and 'question 1' in summary
+    assert 'called lookup' in summary
+    assert 'rrrr' not in summary  # 工具结果不进入摘要
+
+
+def test_last_turn_is_kept_even_over_budget():
+    lst_messages = turn(0) + turn(1)
+    lst_context, lst_dropped, _ = build_context(lst_messages, max_tokens=1)
+    assert lst_dropped == turn(0)
+    assert lst_context[1:] == turn(1)
+
+
+def test_existing_summary_is_extended():
+    lst_messages = turn(0) + turn(1)
+    _, _, summary = build_context(lst_messages, summary='earlier facts', max_tokens=tokens(turn(1)) + 50)
+    assert summary.startswith('earlier facts')
+    assert 'question 0' in summary
+
+
+def test_custom_summarize_fn():
+    lst_messages = turn(0) + turn(1)
+    lst_context, _, summary = build_context(
+        lst_messages, max_tokens=tokens(turn(1)) + 50,
+        summarize_fn=lambda lst_dropped, summary: f'{len(lst_dropped)} dropped',
+    )
+    assert summary == '4 dropped'
+    assert lst_context[0]['content'].endswith('4 dropped')
@@ -0,0 +1,124 @@
+"""
+ReplicaSet 的单元测试：滚动重启失败时的处理、会话表的淘汰。不启动网关和真实的代理进程。
+"""
+
+import threading
+import time
+
+import pytest
+
+from local_mcp_manager_gateway import ReplicaSet
+
+
+class FakeProcess:
+    """
+    代替 mp.Process：start 之后 lifetime 秒内视为在运行（None 表示一直运行）。
+    """
+    def __init__(self, lifetime=None):
+        self.lifetime = lifetime
+        self.pid = None
+        self._started_at = None
+        self._terminated = False
+
+    def start(self):
+        self._started_at = time.monotonic()
+
+    def is_alive(self):
+        if self._started_at is None or self._terminated:
+            return False
+        return self.lifetime is None or time.monotonic() - self._started_at < self.lifetime
+
+    def terminate(self):
+        self._terminated = True
+
+    def join(self, timeout=None):
+        pass
+
+    def kill(self):
+        self._terminated = True
+
+
+def make_set(spawn_fn, n_replicas=1, **kw):
+    replica_set = ReplicaSet('svc', spawn_fn, n_replicas, host='127.0.0.1', port=1, **kw)
+    for _ in range(n_replicas):
+        replica_set.add_replica().healthy = True
+    return replica_set
+
+
+def mark_healthy_until(replica_set, done):
+    """
+    代替健康检查：把进程在运行的副本标记为健康。
+    """
+    while not done.is_set():
+        with replica_set._lock:
+            for r in replica_set.replicas:
+                r.healthy = r.is_process_alive()
+        time.sleep(0.05)
+
+
+def test_replace_all_swaps_every_replica():
+    replica_set = make_set(lambda port: FakeProcess(), n_replicas=2)
+    lst_old = list(replica_set.replicas)
+    done = threading.Event()
+    threading.Thread(target=mark_healthy_until, args=(replica_set, done), daemon=True).start()
+    try:
+        replica_set.replace_all(lambda r: True, ready_timeout=5, drain_timeout=0)
+    finally:
+        done.set()
+    assert len(replica_set.replicas) == 2
+    assert not any(r in replica_set.replicas for r in lst_old)
+    assert not any(r.standby or r.draining for r in replica_set.replicas)
+    assert not replica_set.restarting
+
+
+def test_replace_all_gives_up_fast_when_new_replica_dies():
+    lst_spawned = []
+
+    def spawn_fn(port):
+        # 第一个副本正常运行，滚动重启时的新副本启动后立即退出
+        lst_spawned.append(FakeProcess(lifetime=None if not lst_spawned else 0.0))
+        return lst_spawned[-1]
+
+    replica_set = make_set(spawn_fn)
+    old = replica_set.replicas[0]
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError):
+        replica_set.replace_all(lambda r: True, ready_timeout=30, drain_timeout=0)
+    assert time.monotonic() - t0 < 5.0  # 没有等到 ready_timeout
+    assert replica_set.replicas == [old]
+    assert not old.draining and old.healthy
+    assert not replica_set.restarting
+
+
+def test_replace_all_gives_up_when_never_ready():
+    replica_set = make_set(lambda port: FakeProcess())
+    old = replica_set.replicas[0]
+    with pytest.raises(RuntimeError):
+        replica_set.replace_all(lambda r: False, ready_timeout=0.2, drain_timeout=0)
+    assert replica_set.replicas == [old]
+    assert not old.draining
+
+
+def test_sessions_over_the_cap_evict_least_recently_used():
+    replica_set = make_set(lambda port: FakeProcess(), max_sessions=2)
+    replica = replica_set.replicas[0]
+    with replica_set._lock:
+        replica_set._touch_session('s1', replica)
+        replica_set._touch_session('s2', replica)
+    assert replica_set.pick('s1') is replica  # s1 变为最近使用
+    with replica_set._lock:
+        replica_set._touch_session('s3', replica)
+    assert list(replica_set.sessions) == ['s1', 's3']
+    assert set(replica_set._session_seen) == {'s1', 's3'}
+
+
+def test_idle_sessions_expire():
+    replica_set = make_set(lambda port: FakeProcess(), session_ttl=0.05)
+    replica = replica_set.replicas[0]
+    with replica_set._lock:
+        replica_set._touch_session('old', replica)
+    time.sleep(0.1)
+    with replica_set._lock:
+        replica_set._touch_session('new', replica)
+    assert list(replica_set.sessions) == ['new']
+    assert replica_set.pick('old') is None
@@ -0,0 +1,178 @@
+"""
+熔断器与合并请求（SingleFlight）的单元测试。
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from local_mcp_manager_resilience import CircuitBreaker, SingleFlight
+
+
+def make_breaker(**kw):
+    cfg = dict(window=4, min_calls=2, failure_rate=0.5, slow_call_seconds=1.0, slow_call_rate=1.0,
+               open_seconds=0.05, half_open_probes=1)
+    cfg.update(kw)
+    return CircuitBreaker(**cfg)
+
+
+# ---------- CircuitBreaker ----------
+
+def test_breaker_stays_closed_below_min_calls():
+    breaker = make_breaker(min_calls=3)
+    breaker.record(False, 0.01)
+    breaker.record(False, 0.01)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_opens_on_failure_rate():
+    breaker = make_breaker()
+    breaker.record(True, 0.01)
+    breaker.record(False, 0.01)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_opens_on_slow_calls():
+    breaker = make_breaker()
+    breaker.record(True, 2.0)
+    breaker.record(True, 2.0)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_half_open_allows_one_probe_then_closes():
+    breaker = make_breaker()
+    breaker.record(False, 0.01)
+    breaker.record(False, 0.01)
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # 只放行 half_open_probes 个探测
+    breaker.record(True, 0.01)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.status()['calls'] == 0
+
+
+def test_breaker_failed_probe_opens_again():
+    breaker = make_breaker()
+    breaker.record(False, 0.01)
+    breaker.record(False, 0.01)
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(False, 0.01)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_release_probe_returns_the_slot():
+    breaker = make_breaker()
+    breaker.record(False, 0.01)
+    breaker.record(False, 0.01)
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+
+
+def test_breaker_window_forgets_old_failures():
+    breaker = make_breaker(window=4, min_calls=4, failure_rate=0.75)
+    for ok in [False, False, True, True, True, True]:
+        breaker.record(ok, 0.01)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.status()['failures'] == 0
+
+
+# ---------- SingleFlight ----------
+
+def run_in_thread(fn):
+    result = {}
+
+    def target():
+        try:
+            result['value'] = asyncio.run(fn())
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    return thread, result
+
+
+def test_single_flight_shares_one_call_across_event_loops():
+    flight = SingleFlight()
+    release = threading.Event()
+    n_upstream = []
+
+    async def upstream():
+        n_upstream.append(1)
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+        return {'value': 42}
+
+    leader, leader_result = run_in_thread(lambda: flight.do('k', upstream))
+    while flight.status()['in_flight'] == 0:
+        time.sleep(0.01)
+    follower, follower_result = run_in_thread(lambda: flight.do('k', upstream))
+    while flight.n_shared == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert leader_result == {'value': {'value': 42}}
+    assert follower_result == {'value': {'value': 42}}
+    assert len(n_upstream) == 1
+    assert flight.status() == {'in_flight': 0, 'calls': 1, 'shared': 1}
+
+
+def test_single_flight_shares_the_error():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    async def upstream():
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+        raise ValueError('backend failed')
+
+    leader, leader_result = run_in_thread(lambda: flight.do('k', upstream))
+    while flight.status()['in_flight'] == 0:
+        time.sleep(0.01)
+    follower, follower_result = run_in_thread(lambda: flight.do('k', upstream))
+    while flight.n_shared == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert isinstance(leader_result['error'], ValueError)
+    assert isinstance(follower_result['error'], ValueError)
+
+
+def test_single_flight_runs_again_after_completion():
+    flight = SingleFlight()
+
+    async def upstream():
+        return 1
+
+    async def twice():
+        return [await flight.do('k', upstream), await flight.do('k', upstream)]
+
+    assert asyncio.run(twice()) == [1, 1]
+    assert flight.status()['calls'] == 2
+
+
+@pytest.mark.parametrize('key', ['a', ('svc', 'tool', '{}')])
+def test_single_flight_different_keys_do_not_share(key):
+    flight = SingleFlight()
+
+    async def upstream():
+        return key
+
+    async def both():
+        return await asyncio.gather(flight.do(key, upstream), flight.do('other', upstream))
+
+    assert asyncio.run(both()) == [key, key]
+    assert flight.status()['shared'] == 0